@@ -0,0 +1,32 @@
+"""Benchmarks for FOSS News Telegram Bot
+
+Benchmarks run offline against local stand-ins of external services,
+so configuration required by the bot is filled with dummy values here.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+
+from fossnewsbot.config import PREFIX
+
+
+os.environ.setdefault(f'{PREFIX}_ENV', 'development')
+os.environ.setdefault(f'{PREFIX}_BOT__TOKEN', '123456789:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+os.environ.setdefault(f'{PREFIX}_FNGS__USERNAME', 'bench')
+os.environ.setdefault(f'{PREFIX}_FNGS__PASSWORD', 'bench')
@@ -0,0 +1,114 @@
+"""LRU cache with TTL microbenchmark
+
+Compares `cache.LRUCacheTTL` in the working tree with its version in a git revision,
+by default the revision before the LRU cache was rebuilt on a monotonic clock.
+Only `cache.py` of the revision is loaded, so revisions with dependencies unavailable here can be compared too.
+
+Usage: python -m benchmarks.cache [--ref REVISION] [--size N] [--number N]
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections.abc
+import random
+import re
+import subprocess
+from argparse import ArgumentParser
+from timeit import timeit
+from types import ModuleType
+from typing import Callable, Dict
+
+import cache
+
+
+# Last revision with the LRU cache on wall clock time and linear expiry, i.e. the parent of the commit
+# which rebuilt it on a monotonic clock with an expiry heap
+DEFAULT_REF = '9f2d8d58be4a8f84547cd9e0905d18d8152f94e8'
+
+
+def git(*args: str) -> str:
+    return subprocess.run(['git', *args], check=True, capture_output=True, text=True).stdout
+
+
+def _abc_imports(match: re.Match) -> str:
+    """Import names moved to `collections.abc` (removed from `collections` in Python 3.10) from there"""
+    names = [name.strip() for name in match.group(1).split(',')]
+    abc = [name for name in names if name in collections.abc.__all__]
+    rest = [name for name in names if name not in abc]
+    lines = [f'from collections.abc import {", ".join(abc)}'] if abc else []
+    if rest:
+        lines.append(f'from collections import {", ".join(rest)}')
+    return '\n'.join(lines)
+
+
+def load(ref: str) -> ModuleType:
+    """Load `cache` module from git revision"""
+    source = git('show', f'{ref}:cache.py')
+    source = re.sub(r'^from collections import (.+)$', _abc_imports, source, flags=re.MULTILINE)
+    module = ModuleType(f'cache@{ref}')
+    exec(compile(source, f'{ref}:cache.py', 'exec'), module.__dict__)
+    return module
+
+
+def scenarios(module: ModuleType, size: int) -> Dict[str, Callable[[], None]]:
+    """Operations on a full cache of `size` entries"""
+    c = module.LRUCacheTTL(maxsize=size, days=1)
+    for i in range(size):
+        c[i] = i
+    keys = [random.randrange(size) for _ in range(4096)]
+    misses = [size + random.randrange(size * 100) for _ in range(4096)]
+    mixed = [random.randrange(size * 2) for _ in range(4096)]
+    n = len(keys)
+    pos = [0]
+
+    def hit() -> None:
+        c.get(keys[pos[0] % n])
+        pos[0] += 1
+
+    def insert() -> None:
+        c[misses[pos[0] % n]] = None
+        pos[0] += 1
+
+    def get_or_set() -> None:
+        k = mixed[pos[0] % n]
+        if c.get(k) is None:
+            c[k] = k
+        pos[0] += 1
+
+    return dict(hit=hit, insert=insert, get_or_set=get_or_set)
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ref', default=DEFAULT_REF, help='git revision to compare with '
+                                                           '(default: the revision before the LRU cache rebuild)')
+    parser.add_argument('--size', type=int, default=256, help='cache size')
+    parser.add_argument('--number', type=int, default=200000, help='number of operations')
+    args = parser.parse_args()
+
+    reference = load(args.ref)
+    print(f'{"operation":<12} {args.ref[:7] + ", ns":>12} {"current, ns":>12} {"speedup":>8}')
+    for name, op in scenarios(cache, args.size).items():
+        random.seed(name)
+        before = timeit(scenarios(reference, args.size)[name], number=args.number) / args.number
+        after = timeit(op, number=args.number) / args.number
+        print(f'{name:<12} {before * 1e9:12.0f} {after * 1e9:12.0f} {before / after:7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""Local FNGS stand-in for benchmarks
+
+This module implements a fake FOSS News Gathering Server with the API endpoints used by `fossnewsbot.fngs`.
+Every response is delayed by a configurable latency. A configurable part of API requests
+(except authentication) fails with `503 Service Unavailable`.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import base64
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from typing import Callable
+
+from aiohttp import web
+
+
+API = '/api/v2/'
+KEYWORDS = ['Linux', 'GNOME', 'KDE', 'Firefox', 'Rust', 'Python', 'Debian', 'Fedora', 'Mesa', 'Wayland',
+            'systemd', 'LibreOffice', 'GIMP', 'Blender', 'Kubernetes', 'Docker', 'PostgreSQL', 'Nextcloud']
+PROPRIETARY = ['Windows', 'macOS', 'GitHub', 'Google', 'Microsoft', 'Apple']
+
+
+def make_token(kind: str, lifetime: float) -> str:
+    """Generate unsigned JSON Web Token with expiration time"""
+    def encode(obj: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(obj).encode()).rstrip(b'=').decode()
+
+    return '.'.join([encode(dict(alg='none', typ='JWT')),
+                     encode(dict(token_type=kind, exp=int(time.time() + lifetime))), ''])
+
+
+def make_news(news_id: int, keywords: int = 12) -> dict:
+    """Generate a digest record similar to one returned by FNGS"""
+    dt = datetime(2021, 11, 1, tzinfo=timezone(timedelta(hours=5))) + timedelta(minutes=news_id)
+    names = random.sample(KEYWORDS + PROPRIETARY, min(keywords, len(KEYWORDS) + len(PROPRIETARY)))
+    return dict(
+        id=news_id,
+        title=f'News #{news_id}: {" and ".join(names[:3])} released (v{news_id}.0)',
+        url=f'https://example.org/news/{news_id}',
+        dt=dt.strftime('%Y-%m-%dT%H:%M:%S.%f%z') if news_id % 5 else None,
+        gather_dt=dt.strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
+        language=random.choice(['ENGLISH', 'RUSSIAN']),
+        title_keywords=[dict(name=k, is_generic=random.random() < 0.2, proprietary=k in PROPRIETARY) for k in names],
+        content_type=None,
+        content_category=None,
+    )
+
+
+class FakeFNGS:
+    """Fake FNGS server state and request handlers"""
+
+    def __init__(self, latency: float = 0.05, news: int = 1000, token_lifetime: float = 300,
+                 error_rate: float = 0) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.errors = 0
+        self.token_lifetime = token_lifetime
+        self.tokens = set()
+        self.news = {i: make_news(i) for i in range(1, news + 1)}
+        self.users = {}
+        self.attempts = {}
+        self.categorized = {}
+        self.requests = 0
+        self.replayed = 0
+        self._replies = {}  # responses by idempotency key
+        self._ids = count(1)
+
+    async def _delay(self) -> None:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _uncategorized(self, user_id: int) -> list:
+        done = self.categorized.get(user_id, set())
+        return [n for i, n in self.news.items() if i not in done]
+
+    def _access(self) -> str:
+        access = make_token('access', self.token_lifetime)
+        self.tokens.add(access)
+        return access
+
+    async def token(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.json_response(dict(access=self._access(), refresh=make_token('refresh', self.token_lifetime * 288)))
+
+    async def refresh_token(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.json_response(dict(access=self._access()))
+
+    @web.middleware
+    async def fail(self, request: web.Request, handler: Callable) -> web.StreamResponse:
+        if self.error_rate and not request.path.startswith(API + 'auth/') and random.random() < self.error_rate:
+            await self._delay()
+            self.errors += 1
+            return web.json_response(dict(detail='Service unavailable (fake error)'), status=503)
+        return await handler(request)
+
+    @web.middleware
+    async def authorize(self, request: web.Request, handler: Callable) -> web.StreamResponse:
+        if not request.path.startswith(API + 'auth/'):
+            token = request.headers.get('Authorization', '').split(' ')[-1]
+            if token not in self.tokens:
+                return web.json_response(dict(detail='Given token not valid for any token type'), status=401)
+        return await handler(request)
+
+    @web.middleware
+    async def idempotent(self, request: web.Request, handler: Callable) -> web.StreamResponse:
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return await handler(request)
+        if key in self._replies:
+            self.replayed += 1
+            status, body = self._replies[key]
+            return web.Response(status=status, body=body, content_type='application/json')
+        response = await handler(request)
+        if response.status < 500:
+            self._replies[key] = response.status, response.body
+        return response
+
+    async def get_user(self, request: web.Request) -> web.Response:
+        await self._delay()
+        tid = int(request.query['tid'])
+        if tid not in self.users:
+            return web.json_response(dict(detail='Not found.'), status=404)
+        return web.json_response(self.users[tid])
+
+    async def post_user(self, request: web.Request) -> web.Response:
+        await self._delay()
+        data = await request.post()
+        tid = int(data['tid'])
+        if tid in self.users:
+            return web.json_response(dict(tid=['telegram bot user with this tid already exists.']), status=400)
+        self.users[tid] = dict(id=len(self.users) + 1, tid=tid, username=data['username'], groups=[dict(name='users')])
+        return web.json_response(self.users[tid], status=201)
+
+    async def random_news(self, request: web.Request) -> web.Response:
+        await self._delay()
+        news = self._uncategorized(int(request.query['tbot-user-id']))
+        limit = int(request.query.get('limit', 1))
+        return web.json_response(dict(results=random.sample(news, min(limit, len(news)))))
+
+    async def news_count(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.json_response(dict(count=len(self._uncategorized(int(request.query['tbot-user-id'])))))
+
+    async def post_attempt(self, request: web.Request) -> web.Response:
+        await self._delay()
+        data = dict(await request.post())
+        attempt_id = next(self._ids)
+        self.attempts[attempt_id] = data
+        self.categorized.setdefault(int(data['telegram_bot_user']), set()).add(int(data['digest_record']))
+        return web.json_response(dict(id=attempt_id, **data), status=201)
+
+    async def patch_attempt(self, request: web.Request) -> web.Response:
+        await self._delay()
+        attempt_id = int(request.match_info['id'])
+        if attempt_id not in self.attempts:
+            return web.json_response(dict(detail='Not found.'), status=404)
+        self.attempts[attempt_id].update(await request.post())
+        return web.json_response(dict(id=attempt_id, **self.attempts[attempt_id]))
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.fail, self.authorize, self.idempotent])
+        app.router.add_post(API + 'auth/token/', self.token)
+        app.router.add_post(API + 'auth/token/refresh/', self.refresh_token)
+        app.router.add_get(API + 'tbot/user/', self.get_user)
+        app.router.add_post(API + 'tbot/user/', self.post_user)
+        app.router.add_get(API + 'tbot/digest-record/not-categorized/random/', self.random_news)
+        app.router.add_get(API + 'tbot/digest-record/not-categorized/count/', self.news_count)
+        app.router.add_post(API + 'tbot/digest-record/categorization-attempt/', self.post_attempt)
+        app.router.add_patch(API + 'tbot/digest-record/categorization-attempt/{id}/', self.patch_attempt)
+        return app
+
+
+async def serve(app: web.Application, host: str = '127.0.0.1', port: int = 0) -> web.AppRunner:
+    """Start aiohttp application in background and return its runner"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner
+
+
+def url(runner: web.AppRunner, path: str = API) -> str:
+    host, port = runner.addresses[0][:2]
+    return f'http://{host}:{port}{path}'
@@ -0,0 +1,110 @@
+"""Local Telegram Bot API stand-in for benchmarks
+
+This module implements a fake Telegram Bot API server which records calls of API methods
+and keeps sent messages with their inline keyboards, so clicks on their buttons can be simulated.
+Texts are returned as sent, entities are not parsed. Every response is delayed by a configurable latency.
+Flood control can be emulated: requests to a chat above the limit per second fail with 429 and `retry_after`.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import time
+from collections import Counter, defaultdict, deque
+from itertools import count
+from typing import Optional
+
+from aiohttp import web
+
+
+BOT = dict(id=1, is_bot=True, first_name='FOSS News Bot', username='fossnewsbot')
+
+
+class FakeTelegram:
+    """Fake Telegram Bot API state and request handler"""
+
+    def __init__(self, latency: float = 0.02, flood: int = 0) -> None:
+        self.latency = latency
+        self.flood = flood  # max requests per second in a chat, 0 — no limit
+        self.calls = Counter()
+        self.floods = 0
+        self._recent = defaultdict(deque)  # times of recent requests by chat id
+        self.messages = {}  # messages by chat id and message id
+        self.last = {}  # id of the last sent message by chat id
+        self._ids = count(1)
+
+    def message(self, chat_id: int) -> Optional[dict]:
+        """The last message sent to the chat"""
+        return self.messages.get((chat_id, self.last.get(chat_id)))
+
+    def _message(self, chat_id: int, message_id: int = None, text: str = None,
+                 reply_markup: Optional[str] = None) -> dict:
+        """Save sent or edited message; like in Telegram, editing without a keyboard removes the keyboard"""
+        if message_id is None:
+            message_id = self.last[chat_id] = next(self._ids)
+        old = self.messages.get((chat_id, message_id), {})
+        message = dict(
+            message_id=message_id,
+            date=int(time.time()),
+            chat=dict(id=chat_id, type='private'),
+            text=text if text is not None else old.get('text', ''),
+            **{'from': BOT},
+        )
+        if reply_markup:
+            message['reply_markup'] = json.loads(reply_markup)
+        self.messages[chat_id, message_id] = message
+        return message
+
+    def _flooded(self, chat_id: str) -> bool:
+        now = time.monotonic()
+        recent = self._recent[chat_id]
+        while recent and recent[0] < now - 1:
+            recent.popleft()
+        if len(recent) >= self.flood:
+            return True
+        recent.append(now)
+        return False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        data = await request.post()
+        if self.flood and 'chat_id' in data and self._flooded(data['chat_id']):
+            self.floods += 1
+            return web.json_response(dict(ok=False, error_code=429, description='Too Many Requests: retry after 1',
+                                          parameters=dict(retry_after=1)), status=429)
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            result = BOT
+        elif method == 'sendMessage':
+            result = self._message(int(data['chat_id']), text=data['text'], reply_markup=data.get('reply_markup'))
+        elif method in ('editMessageText', 'editMessageReplyMarkup'):
+            result = self._message(int(data['chat_id']), int(data['message_id']), data.get('text'),
+                                   data.get('reply_markup', ''))
+        else:
+            result = True
+
+        return web.json_response(dict(ok=True, result=result))
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
@@ -0,0 +1,81 @@
+"""FNGS client concurrency benchmark
+
+Runs a categorization click (fetch news, fetch count, send attempt) for many users at once
+against the local FNGS stand-in and compares concurrent and serialized throughput for several latencies.
+
+Usage: python -m benchmarks.fngs_client [--users N] [--latency SECONDS ...]
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from argparse import ArgumentParser
+from time import perf_counter
+
+from aiogram.types import User
+
+from . import fake_fngs
+from fossnewsbot.fngs import FNGS
+
+
+async def click(fngs: FNGS, user: User) -> None:
+    news = await fngs.fetch_news(user)
+    await fngs.fetch_news_count(user)
+    await fngs.send_attempt(user, news['id'], 'IN_DIGEST')
+
+
+async def run(latency: float, users: int) -> None:
+    server = fake_fngs.FakeFNGS(latency=latency)
+    runner = await fake_fngs.serve(server.app())
+    fngs = FNGS(fake_fngs.url(runner), 'bench', 'bench')
+    tusers = [User(id=i, first_name=f'User {i}', language_code='en') for i in range(1, users + 1)]
+
+    try:
+        await fngs.token
+        await asyncio.gather(*[fngs.fetch_user(u) for u in tusers])
+
+        t = perf_counter()
+        for u in tusers:
+            await click(fngs, u)
+        serial = perf_counter() - t
+
+        t = perf_counter()
+        await asyncio.gather(*[click(fngs, u) for u in tusers])
+        concurrent = perf_counter() - t
+    finally:
+        await fngs.close()
+        await runner.cleanup()
+
+    print(f'{latency * 1000:8.0f} ms {users:6d} {users / serial:12.1f} {users / concurrent:12.1f} '
+          f'{serial / concurrent:8.1f}x')
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50, help='number of concurrent users')
+    parser.add_argument('--latency', type=float, nargs='+', default=[0.005, 0.02, 0.05, 0.1],
+                        help='FNGS response latency in seconds')
+    args = parser.parse_args()
+
+    print(f'{"latency":>11} {"users":>6} {"serial/s":>12} {"concurrent/s":>12} {"speedup":>9}')
+    for latency in args.latency:
+        asyncio.run(run(latency, args.users))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Keyboards construction microbenchmark
+
+Compares building of inline keyboards from scratch (with serialization for Bot API request)
+with instantiation of cached keyboard templates.
+
+Usage: python -m benchmarks.keyboards [--number N]
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+from argparse import ArgumentParser
+from itertools import count
+from timeit import timeit
+
+from fossnewsbot import keyboards
+from fossnewsbot.fngs import TEST_CATEGORIES, TEST_TYPES
+from fossnewsbot.i18n import set_language
+from fossnewsbot.keyboards import Command
+
+
+ids = count(100000)
+
+BUILDERS = dict(
+    include=lambda i: keyboards._ternary(_('Include in digest?'), Command.INCLUDE, i),
+    is_main=lambda i: keyboards._ternary(_('Include in main news?'), Command.IS_MAIN, i),
+    types=lambda i: keyboards._from_dict(_('Choose type'), Command.CONTENT_TYPE, i, TEST_TYPES, 'ru', 3),
+    categories=lambda i: keyboards._from_dict(_('Choose category'), Command.CONTENT_CATEGORY, i, TEST_CATEGORIES, 'ru', 3),
+)
+
+TEMPLATES = dict(
+    include=lambda i: keyboards.include(i),
+    is_main=lambda i: keyboards.is_main(i),
+    types=lambda i: keyboards.types(i, TEST_TYPES, 'ru'),
+    categories=lambda i: keyboards.categories(i, TEST_CATEGORIES, 'ru'),
+)
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000, help='number of keyboards of every kind')
+    args = parser.parse_args()
+
+    set_language('ru')
+    for kind in BUILDERS:
+        # The same keyboards must be built
+        assert json.loads(json.dumps(BUILDERS[kind](1).to_python())) == json.loads(TEMPLATES[kind](1))
+
+    print(f'{"keyboard":<12} {"build, µs":>10} {"template, µs":>13} {"speedup":>8}')
+    for kind in BUILDERS:
+        build, template = BUILDERS[kind], TEMPLATES[kind]
+        before = timeit(lambda: json.dumps(build(next(ids)).to_python()), number=args.number) / args.number
+        after = timeit(lambda: template(next(ids)), number=args.number) / args.number
+        print(f'{kind:<12} {before * 1e6:10.1f} {after * 1e6:13.2f} {before / after:7.0f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""End-to-end load benchmark
+
+Drives the bot with synthetic Telegram updates: every user sends commands and clicks buttons of inline keyboards
+in messages of the bot until the news is categorized and the next one is requested (or, in batch mode,
+until every news of a batch has a state and the batch is submitted). FNGS and Telegram Bot API are replaced
+with local stand-ins, so the benchmark runs offline. Updates are passed to the dispatcher directly,
+as the webhook handler does. Throughput, latency percentiles of updates and Telegram API calls per update
+are reported for every scenario.
+
+Usage: python -m benchmarks.load [--users N] [--rounds N] [--news N] [--fngs-latency S] [--telegram-latency S]
+                                 [--error-rate R] [--telegram-flood N] [--limits] [--no-pool] [--scenario NAME ...]
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from collections import Counter
+from itertools import count
+from statistics import quantiles
+from time import perf_counter
+from typing import Awaitable, Callable, List
+
+from aiogram import Dispatcher
+from aiogram.types import Update
+
+from . import fake_fngs, fake_telegram
+from fossnewsbot.config import PREFIX
+
+
+MAX_CLICKS = 10  # clicks on a single news before the flow is considered broken
+BATCH_SIZE = 10  # news in a batch
+
+ids = count(1)
+
+
+class User:
+    """Synthetic Telegram user"""
+
+    def __init__(self, uid: int, lang: str) -> None:
+        self.json = dict(id=uid, is_bot=False, first_name=f'User {uid}', language_code=lang)
+        self.chat = dict(id=uid, type='private')
+
+    @property
+    def id(self) -> int:
+        return self.json['id']
+
+    def command(self, command: str) -> dict:
+        text = '/' + command
+        return dict(update_id=next(ids), message=dict(
+            message_id=next(ids), date=int(time.time()), chat=self.chat, text=text,
+            entities=[dict(type='bot_command', offset=0, length=len(text.split()[0]))], **{'from': self.json},
+        ))
+
+    def click(self, message: dict, data: str) -> dict:
+        return dict(update_id=next(ids), callback_query=dict(
+            id=str(next(ids)), chat_instance=str(self.id), message=message, data=data, **{'from': self.json},
+        ))
+
+
+class Stats:
+    """Latencies and errors of handled updates"""
+
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.broken = 0
+
+    def report(self, name: str, elapsed: float, calls: int) -> str:
+        n = len(self.latencies)
+        q = quantiles(self.latencies, n=100) if n > 1 else [self.latencies[0] if n else 0] * 99
+        return (f'{name:<11} {n:8d} {n / elapsed:9.1f} {q[49] * 1000:8.1f} {q[94] * 1000:8.1f} {q[98] * 1000:8.1f} '
+                f'{calls / max(n, 1):7.2f} {self.errors:7d} {self.broken:7d}')
+
+
+class Driver:
+    """Sends updates of synthetic users to the dispatcher"""
+
+    def __init__(self, dispatcher: Dispatcher, telegram: fake_telegram.FakeTelegram, think: float) -> None:
+        self._dispatcher = dispatcher
+        self._telegram = telegram
+        self._think = think
+        self.stats = Stats()
+
+    async def send(self, update: dict) -> None:
+        if self._think:
+            await asyncio.sleep(random.expovariate(1 / self._think))
+        started = perf_counter()
+        try:
+            await self._dispatcher.updates_handler.notify(Update.to_object(update))
+        except Exception as e:
+            self.stats.errors += 1
+            logging.debug('update failed: %r', e)
+        self.stats.latencies.append(perf_counter() - started)
+
+    async def start(self, user: User) -> None:
+        await self.send(user.command('start'))
+
+    async def next(self, user: User) -> None:
+        await self.send(user.command('next'))
+
+    async def categorize(self, user: User) -> None:
+        """Request news and click buttons until the next news is requested"""
+        await self.send(user.command('next'))
+        for _ in range(MAX_CLICKS):
+            message = self._telegram.message(user.id)
+            buttons = [b['callback_data'] for row in (message or {}).get('reply_markup', {}).get('inline_keyboard', [])
+                       for b in row if not b['callback_data'].startswith('? ')]
+            if not buttons:
+                break
+            data = random.choice(buttons)
+            await self.send(user.click(message, data))
+            if data == 'next':
+                return
+        self.stats.broken += 1
+
+    async def batch(self, user: User) -> None:
+        """Request a batch of news, choose digest state of every news and submit the batch"""
+        await self.send(user.command(f'batch {BATCH_SIZE}'))
+        for _ in range(MAX_CLICKS * BATCH_SIZE):
+            message = self._telegram.message(user.id)
+            buttons = {b['callback_data']: b['text'] for row in (message or {}).get('reply_markup', {})
+                       .get('inline_keyboard', []) for b in row if b['callback_data'].startswith('batch ')}
+            if not buttons:
+                break
+            submit = next(d for d in buttons if d.endswith(' done'))
+            decided, pages = buttons[submit].rsplit('(', 1)[1].rstrip(')').split('/')
+            if decided == pages:
+                await self.send(user.click(message, submit))
+                return
+            states = [d for d in buttons if d.split()[-1] in ('yes', 'no', '?')]
+            await self.send(user.click(message, random.choice(states)))
+        self.stats.broken += 1
+
+
+async def run(args: Namespace) -> None:
+    fngs_server = fake_fngs.FakeFNGS(latency=args.fngs_latency, news=args.news, error_rate=args.error_rate)
+    telegram = fake_telegram.FakeTelegram(latency=args.telegram_latency, flood=args.telegram_flood)
+    fngs_runner = await fake_fngs.serve(fngs_server.app())
+    telegram_runner = await fake_fngs.serve(telegram.app())
+    tmp = tempfile.TemporaryDirectory()
+
+    # Configuration is read on first use, so the bot is imported after the stand-ins are started
+    os.environ[f'{PREFIX}_FNGS__ENDPOINT'] = fake_fngs.url(fngs_runner)
+    os.environ[f'{PREFIX}_BOT__SERVER'] = fake_fngs.url(telegram_runner, '')
+    os.environ[f'{PREFIX}_JOURNAL__PATH'] = os.path.join(tmp.name, 'journal.db')
+    os.environ[f'{PREFIX}_CACHE__PERSISTENT__PATH'] = os.path.join(tmp.name, 'cache.db')
+    # Synthetic users click without pauses, so rate limits of the bot would be measured instead of the bot
+    os.environ[f'{PREFIX}_BOT__LIMITS__ENABLED'] = str(args.limits).lower()
+    os.environ[f'{PREFIX}_POOL__ENABLED'] = str(not args.no_pool).lower()
+    from aiogram import Bot
+    from fossnewsbot import handlers
+    from fossnewsbot.core import bot, dispatcher, fngs
+
+    Bot.set_current(bot)
+    Dispatcher.set_current(dispatcher)
+    await fngs.token
+    await handlers.on_startup(dispatcher, webhook=False)
+
+    users = [User(uid, random.choice(['en', 'ru'])) for uid in range(1, args.users + 1)]
+    print(f'{"scenario":<11} {"updates":>8} {"updates/s":>9} {"p50, ms":>8} {"p95, ms":>8} {"p99, ms":>8} '
+          f'{"tg/upd":>7} {"errors":>7} {"broken":>7}')
+    try:
+        for name in args.scenario:
+            driver = Driver(dispatcher, telegram, args.think)
+            flow: Callable[[User], Awaitable[None]] = getattr(driver, name)
+
+            async def session(user: User) -> None:
+                for _ in range(args.rounds):
+                    await flow(user)
+
+            calls = sum(telegram.calls.values())
+            started = perf_counter()
+            await asyncio.gather(*[session(u) for u in users])
+            print(driver.stats.report(name, perf_counter() - started, sum(telegram.calls.values()) - calls))
+    finally:
+        await handlers.on_shutdown(dispatcher, webhook=False)
+        session = await bot.get_session()
+        await session.close()
+        await telegram_runner.cleanup()
+        await fngs_runner.cleanup()
+        tmp.cleanup()
+
+    news = Counter(a['digest_record'] for a in fngs_server.attempts.values())
+    print(f'\nFNGS requests: {fngs_server.requests} (fake errors: {fngs_server.errors}), '
+          f'attempts: {len(fngs_server.attempts)} (on news categorized by another user: {sum(news.values()) - len(news)})')
+    print('Telegram calls: ' + ', '.join(f'{m}={n}' for m, n in telegram.calls.most_common())
+          + (f' (flood control errors: {telegram.floods})' if telegram.flood else ''))
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50, help='number of concurrent users')
+    parser.add_argument('--rounds', type=int, default=10, help='number of flows of every user in a scenario')
+    parser.add_argument('--news', type=int, default=1000, help='number of news in FNGS')
+    parser.add_argument('--fngs-latency', type=float, default=0.02, help='FNGS response latency in seconds')
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help='Telegram response latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='part of FNGS requests failing with 503')
+    parser.add_argument('--telegram-flood', type=int, default=0,
+                        help='Telegram requests per second in a chat before flood control errors (default: no limit)')
+    parser.add_argument('--limits', action='store_true', help='enable rate limits of Telegram requests')
+    parser.add_argument('--no-pool', action='store_true', help='fetch random news for every user instead of work pool')
+    parser.add_argument('--think', type=float, default=0, help='mean time between actions of a user in seconds')
+    parser.add_argument('--scenario', nargs='+', choices=['start', 'next', 'categorize', 'batch'],
+                        default=['start', 'next', 'categorize', 'batch'], help='scenarios to run')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Metrics recording overhead microbenchmark
+
+Measures cost of recording metrics of a single update: middleware hooks of update and callback handler,
+FNGS and Telegram API requests made while handling it. Cost of rendering metrics on scrape is measured too.
+
+Usage: python -m benchmarks.metrics [--number N] [--requests N]
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from argparse import ArgumentParser
+from time import monotonic, perf_counter
+from timeit import timeit
+
+from aiogram.types import Update
+
+from fossnewsbot import metrics
+from fossnewsbot import core  # noqa: F401 (registers metrics of caches)
+
+
+UPDATE = dict(update_id=1, callback_query=dict(
+    id='1', chat_instance='1', data='include 1 yes',
+    **{'from': dict(id=1, is_bot=False, first_name='Bench')},
+))
+
+
+async def update_hooks(middleware: metrics.MetricsMiddleware, update: Update, number: int) -> float:
+    """Average time of middleware hooks for an update with a callback query, seconds"""
+    started = perf_counter()
+    for _ in range(number):
+        data, handler_data = {}, {}
+        await middleware.on_pre_process_update(update, data)
+        await middleware.on_process_callback_query(update.callback_query, handler_data)
+        await middleware.on_post_process_callback_query(update.callback_query, [], handler_data)
+        await middleware.on_post_process_update(update, [], data)
+    return (perf_counter() - started) / number
+
+
+def request(requests: int) -> None:
+    """Recording of FNGS and Telegram API requests of a single update"""
+    for _ in range(requests):
+        started = monotonic()
+        labels = ('GET', metrics.endpoint('tbot/digest-record/categorization-attempt/42/'))
+        metrics.fngs_seconds.observe(monotonic() - started, labels)
+        metrics.fngs_responses.inc(labels + ('200',))
+        metrics.telegram_seconds.observe(monotonic() - started, ('editMessageText', 'ok'))
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=100000, help='number of updates')
+    parser.add_argument('--requests', type=int, default=3, help='number of API requests per update')
+    args = parser.parse_args()
+
+    update = Update.to_object(UPDATE)
+    hooks = asyncio.get_event_loop().run_until_complete(update_hooks(metrics.MetricsMiddleware(), update, args.number))
+    requests = timeit(lambda: request(args.requests), number=args.number) / args.number
+    render = timeit(metrics.registry.render, number=100) / 100
+    total = hooks + requests
+
+    print(f'{"recording":<28} {"µs":>8}')
+    print(f'{"middleware hooks":<28} {hooks * 1e6:8.2f}')
+    print(f'{f"{args.requests} API requests":<28} {requests * 1e6:8.2f}')
+    print(f'{"per update":<28} {total * 1e6:8.2f}')
+    for latency in (0.01, 0.05, 0.2):
+        print(f'{f"overhead at {latency * 1000:.0f} ms/update":<28} {total / latency:8.3%}')
+    print(f'{"render /metrics":<28} {render * 1e6:8.0f}  ({len(metrics.registry.render().splitlines())} lines)')
+
+
+if __name__ == '__main__':
+    main()
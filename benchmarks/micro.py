@@ -0,0 +1,263 @@
+"""Microbenchmark suite of CPU hot paths
+
+Measures functions called on every update with realistic inputs: LRU cache with TTL at its maximum size,
+formatting of news with dozens of keywords, updating of news cards from their state and in their text,
+building of keyboards of the full categories catalog, parsing of callback data and access to settings
+through Dynaconf and through the snapshot.
+
+Every benchmark is timed several times and the best time per call is taken. Results can be saved as a baseline
+and later runs compared with it: benchmarks which are slower than the baseline by more than the threshold
+are reported as regressions and the command exits with status 1. Baselines depend on the machine,
+so they are not committed.
+
+Usage: python -m benchmarks.micro [--save | --compare] [--baseline PATH] [--threshold R] [--repeat N] [PATTERN ...]
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import platform
+import random
+import sys
+from argparse import ArgumentParser
+from fnmatch import fnmatch
+from itertools import count, cycle
+from timeit import Timer
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from aiogram.types import Message
+
+import cache
+from . import cache as cache_bench
+from .fake_fngs import make_news
+from fossnewsbot import cards, keyboards
+from fossnewsbot.config import config, settings
+from fossnewsbot.fngs import TEST_CATEGORIES
+from fossnewsbot.i18n import set_language
+from fossnewsbot.keyboards import Command, Result
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+THRESHOLD = 0.1  # relative slowdown reported as a regression
+REPEAT = 5
+MIN_TIME = 0.2  # seconds per timing
+
+CACHE_SIZE = config.cache.users.size
+KEYWORDS = 48
+
+# Benchmarks by name: every function prepares inputs and returns a function to time
+BENCHMARKS: Dict[str, Callable[[], Callable[[], Any]]] = {}
+
+
+def benchmark(name: str) -> Callable:
+    def register(setup: Callable[[], Callable[[], Any]]) -> Callable[[], Callable[[], Any]]:
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def news() -> dict:
+    """News with dozens of keywords"""
+    random.seed(1)
+    n = make_news(1, keywords=KEYWORDS)
+    n['title_keywords'] = (n['title_keywords'] * (KEYWORDS // len(n['title_keywords']) + 1))[:KEYWORDS]
+    n['count'] = 12345
+    n['content_type'] = 'NEWS'
+    n['content_category'] = 'SYSTEM'
+    return n
+
+
+for _op in ('hit', 'insert', 'get_or_set'):
+    benchmark(f'cache.{_op}')(lambda op=_op: cache_bench.scenarios(cache, CACHE_SIZE)[op])
+
+
+@benchmark('render.format_news')
+def _format_news() -> Callable[[], Any]:
+    n = news()
+    return lambda: cards.format_news(n)
+
+
+@benchmark('render.format_news_body')
+def _format_news_body() -> Callable[[], Any]:
+    n = news()
+    return lambda: cards.format_news_body(n, True, True)
+
+
+@benchmark('render.parse_datetime')
+def _parse_datetime() -> Callable[[], Any]:
+    dt = news()['gather_dt']
+    return lambda: cards.parse_datetime(dt)
+
+
+@benchmark('render.update_text_attr.set')
+def _update_text_attr_set() -> Callable[[], Any]:
+    text = cards.format_news(news())
+    return lambda: cards.update_text_attr(text, config.marker.content_category, 'Системное')
+
+
+@benchmark('render.update_text_attr.confirm')
+def _update_text_attr_confirm() -> Callable[[], Any]:
+    text = cards.format_news(news())
+    return lambda: cards.update_text_attr(text, config.marker.content_type)
+
+
+def entities(text: str) -> Tuple[str, List[dict]]:
+    """Plain text and entities of MarkdownV2 text used in cards, like in a message received from Telegram"""
+    kinds = {'*': 'bold', '_': 'italic', '~': 'strikethrough'}
+    plain, result, opened = [], [], {}
+    pos = 0  # offset in UTF-16 code units
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == '\\':
+            i += 1
+            c = text[i]
+        elif c == '\r':  # separates italic and underline, it is not a part of the text
+            i += 1
+            continue
+        elif c in kinds or c == '[':
+            if c in opened:
+                start = opened.pop(c)
+                result.append(dict(type=kinds[c], offset=start, length=pos - start))
+            else:
+                opened[c] = pos
+            i += 1
+            continue
+        elif c == ']' and '[' in opened:
+            end = text.index(')', i)
+            start = opened.pop('[')
+            result.append(dict(type='text_link', offset=start, length=pos - start, url=text[i + 2:end]))
+            i = end + 1
+            continue
+        plain.append(c)
+        pos += len(c.encode('utf-16-le')) // 2
+        i += 1
+    return ''.join(plain), result
+
+
+def click(card: Union[cards.Card, Message], marker: str) -> Callable[[], Any]:
+    """Choice of a content category: the card is updated and rendered like in the callback handler"""
+    def run() -> str:
+        c = card.copy() if isinstance(card, cards.Card) else cards.TextCard(card.md_text)
+        c.add_result(config.marker.include, 'В дайджест')
+        c.set_attr(marker, 'Системное')
+        return c.render()
+    return run
+
+
+@benchmark('render.click.state')
+def _click_state() -> Callable[[], Any]:
+    return click(cards.Card(news()), config.marker.content_category)
+
+
+@benchmark('render.click.text')
+def _click_text() -> Callable[[], Any]:
+    text, ents = entities(cards.format_news(news()))
+    message = Message.to_object(dict(message_id=1, date=0, chat=dict(id=1, type='private'), text=text, entities=ents))
+    return click(message, config.marker.content_category)
+
+
+@benchmark('keyboards._from_dict')
+def _from_dict() -> Callable[[], Any]:
+    ids = count(1)
+    return lambda: keyboards._from_dict(_('Choose category'), Command.CONTENT_CATEGORY, next(ids), TEST_CATEGORIES,
+                                        'ru', config.keyboard.columns)
+
+
+@benchmark('keyboards.categories')
+def _categories() -> Callable[[], Any]:
+    ids = count(1)
+    return lambda: keyboards.categories(next(ids), TEST_CATEGORIES, 'ru')
+
+
+@benchmark('keyboards.from_callback_data')
+def _from_callback_data() -> Callable[[], Any]:
+    data = cycle([
+        keyboards.to_callback_data(Command.INCLUDE, 123456, Result.YES),
+        keyboards.to_callback_data(Command.IS_MAIN, 123456, Result.NO),
+        keyboards.to_callback_data(Command.CONTENT_CATEGORY, 123456, Result.SET, 'MULTIMEDIA'),
+        keyboards.to_callback_data(Command.NEXT),
+    ])
+    return lambda: keyboards.from_callback_data(next(data))
+
+
+@benchmark('config.dynaconf')
+def _config_dynaconf() -> Callable[[], Any]:
+    return lambda: (config.features.types, config.marker.include, config.keyboard.columns)
+
+
+@benchmark('config.snapshot')
+def _config_snapshot() -> Callable[[], Any]:
+    return lambda: (settings().features.types, settings().marker.include, settings().keyboard.columns)
+
+
+def measure(setup: Callable[[], Callable[[], Any]], repeat: int) -> float:
+    """Best time of a call in nanoseconds"""
+    timer = Timer(setup())
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * MIN_TIME / elapsed))
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--save', action='store_true', help='save results as the baseline')
+    mode.add_argument('--compare', action='store_true', help='compare results with the baseline')
+    parser.add_argument('--baseline', default=BASELINE, help=f'baseline file (default: {BASELINE})')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help=f'slowdown reported as a regression (default: {THRESHOLD})')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help=f'timings of every benchmark (default: {REPEAT})')
+    parser.add_argument('patterns', nargs='*', metavar='PATTERN', help='run only benchmarks matching glob patterns')
+    args = parser.parse_args()
+
+    set_language('ru')
+    baseline = {}
+    if args.compare:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)['results']
+        except FileNotFoundError:
+            parser.error(f'no baseline in {args.baseline}, save it with --save first')
+
+    names = [n for n in BENCHMARKS if not args.patterns or any(fnmatch(n, p) for p in args.patterns)]
+    results, regressions = {}, []
+    print(f'{"benchmark":<36} {"ns":>10}' + (f' {"baseline":>10} {"change":>8}' if baseline else ''))
+    for name in names:
+        results[name] = ns = measure(BENCHMARKS[name], args.repeat)
+        line = f'{name:<36} {ns:10.0f}'
+        if name in baseline:
+            change = ns / baseline[name] - 1
+            line += f' {baseline[name]:10.0f} {change:+8.1%}'
+            if change > args.threshold:
+                regressions.append(name)
+                line += '  REGRESSION'
+        print(line)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(python=sys.version.split()[0], machine=platform.machine(), results=results), f, indent=2)
+        print(f'\nBaseline saved to {args.baseline}')
+    if regressions:
+        print(f'\n{len(regressions)} regression(s) above {args.threshold:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
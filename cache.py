@@ -17,25 +17,244 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from collections import Mapping, namedtuple
-from datetime import datetime, timedelta
+import asyncio
+import os
+import pickle
+import sqlite3
+from collections import namedtuple
+from collections.abc import Mapping
+from datetime import timedelta
 from functools import update_wrapper
-from typing import Any, Callable, Generator, Tuple
+from heapq import heapify, heappop, heappush
+from inspect import iscoroutinefunction
+from logging import getLogger
+from math import inf
+from time import monotonic, time
+from typing import Any, Awaitable, Callable, Dict, Generator, Iterator, Optional, Tuple, Union
+
+
+CacheInfoTTL = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize', 'ttl', 'coalesced'], defaults=[0])
+
+# TTL of an entry: number of seconds or a function of the value returning number of seconds;
+# zero or `None` means no TTL
+TTL = Union[None, float, Callable[[Any], Optional[float]]]
+
+# Persistent cache
+PERSISTENT_MAXSIZE = 64 * 2 ** 20  # bytes
+PERSISTENT_TIMEOUT = 5  # seconds to wait for a lock held by another process
+PERSISTENT_TRIM_INTERVAL = 64  # writes
+PERSISTENT_FLUSH_DELAY = 1  # seconds to collect writes into a single transaction
+
+# Expired entries of a cache are evicted at most once in this number of seconds
+EXPIRE_DELAY = 1
+
+PERSISTENT_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT NOT NULL,
+    key BLOB NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS cache_updated ON cache (updated);
+'''
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+def _seconds(days: float = 0, seconds: float = 0, microseconds: float = 0, milliseconds: float = 0,
+             minutes: float = 0, hours: float = 0, weeks: float = 0) -> float:
+    return timedelta(days=days, seconds=seconds, microseconds=microseconds, milliseconds=milliseconds,
+                     minutes=minutes, hours=hours, weeks=weeks).total_seconds()
+
+
+class PersistentCache:
+    """Persistent tier of caches: SQLite database which survives restarts
+
+    Keys and values are pickled. Expiration times are stored as Unix time, so entries keep their TTL
+    across restarts; entries without TTL are not stored, since they would be reused after restarts forever.
+    The database is in WAL mode, so several processes on the same host can share it.
+    When the size of values exceeds `maxsize` bytes, expired entries and then least recently written entries
+    are deleted.
+
+    Writes are not done on the spot: within an event loop they are collected for `PERSISTENT_FLUSH_DELAY` seconds
+    and written in a single transaction, so a cache set does not wait for the disk. Reads see pending writes.
+
+    Errors of the database are logged and treated as misses: the cache must not break its users.
+    """
+
+    def __init__(self, path: str, maxsize: int = PERSISTENT_MAXSIZE) -> None:
+        self._path = path
+        self._maxsize = maxsize
+        self._db: Optional[sqlite3.Connection] = None
+        self._pid = None
+        self._writes = 0
+        # Rows to write (`None` to delete) by namespace and pickled key
+        self._pending: Dict[Tuple[str, bytes], Optional[Tuple[bytes, Optional[float], float]]] = {}
+        self._flusher: Optional[asyncio.TimerHandle] = None
 
+    @property
+    def db(self) -> sqlite3.Connection:
+        # A connection must not be used by a forked process, so every process opens its own one
+        if self._db is None or self._pid != os.getpid():
+            # The cache may contain secrets (e.g. tokens), so it is readable by the owner only
+            os.close(os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600))
+            self._db = sqlite3.connect(self._path, timeout=PERSISTENT_TIMEOUT, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(PERSISTENT_SCHEMA)
+            self._pid = os.getpid()
+            self.trim()
+        return self._db
+
+    def close(self) -> None:
+        self.flush()
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = None
+
+    def get(self, namespace: str, key: Any) -> Tuple[Any, Optional[float]]:
+        """Get value and its remaining TTL in seconds (`None` means no TTL); raise `KeyError` if there is no entry"""
+        try:
+            pickled = pickle.dumps(key)
+            if (namespace, pickled) in self._pending:
+                row = self._pending[namespace, pickled]
+            else:
+                row = self.db.execute('SELECT value, expires FROM cache WHERE namespace = ? AND key = ?',
+                                      (namespace, pickled)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            ttl = None if row[1] is None else row[1] - time()
+            if ttl is not None and ttl <= 0:
+                raise KeyError(key)
+            return pickle.loads(row[0]), ttl
+        except (sqlite3.Error, pickle.PickleError, AttributeError, EOFError, ImportError) as e:
+            log.warning('persistent cache %s: cannot get %r: %r', namespace, key, e)
+            raise KeyError(key)
 
-CacheInfoTTL = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize', 'ttl'])
+    def put(self, namespace: str, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        """Set value with TTL in seconds; an entry without TTL (`None` or zero) is deleted instead"""
+        if not ttl:
+            self.delete(namespace, key)
+            return
+
+        now = time()
+        try:
+            self._pending[namespace, pickle.dumps(key)] = pickle.dumps(value), now + ttl, now
+        except (pickle.PickleError, AttributeError, TypeError) as e:
+            log.warning('persistent cache %s: cannot put %r: %r', namespace, key, e)
+            return
+        self._schedule()
+
+    def delete(self, namespace: str, key: Any = None) -> None:
+        """Delete entry; all entries of the namespace are deleted if `key` is `None`"""
+        if key is not None:
+            self._pending[namespace, pickle.dumps(key)] = None
+            self._schedule()
+            return
+
+        for pending in [pending for pending in self._pending if pending[0] == namespace]:
+            del self._pending[pending]
+        try:
+            self.db.execute('DELETE FROM cache WHERE namespace = ?', (namespace,))
+        except sqlite3.Error as e:
+            log.warning('persistent cache %s: cannot delete %r: %r', namespace, key, e)
+
+    def _schedule(self) -> None:
+        """Flush pending writes later within an event loop, otherwise at once"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if self._flusher is None:
+            self._flusher = loop.call_later(PERSISTENT_FLUSH_DELAY, self.flush)
+
+    def flush(self) -> None:
+        """Write pending writes in a single transaction"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        try:
+            db = self.db
+            with db:
+                db.execute('BEGIN')
+                for (namespace, key), row in pending.items():
+                    if row is None:
+                        db.execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (namespace, key))
+                    else:
+                        value, expires, updated = row
+                        db.execute('INSERT OR REPLACE INTO cache (namespace, key, value, size, expires, updated) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)', (namespace, key, value, len(value), expires, updated))
+        except sqlite3.Error as e:
+            log.warning('persistent cache: cannot write %i entries: %r', len(pending), e)
+            return
+
+        self._writes += len(pending)
+        if self._writes >= PERSISTENT_TRIM_INTERVAL:
+            self._writes = 0
+            self.trim()
+
+    def items(self, namespace: str, limit: int = -1) -> Iterator[Tuple[Any, Any, Optional[float]]]:
+        """Unexpired entries (key, value, remaining TTL) of the namespace from the least recently written one;
+        only `limit` most recently written entries are returned if `limit` is not negative
+        """
+        self.flush()
+        now = time()
+        try:
+            rows = self.db.execute('SELECT key, value, expires FROM ('
+                                   '  SELECT key, value, expires, updated FROM cache'
+                                   '  WHERE namespace = ? AND (expires IS NULL OR expires > ?)'
+                                   '  ORDER BY updated DESC LIMIT ?'
+                                   ') ORDER BY updated', (namespace, now, limit)).fetchall()
+        except sqlite3.Error as e:
+            log.warning('persistent cache %s: cannot read: %r', namespace, e)
+            return
+
+        for key, value, expires in rows:
+            try:
+                yield pickle.loads(key), pickle.loads(value), None if expires is None else expires - now
+            except (pickle.PickleError, AttributeError, EOFError, ImportError) as e:
+                log.warning('persistent cache %s: cannot load entry: %r', namespace, e)
+
+    def trim(self) -> None:
+        """Delete expired entries and the least recently written entries beyond the size limit"""
+        try:
+            db = self.db
+            db.execute('DELETE FROM cache WHERE expires <= ?', (time(),))
+            db.execute('DELETE FROM cache WHERE rowid IN ('
+                       '  SELECT rowid FROM (SELECT rowid, sum(size) OVER (ORDER BY updated DESC) AS total FROM cache)'
+                       '  WHERE total > ?'
+                       ')', (self._maxsize,))
+        except sqlite3.Error as e:
+            log.warning('persistent cache: cannot trim: %r', e)
 
 
 class cached_property_with_ttl:
-    """Decorator for cached property with TTL"""
+    """Decorator for cached property with TTL
+
+    A coroutine function is cached as a future, so the property is awaitable and concurrent awaits share
+    the same call. A future that has failed or has been cancelled is not cached.
+
+    With a persistent cache `store`, values are written through to it and a missing value is loaded from it
+    before the property is computed, so values survive restarts.
+    """
 
     def __init__(self, days: float = 0, seconds: float = 0, microseconds: float = 0, milliseconds: float = 0,
-                 minutes: float = 0, hours: float = 0, weeks: float = 0):
-        self._ttl = timedelta(days=days, seconds=seconds, microseconds=microseconds, milliseconds=milliseconds,
-                              minutes=minutes, hours=hours, weeks=weeks)
-        self._dt = None
+                 minutes: float = 0, hours: float = 0, weeks: float = 0, store: PersistentCache = None):
+        self._ttl = _seconds(days=days, seconds=seconds, microseconds=microseconds, milliseconds=milliseconds,
+                             minutes=minutes, hours=hours, weeks=weeks)
+        self._expires = inf
         self._hits = 0
         self._misses = 0
+        self._store = store
         self.__wrapped__ = None
 
     def __call__(self, fget: Callable[[Any], Any]) -> Any:
@@ -47,38 +266,76 @@ def __get__(self, obj: Any, cls: Any = None) -> Any:
             return self
 
         try:
-            if self._ttl and self._dt and datetime.utcnow() - self._dt >= self._ttl:
+            if monotonic() >= self._expires:
                 raise AttributeError
             value = obj.__dict__[self.__name__]
+            if isinstance(value, asyncio.Future) and value.done() and (value.cancelled() or value.exception()):
+                raise AttributeError
             self._hits += 1
         except (AttributeError, KeyError):
-            value = self.__wrapped__(obj)
+            try:
+                value = self._load()
+            except KeyError:
+                value = self._compute(obj)
             obj.__dict__[self.__name__] = value
-            self._dt = datetime.utcnow()
-            self._misses += 1
 
         return value
 
+    def _load(self) -> Any:
+        """Load value from the persistent cache"""
+        if self._store is None:
+            raise KeyError(self.__qualname__)
+
+        value, ttl = self._store.get('properties', self.__qualname__)
+        if iscoroutinefunction(self.__wrapped__):
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(value)
+            value = future
+        self._expires = monotonic() + ttl if ttl is not None else inf
+        self._hits += 1
+
+        return value
+
+    def _compute(self, obj: Any) -> Any:
+        value = self.__wrapped__(obj)
+        if iscoroutinefunction(self.__wrapped__):
+            value = asyncio.ensure_future(value)
+            if self._store is not None:
+                value.add_done_callback(self._save)
+        elif self._store is not None:
+            self._store.put('properties', self.__qualname__, value, self._ttl)
+        self._expires = monotonic() + self._ttl if self._ttl else inf
+        self._misses += 1
+
+        return value
+
+    def _save(self, future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is None:
+            self._store.put('properties', self.__qualname__, future.result(), self._ttl)
+
     def __delete__(self, obj: Any) -> None:
         try:
             del obj.__dict__[self.__name__]
         except KeyError:
             pass
+        if self._store is not None:
+            self._store.delete('properties', self.__qualname__)
 
     def info(self) -> CacheInfoTTL:
-        return CacheInfoTTL(hits=self._hits, misses=self._misses, maxsize=1, currsize=1, ttl=self._ttl)
+        return CacheInfoTTL(hits=self._hits, misses=self._misses, maxsize=1, currsize=1,
+                            ttl=timedelta(seconds=self._ttl))
 
 
 class CacheNode:
     """Node in doubly linked list and hash map"""
 
-    __slots__ = ('empty', 'next', 'prev', 'key', 'value', 'dt')
+    __slots__ = ('empty', 'next', 'prev', 'key', 'value', 'expires')
 
     def __init__(self) -> None:
         self.empty = True
         self.key = None
         self.value = None
-        self.dt = None
+        self.expires = inf
 
     def __str__(self) -> str:
         return f'{self.key}: {self.value}'
@@ -86,31 +343,67 @@ def __str__(self) -> str:
     def __bool__(self) -> bool:
         return not self.empty
 
-    def set(self, key: Any, value: Any) -> None:
+    def __lt__(self, other: 'CacheNode') -> bool:
+        # Nodes with the same expiration time are not ordered in the expiration heap
+        return False
+
+    def set(self, key: Any, value: Any, expires: float = inf) -> None:
         self.empty = False
         self.key = key
         self.value = value
-        self.dt = datetime.utcnow()
+        self.expires = expires
 
     def clear(self) -> None:
         self.__init__()
 
 
+def _consume(task: asyncio.Task) -> None:
+    """Retrieve exception of a finished task so it is not reported as never retrieved"""
+    if not task.cancelled():
+        task.exception()
+
+
 class LRUCacheTTL:
-    """LRU cache with TTL"""
+    """LRU cache with TTL
+
+    Time is measured with a monotonic clock. Every entry has its own expiration time (see `set`),
+    expiration times are kept in a heap, so expired entries are evicted proactively instead of occupying
+    the cache until they are touched again: on insertion, by `expire`, and within an event loop by a timer
+    set to the nearest expiration time (but not more often than every `EXPIRE_DELAY` seconds),
+    so entries of an idle cache are evicted too.
+
+    Zero TTL means no TTL: entries never expire. Note that zero TTL used to expire entries at once,
+    so a zero TTL in a configuration written for previous versions now keeps entries until they are evicted.
+
+    Missing values can be fetched with `fetch`, so concurrent misses of the same key share a single call.
+
+    With a persistent cache `store`, entries set by `set` are written through to its namespace `name`,
+    `fetch` looks up missing values there before fetching them, and `warm` loads entries from it.
+    Entries evicted from memory are kept by the store.
+    """
 
     def __init__(self, maxsize: int = 128, days: float = 0, seconds: float = 0, microseconds: float = 0,
-                 milliseconds: float = 0, minutes: float = 0, hours: float = 0, weeks: float = 0) -> None:
+                 milliseconds: float = 0, minutes: float = 0, hours: float = 0, weeks: float = 0,
+                 timer: Callable[[], float] = monotonic, store: PersistentCache = None, name: str = '') -> None:
         self._data = {}
         self._head = CacheNode()
         self._head.next = self._head
         self._head.prev = self._head
         self._maxsize = 1
         self.maxsize = maxsize
-        self._ttl = timedelta(days=days, seconds=seconds, microseconds=microseconds, milliseconds=milliseconds,
-                              minutes=minutes, hours=hours, weeks=weeks)
+        self._ttl = _seconds(days=days, seconds=seconds, microseconds=microseconds, milliseconds=milliseconds,
+                             minutes=minutes, hours=hours, weeks=weeks)
+        self._timer = timer
+        self._expiry = []  # heap of (expiration time, node)
+        self._compact_size = 4 * self._maxsize
+        self._expirer: Optional[asyncio.TimerHandle] = None
         self.hits = 0
         self.misses = 0
+        self.coalesced = 0
+        self.expired = 0
+        self._inflight = {}
+        self._store = store
+        self._name = name
 
     def __str__(self) -> str:
         return '{' + ', '.join([str(node) for node in self._iter()]) + '}'
@@ -129,6 +422,55 @@ def _move_to_tail(self, node: CacheNode) -> None:
         node.next.prev = node
         node.prev.next = node
 
+    def expire(self) -> int:
+        """Evict all expired entries and return their number"""
+        now = self._timer()
+        n = 0
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= now:
+            expires, node = heappop(expiry)
+            # Nodes are reused, so the node is checked to be still expiring at this time
+            if not node.empty and node.expires == expires:
+                self._evict(node)
+                n += 1
+        self.expired += n
+
+        return n
+
+    def _schedule_expire(self) -> None:
+        """Set the timer evicting expired entries to the nearest expiration time if there is an event loop"""
+        if self._expirer is not None or not self._expiry:
+            return
+        # Unlike `get_running_loop`, it does not raise without a loop, which is costly on every insertion
+        loop = asyncio._get_running_loop()
+        if loop is None:
+            return
+        delay = max(self._expiry[0][0] - self._timer(), EXPIRE_DELAY)
+        self._expirer = loop.call_later(delay, self._expire_due)
+
+    def _expire_due(self) -> None:
+        self._expirer = None
+        self.expire()
+        self._schedule_expire()
+
+    def _compact(self) -> None:
+        """Drop heap items of entries which are deleted or have got another expiration time"""
+        live = {}
+        for item in self._expiry:
+            node = item[1]
+            if not node.empty and node.expires == item[0]:
+                live[id(node)] = item
+        self._expiry = list(live.values())
+        heapify(self._expiry)
+        self._compact_size = 4 * max(self._maxsize, len(self._expiry))
+
+    def _evict(self, node: CacheNode) -> None:
+        if self._head is node:
+            self._head = node.next
+        else:
+            self._move_to_tail(node)
+        del self[node.key]
+
     def peek(self, key: Any) -> Any:
         return self._data[key].value
 
@@ -139,12 +481,9 @@ def __getitem__(self, key):
             self.misses += 1
             raise ex
 
-        if datetime.utcnow() - node.dt >= self._ttl:
-            if self._head == node:
-                self._head = node.next
-            else:
-                self._move_to_tail(node)
-            del self[key]
+        if node.expires <= self._timer():
+            self._evict(node)
+            self.expired += 1
             self.misses += 1
             raise KeyError(key)
 
@@ -160,7 +499,45 @@ def get(self, key: Any, default: Any = None) -> Any:
         except KeyError:
             return default
 
+    async def fetch(self, key: Any, fetch: Callable[[], Awaitable[Any]], ttl: TTL = None) -> Any:
+        """Get value by key; if it is missing, await `fetch()` and cache its result with `ttl`
+
+        Concurrent misses of the same key await the same call of `fetch`: they are counted as coalesced,
+        and an exception raised by `fetch` is propagated to all of them.
+        """
+        try:
+            return self[key]
+        except KeyError:
+            pass
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, fetch, ttl))
+            task.add_done_callback(_consume)
+            self._inflight[key] = task
+        else:
+            self.coalesced += 1
+
+        # A cancelled caller must not cancel the call shared with other callers
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: Any, fetch: Callable[[], Awaitable[Any]], ttl: TTL) -> Any:
+        try:
+            if self._store is not None:
+                try:
+                    value, remaining = self._store.get(self._name, key)
+                    self._insert(key, value, remaining or 0)
+                    return value
+                except KeyError:
+                    pass
+            value = await fetch()
+            self.set(key, value, ttl)
+            return value
+        finally:
+            del self._inflight[key]
+
     def __setitem__(self, key: Any, value: Any) -> None:
+        """Set value; an existing entry keeps its expiration time"""
         if key in self._data:
             node = self._data[key]
             node.value = value
@@ -168,11 +545,47 @@ def __setitem__(self, key: Any, value: Any) -> None:
             self._head = node
             return
 
-        node = self._head.prev
-        if node:
-            del self._data[node.key]
-        node.set(key, value)
-        self._data[key] = node
+        self.set(key, value)
+
+    def set(self, key: Any, value: Any, ttl: TTL = None) -> None:
+        """Set value with its own TTL (in seconds), default TTL of the cache is used if `ttl` is `None`"""
+        if ttl is None:
+            ttl = self._ttl
+        elif callable(ttl):
+            ttl = ttl(value)
+            if ttl is None:
+                ttl = self._ttl
+
+        self._insert(key, value, ttl)
+        if self._store is not None:
+            self._store.put(self._name, key, value, ttl)
+
+    def _insert(self, key: Any, value: Any, ttl: float) -> None:
+        now = self._timer()
+        expiry = self._expiry
+        if expiry and expiry[0][0] <= now:
+            self.expire()
+
+        node = self._data.get(key)
+        if node is None:
+            node = self._head.prev
+            if not node.empty:
+                del self._data[node.key]
+            self._data[key] = node
+        else:
+            self._move_to_tail(node)
+
+        if ttl:
+            expires = now + ttl
+            heappush(expiry, (expires, node))
+            if len(expiry) > self._compact_size:
+                self._compact()
+            if self._expirer is None:
+                self._schedule_expire()
+        else:
+            expires = inf
+
+        node.set(key, value, expires)
         self._head = node
 
     def setdefault(self, key: Any, default: Any = None) -> Any:
@@ -216,6 +629,9 @@ def items(self) -> Generator[Tuple[Any, Any], None, None]:
     _default = object()
 
     def pop(self, key: Any, default: Any = _default) -> Any:
+        if self._store is not None:
+            self._store.delete(self._name, key)
+
         if key in self._data:
             value = self.peek(key)
             del self[key]
@@ -259,6 +675,24 @@ def clear(self) -> None:
         for node in self._iter():
             node.clear()
         self._data.clear()
+        self._expiry.clear()
+        if self._expirer is not None:
+            self._expirer.cancel()
+            self._expirer = None
+        if self._store is not None:
+            self._store.delete(self._name)
+
+    def warm(self) -> int:
+        """Load the most recently written unexpired entries from the persistent cache and return their number"""
+        if self._store is None:
+            return 0
+
+        n = 0
+        for key, value, ttl in self._store.items(self._name, self.maxsize):
+            self._insert(key, value, ttl or 0)
+            n += 1
+
+        return n
 
     @property
     def maxsize(self) -> int:
@@ -287,4 +721,5 @@ def maxsize(self, size: int) -> None:
         self._maxsize += n
 
     def info(self) -> CacheInfoTTL:
-        return CacheInfoTTL(hits=self.hits, misses=self.misses, maxsize=self.maxsize, currsize=len(self), ttl=self._ttl)
+        return CacheInfoTTL(hits=self.hits, misses=self.misses, maxsize=self.maxsize, currsize=len(self),
+                            ttl=timedelta(seconds=self._ttl), coalesced=self.coalesced)
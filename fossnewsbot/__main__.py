@@ -1,4 +1,10 @@
-"""Run FOSS News Telegram Bot"""
+"""Run FOSS News Telegram Bot
+
+Modules of the bot are imported when it is known what is run, so the front process of multi-process mode
+does not import handlers. Caches are warmed up in background after the server is started (see `startup`).
+
+Usage: python -m fossnewsbot [--profile-startup]
+"""
 
 #  Copyright (C) 2021 PermLUG
 #
@@ -17,16 +23,14 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
 import logging
 import random
 import sys
+from argparse import ArgumentParser
+from functools import partial
 
-from aiogram import executor
-from requests import RequestException
-
-from . import handlers, log
-from .core import dispatcher, fngs
-from .config import config
+from . import startup
 
 
 LOG_LEVELS = dict(
@@ -39,27 +43,87 @@
 )
 
 
-if __name__ == '__main__':
-    logging.basicConfig(
-        format='%(asctime)s %(levelname)-8s %(name)s - %(message)s',
-        level=LOG_LEVELS.get(config.get('log.level', 'info'), logging.INFO),
+def front() -> None:
+    """Run the front process of multi-process mode"""
+    from .core import bot
+    from .workers import Front
+
+    Front(bot, config.workers.count, config.workers.port).run(
+        webhook_url=config.webhook.base + config.webhook.path,
+        webhook_path=config.webhook.path,
+        host=config.bot.host,
+        port=config.bot.port,
     )
 
-    try:
-        token = fngs.token
-    except RequestException as ex:
-        log.critical('Cannot fetch FNGS token: %s', ex)
-        sys.exit(1)
+
+def profile_startup() -> None:
+    """Import the bot and warm it up without starting the server, then print durations of phases"""
+    with startup.profile.phase('imports'):
+        from .core import fngs
+        from .handlers import WARM_UP
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(startup.warm_up(WARM_UP, retry=False))
+    loop.run_until_complete(fngs.close())
+    print(startup.profile.report())
+    sys.exit(1 if startup.profile.failed else 0)
+
+
+def serve() -> None:
+    """Run the bot in single process mode or a worker process"""
+    with startup.profile.phase('imports'):
+        from aiogram.dispatcher.webhook import WebhookRequestHandler
+        from aiogram.utils.executor import Executor
+        from aiohttp import web
+
+        from . import handlers, metrics
+        from .core import dispatcher, ingestion
+        from .ingest import INGESTION_KEY, IngestRequestHandler
+        from .workers import HEALTH_PATH, health
 
     if config.env != 'production':
         random.seed()
 
-    executor.start_webhook(
-        dispatcher=dispatcher,
-        skip_updates=True,
-        on_startup=handlers.on_startup,
-        on_shutdown=handlers.on_shutdown,
-        host=config.bot.host,
-        port=config.bot.port,
-        webhook_path=config.webhook.path,
+    app = web.Application()
+    if config.metrics.enabled:
+        app.router.add_get(metrics.METRICS_PATH, metrics.handler)
+
+    if config.ingest.enabled:
+        app[INGESTION_KEY] = ingestion
+    request_handler = IngestRequestHandler if config.ingest.enabled else WebhookRequestHandler
+
+    if config.workers.index < 0:
+        runner, webhook = Executor(dispatcher, skip_updates=True), True
+        host, port = config.bot.host, config.bot.port
+    else:
+        # Worker process: the webhook is managed by the front process
+        app.router.add_get(HEALTH_PATH, health)
+        runner, webhook = Executor(dispatcher), False
+        host, port = '127.0.0.1', config.workers.port + config.workers.index
+    runner.on_startup(partial(handlers.on_startup, webhook=webhook), polling=False)
+    runner.on_shutdown(partial(handlers.on_shutdown, webhook=webhook), polling=False)
+    runner.set_webhook(config.webhook.path, request_handler=request_handler, web_app=app)
+    runner.run_app(host=host, port=port)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python -m fossnewsbot', description='FOSS News Telegram Bot')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print durations of startup phases and exit; the server is not started')
+    args = parser.parse_args()
+
+    # Modules are imported in phases, so their durations are profiled
+    with startup.profile.phase('config'):
+        from .config import config, settings
+        settings()
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(name)s - %(message)s',
+        level=LOG_LEVELS.get(config.get('log.level', 'info'), logging.INFO),
     )
+
+    if args.profile_startup:
+        profile_startup()
+    elif config.workers.count and config.workers.index < 0:
+        front()
+    else:
+        serve()
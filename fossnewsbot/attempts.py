@@ -0,0 +1,155 @@
+"""Categorization attempts builder for fossnewsbot
+
+In builder mode, fields of an attempt are collected while the user goes through keyboards
+and the attempt is sent to FNGS with a single write when the flow ends:
+Next is pressed, the last question is answered, or the user has been idle for too long.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from logging import getLogger
+from typing import List, Optional, Tuple, Union
+
+from .fngs import BotUser, attempt_data
+from .journal import Journal
+
+
+# Default values
+DEFAULT_TIMEOUT = 300  # seconds
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+def _consume(task: asyncio.Task) -> None:
+    """Retrieve exception of a finished task so it is not reported as never retrieved"""
+    if not task.cancelled() and task.exception():
+        log.warning('timed out attempt flush failed: %r', task.exception())
+
+
+class Draft:
+    """Attempt which is not sent yet"""
+
+    __slots__ = ('attempt', 'user', 'data', 'timer')
+
+    def __init__(self, attempt: int, user: BotUser, data: dict) -> None:
+        self.attempt = attempt
+        self.user = user
+        self.data = data
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class AttemptBuilder:
+    """Per-user drafts of categorization attempts
+
+    Drafts are written to the attempts journal, so the builder mode requires the journal.
+    Attempt ids returned by the builder are local ids of the journal.
+    """
+
+    def __init__(self, journal: Journal, enabled: bool = True, timeout: float = DEFAULT_TIMEOUT) -> None:
+        self._journal = journal
+        self._drafts = {}
+        self._timeout = timeout
+        self.enabled = enabled and journal.enabled
+        if enabled and not journal.enabled:
+            log.warning('attempts builder is disabled because attempts journal is disabled')
+
+    def __len__(self) -> int:
+        return len(self._drafts)
+
+    async def send_attempt(self, user: BotUser, news_id: int, state: str = None, final: bool = False) -> int:
+        """Start a new attempt of this user; unfinished attempt of the user is flushed
+
+        If `final` is true, the attempt is sent right away.
+        """
+        if not self.enabled:
+            return await self._journal.send_attempt(user, news_id, state)
+
+        await self.flush(user)
+        draft = Draft(self._journal.allocate(user), user, attempt_data(news_id, state))
+        if final:
+            await self._journal.post_attempt(user, draft.attempt, draft.data)
+        else:
+            self._keep(draft)
+            log.debug("%s started attempt: local_id=%i news=%i state=%s", user, draft.attempt, news_id, state)
+
+        return draft.attempt
+
+    async def send_attempts(self, user: BotUser, states: List[Tuple[int, str]]) -> List[int]:
+        """Send final attempts of this user for pairs of news id and state at once
+
+        Unfinished attempt of the user is flushed.
+        """
+        await self.flush(user)
+        return await self._journal.send_attempts(user, states)
+
+    async def update_attempt(self, user: BotUser, attempt_id: int, field: str, value: Union[bool, int, str],
+                             final: bool = False) -> None:
+        """Set field of attempt; if `final` is true, the attempt is sent
+
+        Attempts which have been sent already are updated through the journal.
+        """
+        draft = self._drafts.get(user.tid)
+        if not self.enabled or draft is None or draft.attempt != attempt_id:
+            await self._journal.update_attempt(user, attempt_id, field, value)
+            return
+
+        draft.data[field] = value
+        log.debug("%s set attempt field: local_id=%i %s=%s", user, attempt_id, field, value)
+        if final:
+            await self.flush(user)
+
+    def _keep(self, draft: Draft) -> None:
+        """Keep the draft until the flow ends or the user is idle for too long"""
+        self._drafts[draft.user.tid] = draft
+        draft.timer = asyncio.get_event_loop().call_later(self._timeout, self._expire, draft.user.tid, draft.attempt)
+
+    async def flush(self, user: BotUser) -> None:
+        """Send unfinished attempt of this user, if any
+
+        If the attempt cannot be journaled, the draft is kept, so it is sent by the next flush or on timeout.
+        """
+        draft = self._drafts.pop(user.tid, None)
+        if draft is None:
+            return
+
+        draft.timer.cancel()
+        try:
+            await self._journal.post_attempt(draft.user, draft.attempt, draft.data)
+        except Exception:
+            # A new attempt of the user may have been started meanwhile; it is not replaced
+            if user.tid not in self._drafts:
+                self._keep(draft)
+            raise
+
+    def _expire(self, tid: int, attempt: int) -> None:
+        draft = self._drafts.get(tid)
+        if draft is not None and draft.attempt == attempt:
+            log.info("%s attempt timed out: local_id=%i", draft.user, attempt)
+            asyncio.ensure_future(self.flush(draft.user)).add_done_callback(_consume)
+
+    async def close(self) -> None:
+        """Send all unfinished attempts"""
+        for draft in list(self._drafts.values()):
+            try:
+                await self.flush(draft.user)
+            except Exception as e:
+                self._drafts.pop(draft.user.tid).timer.cancel()
+                log.error("%s unfinished attempt is lost: local_id=%i data=%s: %r",
+                          draft.user, draft.attempt, draft.data, e)
@@ -0,0 +1,306 @@
+"""News cards of fossnewsbot
+
+A news card is a message with a news and results of its categorization chosen by the user.
+The state of a card is kept in a per-user session, and the card is rendered from it on every edit.
+Cards of messages without state (sent before restart, expired or not the last card of the user)
+are edited in their text received from Telegram.
+
+A batch card shows several news one by one and keeps decisions of the user until they are submitted together.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+from aiogram import md
+from aiogram.types import Message
+
+from cache import CacheInfoTTL, LRUCacheTTL
+from .config import config, settings
+from .i18n import format_date, format_number, get_language
+
+
+class Body(NamedTuple):
+    """Rendered card without the "News left" line
+
+    Attributes which can be changed by the user are rendered separately:
+    they are kept as marker, beginning of the line and value.
+    """
+    head: str
+    attrs: Tuple[Tuple[str, str, str], ...]
+
+
+# Rendered bodies of cards.
+# Many users see the same news in the same language, so bodies are shared by news id, interface language,
+# snapshot of settings (enabled features and markers) and content type and category which are shown in the card.
+# Bodies rendered with settings which have been reloaded are not used anymore, so they are evicted in time.
+_bodies = LRUCacheTTL(maxsize=config.cache.cards.size, seconds=config.cache.cards.ttl)
+# Beginning of the "News left" line by interface language and marker
+_count_prefix = {}
+
+
+def cache_info() -> Dict[str, CacheInfoTTL]:
+    return dict(cards=_bodies.info())
+
+
+def format_lang(lang: str) -> str:
+    langs = dict(ENGLISH=_('English'), RUSSIAN=_('Russian'))
+    return langs.get(lang, _('Unknown'))
+
+
+def parse_datetime(s: str) -> datetime:
+    """Parse ISO 8601 date and time of FNGS
+
+    `datetime.fromisoformat` is much faster than `strptime`, but before Python 3.11 it does not accept
+    UTC offsets without a colon and `Z`, so they are normalized; anything else is parsed by `strptime`.
+    """
+    if s[-1] == 'Z':
+        s = s[:-1] + '+00:00'
+    elif len(s) > 10 and s[-5] in '+-':
+        s = s[:-2] + ':' + s[-2:]
+    try:
+        return datetime.fromisoformat(s)
+    except ValueError:
+        return datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%f%z')
+
+
+def format_news(news: dict, attrs: Dict[str, Optional[str]] = None) -> str:
+    """Render news card; `attrs` are new values of attributes by marker, `None` if the value is confirmed"""
+    return format_attrs(*format_news_head(news), attrs)
+
+
+def news_body(news: dict) -> Body:
+    """Rendered body of news card shared by users with the same interface language"""
+    snapshot = settings()
+    key = news['id'], get_language(), snapshot, news['content_type'], news['content_category']
+    body = _bodies.get(key)
+    if body is None:
+        body = _bodies[key] = format_news_body(news, snapshot.features.types, snapshot.features.categories)
+    return body
+
+
+def format_news_head(news: dict) -> Tuple[str, Tuple[Tuple[str, str, str], ...]]:
+    """Render news card without attributes which can be changed by the user"""
+    marker = settings().marker.count
+    key = get_language(), marker
+    body = news_body(news)
+    count = _count_prefix.get(key)
+    if count is None:
+        count = _count_prefix[key] = md.text(marker + ' ', md.italic(_('News left')), md.escape_md(': '), sep='')
+    return count + md.bold(format_number(news['count'])) + '\n\n' + body.head, body.attrs
+
+
+def format_attrs(head: str, body_attrs: Tuple[Tuple[str, str, str], ...], attrs: Dict[str, Optional[str]] = None) -> str:
+    text = head
+    for marker, prefix, value in body_attrs:
+        if attrs and marker in attrs:
+            new = attrs[marker]
+            text += '\n' + prefix + (md.bold(value) if new is None else md.strikethrough(value) + ' ' + md.bold(new))
+        else:
+            text += '\n' + prefix + md.escape_md(value)
+    return text
+
+
+def format_news_body(news: dict, types: bool, categories: bool) -> Body:
+    dt = format_date(parse_datetime(news['dt'] or news['gather_dt']))
+    lang = format_lang(news['language'])
+    marker = settings().marker
+    keywords_foss, keywords_proprietary = [], []
+    for k in news['title_keywords']:
+        if not k['is_generic']:
+            (keywords_proprietary if k['proprietary'] else keywords_foss).append(md.bold(k['name']))
+    lines = [
+        md.link(news['title'], news['url']),
+        md.text('\n', marker.date + ' ', md.italic(_('Date')), md.escape_md(': '), md.bold(dt), sep=''),
+        md.text(marker.lang + ' ', md.italic(_('Language')), md.escape_md(': '), md.bold(lang), sep=''),
+    ]
+    if keywords_foss:
+        lines.append(md.text(marker.keywords.foss + ' ', md.italic(_('FOSS')), md.escape_md(': '), ', '.join(keywords_foss), sep=''),)
+    if keywords_proprietary:
+        lines.append(md.text(marker.keywords.proprietary + ' ', md.italic(_('Proprietary')), md.escape_md(': '), ', '.join(keywords_proprietary), sep=''),)
+    attrs = []
+    if types:
+        content_type = news['content_type'] if news['content_type'] else _('Unknown')
+        attrs.append((marker.content_type, md.text(marker.content_type + ' ', md.italic(_('Type')), ': ', sep=''),
+                      content_type))
+    if categories:
+        content_category = news['content_category'] if news['content_category'] else _('Unknown')
+        attrs.append((marker.content_category, md.text(marker.content_category + ' ', md.italic(_('Category')), ': ', sep=''),
+                      content_category))
+    return Body(md.text(*lines, sep='\n'), tuple(attrs))
+
+
+def update_text_attr(text: str, marker: str, value: str = None) -> str:
+    def replace(m: re.Match) -> str:
+        return m[1] + md.strikethrough(m[2]) + ' ' + md.bold(md.escape_md(value))
+
+    def confirm(m: re.Match) -> str:
+        return m[1] + md.bold(m[2])
+
+    return re.sub(
+        pattern=fr'^({marker}\s+[^:]+:\s+)(.*)$',
+        repl=replace if value else confirm,
+        string=text, count=1, flags=re.MULTILINE)
+
+
+def append_result(icon: str, msg: str) -> str:
+    return '\n' + md.text(icon, md.bold(msg))
+
+
+class Card:
+    """State of a news card: the news and results chosen by the user
+
+    The card is rendered when it is created; on edits only attributes and results are rendered.
+    """
+
+    __slots__ = ('news', 'message_id', 'results', 'attrs', '_head', '_body_attrs')
+
+    def __init__(self, news: dict, message_id: int = None) -> None:
+        self.news = news
+        self.message_id = message_id
+        self.results: List[str] = []
+        self.attrs: Dict[str, Optional[str]] = {}
+        self._head, self._body_attrs = format_news_head(news)
+
+    def copy(self) -> 'Card':
+        card = object.__new__(Card)
+        card.news, card.message_id, card._head, card._body_attrs = self.news, self.message_id, self._head, self._body_attrs
+        card.results = self.results.copy()
+        card.attrs = self.attrs.copy()
+        return card
+
+    def add_result(self, icon: str, msg: str) -> None:
+        self.results.append(append_result(icon, msg))
+
+    def set_attr(self, marker: str, value: str = None) -> None:
+        """Set new value of an attribute or confirm its value if `value` is `None`"""
+        self.attrs[marker] = value
+
+    def render(self) -> str:
+        return format_attrs(self._head, self._body_attrs, self.attrs) + ''.join(self.results)
+
+
+class TextCard:
+    """Card of a message without state: results are added to the text of the message"""
+
+    __slots__ = ('text',)
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+    def add_result(self, icon: str, msg: str) -> None:
+        self.text += append_result(icon, msg)
+
+    def set_attr(self, marker: str, value: str = None) -> None:
+        self.text = update_text_attr(self.text, marker, value)
+
+    def render(self) -> str:
+        return self.text
+
+
+def state_results() -> Dict[str, Tuple[str, str]]:
+    """Markers and texts of results by digest state of attempts"""
+    marker = settings().marker
+    return {
+        'IN_DIGEST': (marker.include, _('In digest')),
+        'IGNORED': (marker.exclude, _('Not in digest')),
+        'UNKNOWN': (marker.unknown, _('Skip')),
+    }
+
+
+class Batch:
+    """State of a batch card: news shown page by page and digest states chosen by the user by page"""
+
+    __slots__ = ('news', 'message_id', 'page', 'states', 'submitted')
+
+    def __init__(self, news: List[dict], message_id: int = None) -> None:
+        self.news = news
+        self.message_id = message_id
+        self.page = 0
+        self.states: Dict[int, str] = {}
+        self.submitted = False
+
+    def copy(self) -> 'Batch':
+        batch = object.__new__(Batch)
+        batch.news, batch.message_id, batch.page, batch.submitted = self.news, self.message_id, self.page, self.submitted
+        batch.states = self.states.copy()
+        return batch
+
+    def decide(self, page: int, state: str) -> None:
+        """Set state of the news on the page and turn to the next page without a state, if any"""
+        self.states[page] = state
+        pages = len(self.news)
+        for p in range(page + 1, page + pages):
+            if p % pages not in self.states:
+                self.page = p % pages
+                return
+        self.page = page
+
+    def render(self) -> str:
+        """Render the current page or the summary of submitted states"""
+        results = state_results()
+        marker = settings().marker.batch
+        if self.submitted:
+            lines = [md.text(marker + ' ', md.bold(_('Batch submitted')), sep='')]
+            for state, (icon, msg) in results.items():
+                n = sum(1 for s in self.states.values() if s == state)
+                if n:
+                    lines.append(md.text(icon, md.italic(msg) + md.escape_md(': ') + md.bold(format_number(n))))
+            return '\n'.join(lines)
+
+        body = news_body(self.news[self.page])
+        text = md.text(marker + ' ', md.italic(_('News')), md.escape_md(': '),
+                       md.bold(md.escape_md(f'{self.page + 1}/{len(self.news)}')), md.escape_md(', '),
+                       md.italic(_('decided')), md.escape_md(': '), md.bold(format_number(len(self.states))), sep='')
+        text = format_attrs(text + '\n\n' + body.head, body.attrs)
+        state = self.states.get(self.page)
+        if state is not None:
+            text += append_result(*results[state])
+        return text
+
+
+class Sessions:
+    """The last card of every user
+
+    Sessions are kept in LRU cache with TTL, so the memory is bounded and sessions of idle users expire.
+    """
+
+    def __init__(self, maxsize: int = 1024, seconds: float = 3600) -> None:
+        self._cards = LRUCacheTTL(maxsize=maxsize, seconds=seconds)
+
+    def cache_info(self) -> Dict[str, CacheInfoTTL]:
+        return dict(sessions=self._cards.info())
+
+    def start(self, user_id: int, card: Union[Card, Batch], message: Message) -> None:
+        """Start a session for the card sent to the user"""
+        card.message_id = message.message_id
+        self._cards[user_id] = card
+
+    def get(self, user_id: int, message: Message) -> Union[Card, Batch, TextCard]:
+        """Card of the message; it is a copy, so the session is not changed until the card is saved"""
+        card = self._cards.get(user_id)
+        if card is None or card.message_id != message.message_id:
+            return TextCard(message.md_text)
+        return card.copy()
+
+    def save(self, user_id: int, card: Union[Card, Batch, TextCard]) -> None:
+        """Save the card after the message is edited"""
+        if isinstance(card, (Card, Batch)):
+            self._cards[user_id] = card
@@ -1,4 +1,14 @@
-"""FOSS News Telegram Bot settings"""
+"""FOSS News Telegram Bot settings
+
+Settings are read by Dynaconf from files and environment. Settings read on every update (markers, features,
+keyboard layout and so on) are read from a snapshot instead: an immutable copy of all validated settings
+in objects with slots, which is much faster than lazy attribute resolution of Dynaconf. Fields of the snapshot
+are typed by validators and checked when it is built.
+
+The snapshot is built again and swapped on SIGHUP and when settings files are changed, so settings read from it
+are changed without a restart; invalid settings are logged and the current snapshot is kept.
+Other settings are read once at startup.
+"""
 
 #  Copyright (C) 2021 PermLUG
 #
@@ -17,51 +27,231 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import os
+from logging import getLogger
+from typing import Any, Dict, List, Optional
+
 from dynaconf import Dynaconf, Validator
+from dynaconf.utils import ensure_a_list
+from dynaconf.utils.files import find_file
+from dynaconf.validator import ValidationError
 
 
 PREFIX = 'FOSSNEWSBOT'
 
-config = Dynaconf(
-    envvar_prefix=PREFIX,
-    envvar=f'{PREFIX}_CONFIG',
-    env_switcher=f'{PREFIX}_ENV',
-    environments=True,
-    settings_files=['config.yml', '.secrets.yml'],
-    validators=[
-        Validator('bot.token', 'fngs.username', 'fngs.username', required=True),
-        Validator('bot.host', default='127.0.0.1'),
-        Validator('bot.port', default=2048, is_type_of=int),
-        Validator('webhook.base', default='https://fn.permlug.org', is_type_of=str, startswith='http'),
-        Validator('webhook.path', default='/bot/', is_type_of=str, startswith='/'),
-        Validator('fngs.endpoint', default='https://fn.permlug.org/api/v1/', is_type_of=str, startswith='http'),
-        Validator('fngs.timeout', default=5, is_type_of=int),
-        Validator('fngs.retries', default=3, is_type_of=int),
-        Validator('log.level', default='info'),
-        Validator('localedir', default='locales'),
-        Validator('url.channel', default='https://t.me/permlug', is_type_of=str, startswith='http'),
-        Validator('url.chat', default='https://t.me/permlug_chat', is_type_of=str, startswith='http'),
-        Validator('marker.count', default='📊'),
-        Validator('marker.date', default='🗓'),
-        Validator('marker.lang', default='🌏'),
-        Validator('marker.keywords.title', default='🏷'),
-        Validator('marker.keywords.foss', default='🟢'),
-        Validator('marker.keywords.proprietary', default='🟡'),
-        Validator('marker.content_type', default='🔖'),
-        Validator('marker.content_category', default='🗂'),
-        Validator('marker.include', default='✅'),
-        Validator('marker.exclude', default='⛔️'),
-        Validator('marker.unknown', default='🤷🏻‍♂️'),
-        Validator('marker.is_main', default='❗️'),
-        Validator('marker.short', default='📃'),
-        Validator('marker.error', default='🤔'),
-        Validator('keyboard.columns', default=3, is_type_of=int),
-        Validator('cache.token.ttl', default=29, is_type_of=int),
-        Validator('cache.attrs.ttl', default=1, is_type_of=int),
-        Validator('cache.users.ttl', default=1, is_type_of=int),
-        Validator('cache.users.size', default=256, is_type_of=int),
-        Validator('features.is_main', default=False, is_type_of=bool),
-        Validator('features.types', default=False, is_type_of=bool),
-        Validator('features.categories', default=False, is_type_of=bool),
-    ],
-)
+VALIDATORS = [
+    Validator('bot.token', 'fngs.username', 'fngs.username', required=True),
+    Validator('bot.host', default='127.0.0.1'),
+    Validator('bot.port', default=2048, is_type_of=int),
+    Validator('bot.server', default='https://api.telegram.org', is_type_of=str, startswith='http'),
+    Validator('bot.limits.enabled', default=True, is_type_of=bool),
+    Validator('bot.limits.rate', default=30, is_type_of=int, gt=0),
+    Validator('bot.limits.chat.rate', default=1, is_type_of=int, gt=0),
+    Validator('bot.limits.chat.burst', default=3, is_type_of=int, gte=1),
+    Validator('bot.limits.retries', default=3, is_type_of=int, gte=0),
+    Validator('webhook.base', default='https://fn.permlug.org', is_type_of=str, startswith='http'),
+    Validator('webhook.path', default='/bot/', is_type_of=str, startswith='/'),
+    Validator('fngs.endpoint', default='https://fn.permlug.org/api/v1/', is_type_of=str, startswith='http'),
+    Validator('fngs.timeout', default=5, is_type_of=int),
+    Validator('fngs.retries', default=3, is_type_of=int),
+    Validator('log.level', default='info'),
+    Validator('localedir', default='locales'),
+    Validator('url.channel', default='https://t.me/permlug', is_type_of=str, startswith='http'),
+    Validator('url.chat', default='https://t.me/permlug_chat', is_type_of=str, startswith='http'),
+    Validator('marker.count', default='📊'),
+    Validator('marker.date', default='🗓'),
+    Validator('marker.lang', default='🌏'),
+    Validator('marker.keywords.title', default='🏷'),
+    Validator('marker.keywords.foss', default='🟢'),
+    Validator('marker.keywords.proprietary', default='🟡'),
+    Validator('marker.content_type', default='🔖'),
+    Validator('marker.content_category', default='🗂'),
+    Validator('marker.include', default='✅'),
+    Validator('marker.exclude', default='⛔️'),
+    Validator('marker.unknown', default='🤷🏻‍♂️'),
+    Validator('marker.is_main', default='❗️'),
+    Validator('marker.short', default='📃'),
+    Validator('marker.error', default='🤔'),
+    Validator('marker.batch', default='🗃'),
+    Validator('keyboard.columns', default=3, is_type_of=int),
+    Validator('cache.token.ttl', default=29, is_type_of=int),
+    Validator('cache.attrs.ttl', default=1, is_type_of=int),
+    Validator('cache.users.ttl', default=1, is_type_of=int),
+    Validator('cache.users.size', default=256, is_type_of=int),
+    Validator('cache.admins.ttl', default=3600, is_type_of=int),
+    Validator('cache.count.ttl', default=600, is_type_of=int),
+    Validator('cache.empty.ttl', default=60, is_type_of=int),
+    Validator('cache.cards.size', default=1024, is_type_of=int),
+    Validator('cache.cards.ttl', default=3600, is_type_of=int),
+    Validator('cache.sessions.size', default=1024, is_type_of=int),
+    Validator('cache.sessions.ttl', default=3600, is_type_of=int),
+    Validator('cache.persistent.enabled', default=True, is_type_of=bool),
+    Validator('cache.persistent.path', default='cache.db', is_type_of=str),
+    Validator('cache.persistent.size', default=64, is_type_of=int),
+    Validator('prefetch.enabled', default=True, is_type_of=bool),
+    Validator('prefetch.size', default=256, is_type_of=int),
+    Validator('prefetch.ttl', default=300, is_type_of=int),
+    Validator('pool.enabled', default=False, is_type_of=bool),
+    Validator('pool.size', default=100, is_type_of=int, gt=0),
+    Validator('pool.low', default=20, is_type_of=int, gte=0),
+    Validator('pool.lease', default=600, is_type_of=int, gt=0),
+    Validator('pool.copies', default=1, is_type_of=int, gte=1),
+    Validator('pool.ttl', default=3600, is_type_of=int, gt=0),
+    Validator('journal.enabled', default=True, is_type_of=bool),
+    Validator('journal.path', default='journal.db', is_type_of=str),
+    Validator('journal.batch', default=32, is_type_of=int),
+    Validator('journal.size', default=10000, is_type_of=int),
+    Validator('attempts.coalesce', default=False, is_type_of=bool),
+    Validator('attempts.timeout', default=300, is_type_of=int),
+    Validator('metrics.enabled', default=True, is_type_of=bool),
+    Validator('batch.size', default=10, is_type_of=int, gte=1),
+    Validator('dedup.enabled', default=True, is_type_of=bool),
+    Validator('dedup.size', default=4096, is_type_of=int, gt=0),
+    Validator('dedup.ttl', default=3600, is_type_of=int, gt=0),
+    Validator('dedup.window', default=2, is_type_of=int, gt=0),
+    Validator('ingest.enabled', default=True, is_type_of=bool),
+    Validator('ingest.size', default=1000, is_type_of=int, gt=0),
+    Validator('ingest.workers', default=64, is_type_of=int, gt=0),
+    Validator('ingest.policy', default='reject', is_type_of=str, is_in=['reject', 'drop']),
+    Validator('workers.count', default=0, is_type_of=int, gte=0),
+    Validator('workers.port', default=2049, is_type_of=int),
+    Validator('workers.index', default=-1, is_type_of=int),
+    Validator('features.is_main', default=False, is_type_of=bool),
+    Validator('features.types', default=False, is_type_of=bool),
+    Validator('features.categories', default=False, is_type_of=bool),
+    Validator('watch.interval', default=5, is_type_of=int, gte=0),
+]
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+def load() -> Dynaconf:
+    """Settings from files and environment; they are read and validated on first use"""
+    return Dynaconf(
+        envvar_prefix=PREFIX,
+        envvar=f'{PREFIX}_CONFIG',
+        env_switcher=f'{PREFIX}_ENV',
+        environments=True,
+        settings_files=['config.yml', '.secrets.yml'],
+        validators=VALIDATORS,
+    )
+
+
+config = load()
+
+
+class Snapshot:
+    """Immutable section of settings; fields are slots of a class made for the section"""
+
+    __slots__ = ()
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f'settings are read-only: {name}')
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f'settings are read-only: {name}')
+
+
+def _schema() -> Dict[str, Any]:
+    """Types of validated settings nested by section; settings without a type check are typed by their defaults"""
+    schema: Dict[str, Any] = dict(env=str)
+    for validator in VALIDATORS:
+        kind = validator.operations.get('is_type_of') or \
+            (type(validator.default) if isinstance(validator.default, (bool, int, str)) else object)
+        for name in validator.names:
+            *sections, field = name.split('.')
+            node = schema
+            for section in sections:
+                node = node.setdefault(section, {})
+            node[field] = kind
+    return schema
+
+
+def _section(name: str, schema: Dict[str, Any]) -> type:
+    """Class of a section of the snapshot; types of fields are kept in annotations"""
+    fields = {field: _section(name + field.title().replace('_', ''), kind) if isinstance(kind, dict) else kind
+              for field, kind in schema.items()}
+    return type(name, (Snapshot,), dict(__slots__=tuple(fields), __annotations__=fields, __module__=__name__))
+
+
+_Settings = _section('Settings', _schema())
+
+
+def freeze(settings: Dynaconf, cls: type = _Settings, prefix: str = '') -> Snapshot:
+    """Snapshot of validated settings; raises `ValidationError` if a value does not match the type of its field"""
+    snapshot = object.__new__(cls)
+    for field, kind in cls.__annotations__.items():
+        name = prefix + field
+        if issubclass(kind, Snapshot):
+            value = freeze(settings, kind, name + '.')
+        else:
+            value = settings.get(name)
+            if not isinstance(value, kind):
+                raise ValidationError(f'{name} must be {kind.__name__}, not {type(value).__name__}')
+        object.__setattr__(snapshot, field, value)
+    return snapshot
+
+
+_settings: Optional[Snapshot] = None
+
+
+def settings() -> Snapshot:
+    """The current snapshot of settings; like settings of Dynaconf, it is built on first use"""
+    global _settings
+    if _settings is None:
+        _settings = freeze(config)
+    return _settings
+
+
+def reload() -> bool:
+    """Read settings again and swap the snapshot; returns `False` and keeps the snapshot if settings are invalid"""
+    global _settings
+    try:
+        fresh = load()
+        fresh.validators.validate()
+        snapshot = freeze(fresh)
+    except Exception as e:
+        log.error('settings are not reloaded: %r', e)
+        return False
+    _settings = snapshot
+    log.info('settings reloaded')
+    return True
+
+
+class Watcher:
+    """Reload settings when their files are changed; files are checked every `interval` seconds, 0 disables it"""
+
+    def __init__(self, interval: float) -> None:
+        self._interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _stamp() -> List[Optional[int]]:
+        """Modification times of settings files, `None` for missing files"""
+        stamp = []
+        for name in ensure_a_list(config.settings_file_for_dynaconf):
+            try:
+                stamp.append(os.stat(find_file(name) or name).st_mtime_ns)
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    async def _run(self) -> None:
+        stamp = self._stamp()
+        while True:
+            await asyncio.sleep(self._interval)
+            current = self._stamp()
+            if current != stamp:
+                stamp = current
+                reload()
+
+    def start(self) -> None:
+        if self._interval and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
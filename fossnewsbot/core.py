@@ -18,12 +18,69 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from aiogram import Bot, Dispatcher
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.types import ParseMode
 
-from .config import config
+from . import cards, metrics
+from .config import Watcher, config
+from .attempts import AttemptBuilder
+from .dedup import DedupMiddleware
 from .fngs import FNGS
+from .ingest import Ingestion
+from .journal import Journal
+from .outbound import Outbound
+from .pool import WorkPool
+from .prefetch import Prefetcher
+from .scheduler import ScheduledBot, Scheduler
+from .workers import worker_path
 
 
-bot = Bot(token=config.bot.token, parse_mode=ParseMode.MARKDOWN_V2)
+class TelegramBot(ScheduledBot, metrics.MeteredBot if config.metrics.enabled else Bot):
+    """Bot with rate limits and metrics of Telegram Bot API requests"""
+
+
+bot = TelegramBot(token=config.bot.token, parse_mode=ParseMode.MARKDOWN_V2,
+                  server=TelegramAPIServer.from_base(config.bot.server))
+if config.bot.limits.enabled:
+    bot.scheduler = Scheduler(config.bot.limits.rate, config.bot.limits.chat.rate, config.bot.limits.chat.burst,
+                              config.bot.limits.retries)
 dispatcher = Dispatcher(bot)
+ingestion = Ingestion(dispatcher, config.ingest.size, config.ingest.workers, config.ingest.policy)
 fngs = FNGS(config.fngs.endpoint, config.fngs.username, config.fngs.password, config.fngs.timeout, config.fngs.retries)
+pool = WorkPool(fngs, config.pool.size, config.pool.low, config.pool.lease, config.pool.copies, config.pool.ttl,
+                config.pool.enabled)
+# The pool hands out news fetched in advance, so news are not prefetched for every user
+prefetcher = Prefetcher(fngs, config.prefetch.size, config.prefetch.ttl,
+                        config.prefetch.enabled and not config.pool.enabled)
+# Every worker process has its own journal
+journal_path = config.journal.path if config.workers.index < 0 else worker_path(config.journal.path, config.workers.index)
+# Local ids of attempts encode the journal, so they are unique across workers
+journal = Journal(fngs, journal_path, config.journal.enabled, config.journal.batch, config.journal.size,
+                  origin=config.workers.index + 1)
+attempts = AttemptBuilder(journal, config.attempts.coalesce, config.attempts.timeout)
+sessions = cards.Sessions(config.cache.sessions.size, config.cache.sessions.ttl)
+outbound = Outbound(bot, config.cache.sessions.size, config.cache.sessions.ttl)
+dedup = DedupMiddleware(config.dedup.size, config.dedup.ttl, config.dedup.window)
+watcher = Watcher(config.watch.interval)
+
+# Duplicates are dropped before other middlewares see them
+if config.dedup.enabled:
+    dispatcher.middleware.setup(dedup)
+
+if config.metrics.enabled:
+    dispatcher.middleware.setup(metrics.MetricsMiddleware())
+    dispatcher.register_errors_handler(metrics.on_error)
+    metrics.caches += [fngs.cache_info, prefetcher.cache_info, cards.cache_info, sessions.cache_info,
+                       outbound.cache_info, dedup.cache_info, pool.cache_info]
+    metrics.registry.gauge('fossnewsbot_journal_pending', 'Undelivered operations in attempts journal',
+                           collect=lambda: [((), len(journal))])
+    metrics.registry.gauge('fossnewsbot_attempt_drafts', 'Unfinished attempts in builder',
+                           collect=lambda: [((), len(attempts))])
+    if pool.enabled:
+        metrics.registry.gauge('fossnewsbot_pool_news', 'News in work pool by state', ['state'],
+                               collect=lambda: [((state,), n) for state, n in pool.stats().items()])
+    metrics.registry.gauge('fossnewsbot_ingest_queue', 'Updates waiting in ingestion queue',
+                           collect=lambda: [((), len(ingestion))])
+    if bot.scheduler is not None:
+        metrics.registry.gauge('fossnewsbot_telegram_queue', 'Telegram Bot API requests waiting for rate limits',
+                               collect=lambda: [((), bot.scheduler.waiting)])
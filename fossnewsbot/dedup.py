@@ -0,0 +1,86 @@
+"""Deduplication of updates of fossnewsbot
+
+Telegram delivers an update again if the webhook has not responded in time, and users tap a button twice
+before the message is changed. Such updates would be handled twice and send the same attempt to FNGS twice,
+so they are dropped before they reach handlers:
+- updates and callback queries with ids which have been seen recently;
+- callback queries with the same data from the same message of the same user within a short window.
+Duplicate callback queries are answered, so the progress indicator of the button stops.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from logging import getLogger
+from typing import Any, Dict
+
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import Update
+from aiogram.utils.exceptions import TelegramAPIError
+
+from cache import CacheInfoTTL, LRUCacheTTL
+from . import metrics
+
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+class DedupMiddleware(BaseMiddleware):
+    """Drop updates which have been handled recently
+
+    Ids are kept for `seconds`, taps for `window` seconds; keys of both are kept in a single LRU cache,
+    so the memory is bounded by `maxsize`.
+    """
+
+    def __init__(self, maxsize: int = 4096, seconds: float = 3600, window: float = 2) -> None:
+        super().__init__()
+        self._seen = LRUCacheTTL(maxsize=maxsize, seconds=seconds)
+        self._window = window
+
+    def cache_info(self) -> Dict[str, CacheInfoTTL]:
+        return dict(dedup=self._seen.info())
+
+    def _first(self, key: Any, ttl: float = None) -> bool:
+        """Remember the key; returns `False` if it has been seen"""
+        if self._seen.get(key) is not None:
+            return False
+        self._seen.set(key, True, ttl)
+        return True
+
+    def _drop(self, kind: str, update: Update) -> None:
+        metrics.duplicates.inc((kind,))
+        log.info('dropped duplicate %s: update %i', kind, update.update_id)
+        raise CancelHandler()
+
+    async def on_pre_process_update(self, update: Update, data: dict) -> None:
+        if not self._first(('update', update.update_id)):
+            self._drop('update', update)
+
+        callback = update.callback_query
+        if callback is None:
+            return
+        if not self._first(('callback', callback.id)):
+            self._drop('callback', update)
+        if callback.message and not self._first(('tap', callback.from_user.id, callback.message.message_id,
+                                                 callback.data), self._window):
+            try:
+                await callback.answer()
+            except TelegramAPIError as e:
+                log.warning('failed to answer callback query: %r', e)
+            self._drop('tap', update)
@@ -20,22 +20,26 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import base64
+import json
 from datetime import datetime
 from functools import wraps
 from json import JSONDecodeError
 from logging import getLogger
+from math import inf
 from random import randint
-from typing import Any, Callable, Optional, Union
-from urllib.parse import urlencode
+from time import monotonic, time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlencode, urljoin
+from uuid import uuid4
 
 from aiogram.types import User
-from requests import HTTPError, Response
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-from requests_toolbelt.sessions import BaseUrlSession
+from aiohttp import ClientConnectorError, ClientError, ClientSession, ClientTimeout, TCPConnector
 
-from cache import LRUCacheTTL, cached_property_with_ttl
-from .config import config
+from cache import TTL, CacheInfoTTL, LRUCacheTTL, PersistentCache, cached_property_with_ttl
+from . import metrics
+from .config import config, settings
 from .i18n import LANGUAGES
 
 
@@ -44,6 +48,27 @@
 DEFAULT_RETRIES = 3
 DEFAULT_GROUPS = ['users']
 
+# Retry policy (the same as `urllib3.util.retry.Retry` used with `requests` before)
+RETRY_BACKOFF_FACTOR = 1
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+RETRY_METHODS = frozenset(['OPTIONS', 'HEAD', 'GET'])
+RETRY_AFTER_STATUSES = frozenset([413, 429, 503])
+RETRY_BACKOFF_MAX = 120  # seconds
+# Requests with this header are retried regardless of method: the server handles requests with the same key once
+IDEMPOTENCY_KEY = 'Idempotency-Key'
+
+# Token refresh: a token is refreshed in background when a part of its lifetime is left
+TOKEN_REFRESH_MARGIN = 0.1
+TOKEN_REFRESH_MIN = 60  # seconds before expiration
+TOKEN_RETRY = 30  # seconds between background refresh attempts
+
+# HTTP connection pool
+POOL_SIZE = 100
+POOL_KEEPALIVE = 30  # seconds
+
+# Max number of single fetches filling up a batch of news while FNGS is not known to support `limit`
+BATCH_FILL = 10
+
 # News types and categories
 # TODO: remove test data
 TEST_TYPES = dict(
@@ -87,27 +112,68 @@
 log = getLogger(__name__.split('.')[-1])
 
 
-class TimeoutHTTPAdapter(HTTPAdapter):
-    """HTTP adapter with timeout and retries"""
+class Response:
+    """FNGS API response"""
 
-    def __init__(self, *args, **kwargs):
-        self.timeout = DEFAULT_TIMEOUT
-        if 'timeout' in kwargs:
-            self.timeout = kwargs['timeout']
-            del kwargs['timeout']
-        kwargs['max_retries'] = Retry(
-            backoff_factor=1,
-            total=kwargs.get('max_retries', DEFAULT_RETRIES),
-            status_forcelist=[429, 500, 502, 503, 504],
-            method_whitelist=['OPTIONS', 'HEAD', 'GET'],
-        )
-        super().__init__(*args, **kwargs)
+    __slots__ = ('status', 'reason', 'text')
+
+    def __init__(self, status: int, reason: str, text: str) -> None:
+        self.status = status
+        self.reason = reason
+        self.text = text
+
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+
+class HTTPError(ClientError):
+    """FNGS API error response"""
+
+    def __init__(self, method: str, url: str, response: Response) -> None:
+        super().__init__(f'{response.status} {response.reason} for {method} {url}')
+        self.response = response
+
+
+def _backoff(retry: int) -> float:
+    """Delay before retry number `retry` (starting with 1) like `urllib3` does"""
+    if retry <= 1:
+        return 0
+    return min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_FACTOR * (2 ** (retry - 1)))
+
+
+def _form(data: Optional[dict]) -> Optional[dict]:
+    """Encode form fields like `requests` does: skip `None` values and convert the rest to strings"""
+    if data is None:
+        return None
+    return {k: str(v) for k, v in data.items() if v is not None}
+
+
+def _retry_after(headers: Any) -> Optional[float]:
+    try:
+        return max(0.0, float(headers['Retry-After']))
+    except (KeyError, ValueError):
+        return None
+
+
+def _observe(labels: Tuple[str, str], started: float, status: str) -> None:
+    """Record latency and status (or error) of FNGS request"""
+    metrics.fngs_seconds.observe(monotonic() - started, labels)
+    metrics.fngs_responses.inc(labels + (status,))
+
+
+def _jwt_expires(token: Optional[str]) -> Optional[float]:
+    """Expiration time (`exp` claim) of JSON Web Token as Unix time; the signature is not verified"""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
 
-    def send(self, request, **kwargs):
-        timeout = kwargs.get('timeout')
-        if timeout is None:
-            kwargs['timeout'] = self.timeout
-        return super().send(request, **kwargs)
+
+# Persistent cache of users, token and attributes shared by bot processes
+store = PersistentCache(config.cache.persistent.path, config.cache.persistent.size * 2 ** 20) \
+    if config.cache.persistent.enabled else None
 
 
 class BotUser:
@@ -140,28 +206,33 @@ def is_editor(self) -> bool:
         return 'editors' in self.groups or self.is_admin()
 
 
+def attempt_data(news_id: int, state: str = None, dt: datetime = None) -> dict:
+    """Fields of a new categorization attempt"""
+    return dict(
+        dt=(dt or datetime.utcnow()).strftime('%Y-%m-%dT%H:%M:%S%z'),
+        digest_record=news_id,
+        estimated_state=state,
+    )
+
+
 class cached_user_method:
     """Users caching decorator"""
 
     def __init__(self, maxsize: int = 128, days: float = 0, seconds: float = 0, microseconds: float = 0,
-                 milliseconds: float = 0, minutes: float = 0, hours: float = 0, weeks: float = 0) -> None:
+                 milliseconds: float = 0, minutes: float = 0, hours: float = 0, weeks: float = 0,
+                 ttl: TTL = None, store: PersistentCache = None) -> None:
         self.cache = LRUCacheTTL(maxsize=maxsize, days=days, seconds=seconds, microseconds=microseconds,
-                                 milliseconds=milliseconds, minutes=minutes, hours=hours, weeks=weeks)
+                                 milliseconds=milliseconds, minutes=minutes, hours=hours, weeks=weeks,
+                                 store=store, name='users')
+        self.ttl = ttl
 
-    def __call__(self, fetch: Callable[[Any, User], BotUser]) -> Callable[[Any, User], BotUser]:
+    def __call__(self, fetch: Callable[[Any, User], Awaitable[BotUser]]) -> Callable[[Any, User], Awaitable[BotUser]]:
         @wraps(fetch)
-        def wrapper(obj: Any, user: User) -> BotUser:
-            try:
-                return self.cache[user.id]
-            except KeyError:
-                pass
-
-            value = fetch(obj, user)
-            self.cache[user.id] = value
-
-            return value
+        async def wrapper(obj: Any, user: User) -> BotUser:
+            return await self.cache.fetch(user.id, lambda: fetch(obj, user), self.ttl)
 
         wrapper.cache_info = self.cache.info
+        wrapper.cache_warm = self.cache.warm
 
         return wrapper
 
@@ -173,91 +244,268 @@ def __init__(self, endpoint: str, username: str, password: str,
                  timeout: int = DEFAULT_TIMEOUT, max_retries: int = DEFAULT_RETRIES):
         self._endpoint = endpoint
         self._auth = dict(username=username, password=password)
-        self._headers = {}
-        self._http = BaseUrlSession(endpoint)
-        self._adapter = TimeoutHTTPAdapter(timeout=timeout, max_retries=max_retries)
-        self._http.mount('https://', self._adapter)
-        self._http.mount('http://', self._adapter)
-
-    @cached_property_with_ttl(days=config.cache.token.ttl)
-    def token(self):
-        """Fetch FNGS token"""
-        t = self._http.post('auth/token/', data=self._auth).json()['access']
-        log.info('fetched token')
-        return t
+        self._access: Optional[str] = None
+        self._refresh: Optional[str] = None
+        self._expires = 0.0  # Unix time
+        self._refresh_at = inf  # Unix time
+        self._authenticating: Optional[asyncio.Task] = None
+        self._refresher: Optional[asyncio.Task] = None
+        self._timeout = ClientTimeout(total=timeout)
+        self._retries = max_retries
+        self._http: Optional[ClientSession] = None
+        self._counts = LRUCacheTTL(maxsize=config.cache.users.size, seconds=config.cache.count.ttl)
+        self._no_news = LRUCacheTTL(maxsize=config.cache.users.size, seconds=config.cache.empty.ttl)
+        self._batch_limit = False  # FNGS has returned several random news at once
 
     @property
-    def headers(self) -> dict:
-        self._headers['Authorization'] = f'Bearer {self.token}'
-        return self._headers
+    def http(self) -> ClientSession:
+        """HTTP session with a pool of keep-alive connections
+
+        The session is created on first use because it must be bound to the running event loop.
+        """
+        if self._http is None or self._http.closed:
+            self._http = ClientSession(
+                connector=TCPConnector(limit=POOL_SIZE, keepalive_timeout=POOL_KEEPALIVE),
+                timeout=self._timeout,
+                raise_for_status=False,
+            )
+        return self._http
+
+    async def close(self) -> None:
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+        if self._http is not None and not self._http.closed:
+            await self._http.close()
+        self._http = None
+        if store is not None:
+            store.close()
+
+    def cache_info(self) -> Dict[str, CacheInfoTTL]:
+        """Info of FNGS caches by name"""
+        return dict(
+            users=self.fetch_user.cache_info(),
+            counts=self._counts.info(),
+            no_news=self._no_news.info(),
+            types=FNGS.types.info(),
+            categories=FNGS.categories.info(),
+        )
+
+    def warm(self) -> None:
+        """Load cached users from the persistent cache"""
+        n = self.fetch_user.cache_warm()
+        if n:
+            log.info('loaded %i cached users', n)
+
+    def warm_attrs(self) -> int:
+        """Fetch types and categories of news, so the first keyboards do not wait for them; returns their number"""
+        return len(self.types) + len(self.categories)
+
+    async def _send(self, method: str, url: str, headers: dict = None, data: dict = None,
+                    timeout: float = None) -> Response:
+        """Send HTTP request with timeout and retries
+
+        Only requests of idempotent methods and requests with an idempotency key are retried
+        after errors which may happen when the request has been handled by the server.
+        """
+        method = method.upper()
+        retriable = method in RETRY_METHODS or IDEMPOTENCY_KEY in (headers or {})
+        labels = (method, metrics.endpoint(url))
+        url = urljoin(self._endpoint, url)
+        timeout = ClientTimeout(total=timeout) if timeout is not None else self._timeout
+        retry = 0
+
+        while True:
+            delay = None
+            started = monotonic()
+            try:
+                async with self.http.request(method, url, headers=headers, data=data, timeout=timeout) as r:
+                    response = Response(r.status, r.reason, await r.text())
+                    _observe(labels, started, str(r.status))
+                    if r.status not in RETRY_STATUSES or not retriable or retry >= self._retries:
+                        break
+                    if r.status in RETRY_AFTER_STATUSES:
+                        delay = _retry_after(r.headers)
+                    log.debug('retry %i: %s %s: %i %s', retry + 1, method, url, r.status, r.reason)
+            except ClientConnectorError as e:
+                _observe(labels, started, type(e).__name__)
+                # Connection was not established so the request can be safely sent again
+                if retry >= self._retries:
+                    raise e
+                log.debug('retry %i: %s %s: %s', retry + 1, method, url, e)
+            except (ClientError, asyncio.TimeoutError) as e:
+                _observe(labels, started, type(e).__name__)
+                if not retriable or retry >= self._retries:
+                    raise e
+                log.debug('retry %i: %s %s: %r', retry + 1, method, url, e)
+
+            retry += 1
+            await asyncio.sleep(_backoff(retry) if delay is None else delay)
+
+        if response.status >= 400:
+            raise HTTPError(method, url, response)
+
+        return response
+
+    @property
+    def token(self) -> Awaitable[str]:
+        """Access token; awaiting it authenticates if there is no valid token
+
+        Tokens with expiration time are kept in the persistent cache, so they survive restarts.
+        A token is refreshed in background before it expires.
+        """
+        return self._token()
+
+    async def _token(self) -> str:
+        if self._access is None and store is not None:
+            try:
+                self._set_tokens(*store.get('tokens', (self._endpoint, self._auth['username']))[0], persist=False)
+            except KeyError:
+                pass
+        if self._access is None or time() >= self._expires:
+            await self.authenticate()
+        return self._access
+
+    async def authenticate(self, stale: str = None) -> None:
+        """Get a new token; concurrent calls share the same request
+
+        If the `stale` token has been replaced already, a new token is not requested.
+        """
+        if stale is not None and stale != self._access:
+            return
+        if self._authenticating is None or self._authenticating.done():
+            self._authenticating = asyncio.ensure_future(self._authenticate())
+        # A cancelled caller must not cancel the request shared with other callers
+        await asyncio.shield(self._authenticating)
+
+    async def _authenticate(self) -> None:
+        """Refresh token with the refresh token if it is valid, otherwise fetch a new token with the password"""
+        if self._refresh is not None and time() < (_jwt_expires(self._refresh) or 0):
+            try:
+                data = (await self._send('post', 'auth/token/refresh/', data=dict(refresh=self._refresh))).json()
+                self._set_tokens(data['access'], data.get('refresh', self._refresh))
+                log.info('refreshed token')
+                return
+            except HTTPError as e:
+                log.warning('cannot refresh token: %i %s', e.response.status, e.response.reason)
+
+        data = (await self._send('post', 'auth/token/', data=_form(self._auth))).json()
+        self._set_tokens(data['access'], data.get('refresh'))
+        log.info('fetched token')
 
-    def _request(self, endpoint: str, method: str, query: dict = None, data: dict = None) -> Optional[Response]:
-        url, response = f'{endpoint}/', None
+    def _set_tokens(self, access: str, refresh: Optional[str], persist: bool = True) -> None:
+        now = time()
+        self._access = access
+        self._refresh = refresh
+        self._expires = _jwt_expires(access)
+        if self._expires is None:
+            # A token without expiration time is used for `cache.token.ttl` days
+            self._expires = now + config.cache.token.ttl * 86400 if config.cache.token.ttl else inf
+        lifetime = self._expires - now
+        self._refresh_at = self._expires - max(min(TOKEN_REFRESH_MIN, lifetime / 2), lifetime * TOKEN_REFRESH_MARGIN)
+
+        if persist and store is not None:
+            store.put('tokens', (self._endpoint, self._auth['username']), (access, refresh),
+                      lifetime if lifetime < inf else None)
+        if self._refresh_at < inf and (self._refresher is None or self._refresher.done()):
+            self._refresher = asyncio.ensure_future(self._refresh_token())
+
+    async def _refresh_token(self) -> None:
+        """Refresh token in background before it expires"""
+        while self._refresh_at < inf:
+            delay = self._refresh_at - time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                # The token may have been replaced while sleeping
+                continue
+
+            try:
+                await self.authenticate()
+            except (ClientError, asyncio.TimeoutError) as e:
+                log.warning('cannot refresh token in background: %r', e)
+                await asyncio.sleep(TOKEN_RETRY)
+            else:
+                if self._refresh_at <= time():
+                    log.warning('fetched token expires too soon')
+                    await asyncio.sleep(TOKEN_RETRY)
+
+    async def _request(self, endpoint: str, method: str, query: dict = None, data: dict = None,
+                       key: str = None) -> Optional[Response]:
+        """Send authenticated request; `key` is an idempotency key which makes the request safe to retry"""
+        url = f'{endpoint}/'
+        headers = {IDEMPOTENCY_KEY: key} if key else {}
 
         if query:
             url += '?' + urlencode(query, doseq=True)
         log.debug('request: %s %s data=%s', method.upper(), url, data)
 
-        if method == 'get':
-            response = self._http.get(url, headers=self.headers)
-        elif method == 'post':
-            response = self._http.post(url, headers=self.headers, data=data)
-        elif method == 'patch':
-            response = self._http.patch(url, headers=self.headers, data=data)
+        if method not in ('get', 'post', 'patch'):
+            return None
 
-        if response is not None:
-            response.raise_for_status()
+        token = await self.token
+        try:
+            return await self._send(method, url, headers=dict(headers, Authorization=f'Bearer {token}'),
+                                    data=_form(data))
+        except HTTPError as e:
+            if e.response.status != 401:
+                raise e
 
-        return response
+        # The token has been revoked or has expired earlier than expected: authenticate again and retry once
+        log.info('token was rejected: %s %s', method.upper(), url)
+        await self.authenticate(stale=token)
+        return await self._send(method, url, headers=dict(headers, Authorization=f'Bearer {self._access}'),
+                                data=_form(data))
 
-    @cached_property_with_ttl(days=config.cache.attrs.ttl)
+    @cached_property_with_ttl(days=config.cache.attrs.ttl, store=store)
     def types(self) -> dict:
         """Fetch types of news"""
         # TODO: replace test types data with a real request
-        # t = self.request('telegram-bot-types', 'get').json()
+        # t = (await self._request('telegram-bot-types', 'get')).json()
         t = TEST_TYPES
         log.info('fetched news types')
         return t
 
-    @cached_property_with_ttl(days=config.cache.attrs.ttl)
+    @cached_property_with_ttl(days=config.cache.attrs.ttl, store=store)
     def categories(self) -> dict:
         """Fetch categories of news"""
         # TODO: replace test categories data with a real request
-        # c = self.request('telegram-bot-categories', 'get').json()
+        # c = (await self._request('telegram-bot-categories', 'get')).json()
         c = TEST_CATEGORIES
         log.info('fetched news categories')
         return c
 
-    def register_user(self, user: User) -> Optional[int]:
+    async def register_user(self, user: User) -> Optional[int]:
         """Register Telegram user on FNGS server"""
         user = BotUser(user)
         try:
-            user.id = self._request('tbot/user', 'post',
-                                    data=dict(tid=user.tid, username=user.name)).json()['id']
+            user.id = (await self._request('tbot/user', 'post',
+                                           data=dict(tid=user.tid, username=user.name))).json()['id']
             log.info("%s was registered successfully", user)
             return user.id
         except HTTPError as e:
             r = e.response
-            if r.status_code == 400:  # TODO: make error code more specific
+            if r.status == 400:  # TODO: make error code more specific
                 log.warning("%s was already registered: %s", user, r.json()['tid'][0])
                 return None
             else:
                 raise e
 
-    @cached_user_method(days=config.cache.users.ttl, maxsize=config.cache.users.size)
-    def fetch_user(self, user: User) -> BotUser:
+    # Groups of editors and admins are changed more often, so they are cached for a shorter time
+    @cached_user_method(days=config.cache.users.ttl, maxsize=config.cache.users.size,
+                        ttl=lambda user: config.cache.admins.ttl if user.is_editor() else None, store=store)
+    async def fetch_user(self, user: User) -> BotUser:
         """Fetch FNGS id and info for Telegram user"""
 
-        def _fetch(tid: int) -> Any:
-            return self._request('tbot/user', 'get', query=dict(tid=tid)).json()
+        async def _fetch(tid: int) -> Any:
+            return (await self._request('tbot/user', 'get', query=dict(tid=tid))).json()
 
         try:
-            user_info = _fetch(user.id)
+            user_info = await _fetch(user.id)
         except HTTPError as e:
             r = e.response
-            if r.status_code == 404:
-                self.register_user(user)
-                user_info = _fetch(user.id)
+            if r.status == 404:
+                await self.register_user(user)
+                user_info = await _fetch(user.id)
             else:
                 raise e
 
@@ -270,63 +518,148 @@ def _fetch(tid: int) -> Any:
 
         return user
 
-    def update_user_news_lang(self, user: Union[User, BotUser], lang: str) -> None:
+    async def update_user_news_lang(self, user: Union[User, BotUser], lang: str) -> None:
         if isinstance(user, User):
-            user = self.fetch_user(user)
+            user = await self.fetch_user(user)
         raise NotImplementedError('implement `news_lang` field in `telegram-bot-user` model')
-        # self._request('tbot/user', 'patch', data=dict(id=user.id, news_lang=lang))
+        # await self._request('tbot/user', 'patch', data=dict(id=user.id, news_lang=lang))
 
-    def fetch_news(self, user: Union[User, BotUser]) -> dict:
+    async def fetch_news(self, user: Union[User, BotUser]) -> dict:
         """Fetch next random uncategorized news for this user"""
         if isinstance(user, User):
-            user = self.fetch_user(user)
+            user = await self.fetch_user(user)
+
+        if self._no_news.get(user.id):
+            log.debug("%s has no news (cached)", user)
+            return {}
 
         try:
-            news = self._request('tbot/digest-record/not-categorized/random', 'get',
-                                 query={'tbot-user-id': user.id, 'project': 'FOSS News'}).json()['results'][0]
+            news = (await self._request('tbot/digest-record/not-categorized/random', 'get',
+                                        query={'tbot-user-id': user.id, 'project': 'FOSS News'})).json()['results'][0]
             log.info("%s fetched news: id=%i \"%s\"", user, news['id'], news['title'])
         except (JSONDecodeError, IndexError):
             news = {}
+            self._no_news[user.id] = True
             log.warning("%s has no news", user)
 
+        # Reconcile the count of news with FNGS if it has drifted
+        count = self._counts.get(user.id)
+        if count is not None and bool(count) != bool(news):
+            log.info("%s news count drifted: %i", user, count)
+            self._counts.pop(user.id, None)
+
         return news
 
-    def fetch_news_count(self, user: Union[User, BotUser]) -> int:
+    async def _random_news(self, user: BotUser, limit: int = None) -> List[dict]:
+        query = {'tbot-user-id': user.id, 'project': 'FOSS News'}
+        if limit is not None:
+            query['limit'] = limit
+        try:
+            return (await self._request('tbot/digest-record/not-categorized/random', 'get', query=query)
+                    ).json()['results']
+        except JSONDecodeError:
+            return []
+
+    async def fetch_news_batch(self, user: Union[User, BotUser], limit: int) -> List[dict]:
+        """Fetch up to `limit` random uncategorized news for this user
+
+        News are requested at once with `limit` query parameter. FNGS may ignore it and return a single news,
+        so until it has returned several news, a short batch is filled up with `BATCH_FILL` single fetches at most.
+        """
+        if isinstance(user, User):
+            user = await self.fetch_user(user)
+
+        if self._no_news.get(user.id):
+            log.debug("%s has no news (cached)", user)
+            return []
+
+        news = (await self._random_news(user, limit))[:limit]
+        if len(news) > 1:
+            self._batch_limit = True
+        elif news and limit > 1 and not self._batch_limit:
+            ids = {news[0]['id']}
+            for result in await asyncio.gather(*[self._random_news(user) for _ in range(min(limit - 1, BATCH_FILL))],
+                                               return_exceptions=True):
+                if isinstance(result, Exception):
+                    log.warning("%s cannot fill up batch of news: %r", user, result)
+                    continue
+                for n in result[:1]:
+                    if n['id'] not in ids:
+                        ids.add(n['id'])
+                        news.append(n)
+        if news:
+            log.info("%s fetched batch of news: ids=%s", user, [n['id'] for n in news])
+        else:
+            self._no_news[user.id] = True
+            log.warning("%s has no news", user)
+
+        return news
+
+    async def fetch_news_count(self, user: Union[User, BotUser]) -> int:
         """Fetch count of uncategorized news for this user"""
         if isinstance(user, User):
-            user = self.fetch_user(user)
+            user = await self.fetch_user(user)
+
+        count = self._counts.get(user.id)
+        if count is not None:
+            log.debug("%s news count (cached): %i", user, count)
+            return count
 
-        count = self._request('tbot/digest-record/not-categorized/count', 'get',
-                              query={'tbot-user-id': user.id, 'project': 'FOSS News'}).json()['count']
+        count = (await self._request('tbot/digest-record/not-categorized/count', 'get',
+                                     query={'tbot-user-id': user.id, 'project': 'FOSS News'})).json()['count']
+        self._counts[user.id] = count
         log.info("%s fetched news count: %i", user, count)
 
         return count
 
-    def send_attempt(self, user: Union[User, BotUser], news_id: int, state: str = None) -> int:
-        """Send categorization attempt of this user"""
-        if isinstance(user, User):
-            user = self.fetch_user(user)
-
-        if config.env in ('production', 'development'):
-            r = self._request('tbot/digest-record/categorization-attempt', 'post', data=dict(
-                dt=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S%z'),
-                telegram_bot_user=user.id,
-                digest_record=news_id,
-                estimated_state=state,
-            ))
+    def count_attempt(self, user: BotUser) -> None:
+        """Decrement local count of uncategorized news of this user after an attempt"""
+        if user.id in self._counts:
+            self._counts[user.id] = max(0, self._counts.peek(user.id) - 1)
+
+    async def post_attempt(self, user_id: int, data: dict, key: str = None) -> int:
+        """Create categorization attempt of FNGS user; `key` is the idempotency key of the request"""
+        if settings().env in ('production', 'development'):
+            r = await self._request('tbot/digest-record/categorization-attempt', 'post',
+                                    data=dict(data, telegram_bot_user=user_id), key=key or uuid4().hex)
             attempt_id = r.json()['id']
         else:
             attempt_id = randint(0, 255)
+
+        return attempt_id
+
+    async def patch_attempt(self, attempt_id: int, data: dict, key: str = None) -> None:
+        """Update fields of categorization attempt; `key` is the idempotency key of the request"""
+        if settings().env in ('production', 'development'):
+            await self._request(f'tbot/digest-record/categorization-attempt/{attempt_id}', 'patch', data=data,
+                                key=key or uuid4().hex)
+
+    async def send_attempt(self, user: Union[User, BotUser], news_id: int, state: str = None) -> int:
+        """Send categorization attempt of this user"""
+        if isinstance(user, User):
+            user = await self.fetch_user(user)
+
+        attempt_id = await self.post_attempt(user.id, attempt_data(news_id, state))
+        self.count_attempt(user)
         log.info("%s sent attempt: id=%i news=%i state=%s", user, attempt_id, news_id, state)
 
         return attempt_id
 
-    def update_attempt(self, user: Union[User, BotUser], attempt_id: int, field: str, value: Union[bool, int, str]) -> None:
+    async def send_attempts(self, user: Union[User, BotUser], states: List[Tuple[int, str]]) -> List[int]:
+        """Send categorization attempts of this user for pairs of news id and state concurrently
+
+        FNGS has no bulk write of attempts, so this is a write per attempt.
+        """
+        if isinstance(user, User):
+            user = await self.fetch_user(user)
+
+        return list(await asyncio.gather(*[self.send_attempt(user, news_id, state) for news_id, state in states]))
+
+    async def update_attempt(self, user: Union[User, BotUser], attempt_id: int, field: str,
+                             value: Union[bool, int, str]) -> None:
         """Update categorization attempt of this user"""
         if isinstance(user, User):
-            user = self.fetch_user(user)
+            user = await self.fetch_user(user)
 
-        if config.env in ('production', 'development'):
-            self._request(f'tbot/digest-record/categorization-attempt/{attempt_id}', 'patch',
-                          data={field: value})
+        await self.patch_attempt(attempt_id, {field: value})
         log.info("%s updated attempt: id=%i %s=%s", user, attempt_id, field, value)
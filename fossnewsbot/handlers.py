@@ -17,20 +17,21 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import re
-from datetime import datetime
+import asyncio
+import signal
 from typing import Union
 
 from aiogram import Dispatcher, md
 from aiogram.types import CallbackQuery, Message, User
 from aiogram.utils.exceptions import CantParseEntities, InvalidQueryID
-from requests import RequestException
-
-from . import keyboards, log
-from .core import bot, dispatcher, fngs
-from .config import config
-from .fngs import BotUser
-from .i18n import set_language
+from aiohttp import ClientError
+
+from . import keyboards, log, metrics, startup
+from .cards import Batch, Card
+from .core import attempts, bot, dispatcher, fngs, ingestion, journal, outbound, pool, prefetcher, sessions, watcher
+from .config import config, reload, settings
+from .fngs import BotUser, HTTPError
+from .i18n import set_language, warm as warm_i18n
 from .keyboards import Command, Result
 
 
@@ -40,52 +41,13 @@
     Result.UNKNOWN: 'UNKNOWN',
 }
 
-
-def format_lang(lang: str) -> str:
-    langs = dict(ENGLISH=_('English'), RUSSIAN=_('Russian'))
-    return langs.get(lang, _('Unknown'))
-
-
-def format_news(news: dict) -> str:
-    dt = news['dt'] if news['dt'] else news['gather_dt']
-    dt = datetime.strptime(dt, '%Y-%m-%dT%H:%M:%S.%f%z').strftime('%x')
-    lang = format_lang(news['language'])
-    keywords_foss = ', '.join([md.bold(k['name']) for k in news['title_keywords'] if not k['is_generic'] and not k['proprietary']])
-    keywords_proprietary = ', '.join([md.bold(k['name']) for k in news['title_keywords'] if not k['is_generic'] and k['proprietary']])
-    lines = [
-        md.text(config.marker.count + ' ', md.italic(_('News left')), md.escape_md(': '), md.bold(news['count']), '\n', sep=''),
-        md.link(news['title'], news['url']),
-        md.text('\n', config.marker.date + ' ', md.italic(_('Date')), md.escape_md(': '), md.bold(dt), sep=''),
-        md.text(config.marker.lang + ' ', md.italic(_('Language')), md.escape_md(': '), md.bold(lang), sep=''),
-    ]
-    if keywords_foss:
-        lines.append(md.text(config.marker.keywords.foss + ' ', md.italic(_('FOSS')), md.escape_md(': '), keywords_foss, sep=''),)
-    if keywords_proprietary:
-        lines.append(md.text(config.marker.keywords.proprietary + ' ', md.italic(_('Proprietary')), md.escape_md(': '), keywords_proprietary, sep=''),)
-    if config.features.types:
-        content_type = news['content_type'] if news['content_type'] else _('Unknown')
-        lines.append(md.text(config.marker.content_type + ' ', md.italic(_('Type')), md.escape_md(':', content_type), sep=''))
-    if config.features.categories:
-        content_category = news['content_category'] if news['content_category'] else _('Unknown')
-        lines.append(md.text(config.marker.content_category + ' ', md.italic(_('Category')), md.escape_md(':', content_category), sep=''))
-    return md.text(*lines, sep='\n')
-
-
-def update_text_attr(text: str, marker: str, value: str = None) -> str:
-    def replace(m: re.Match) -> str:
-        return m[1] + md.strikethrough(m[2]) + ' ' + md.bold(md.escape_md(value))
-
-    def confirm(m: re.Match) -> str:
-        return m[1] + md.bold(m[2])
-
-    return re.sub(
-        pattern=fr'^({marker}\s+[^:]+:\s+)(.*)$',
-        repl=replace if value else confirm,
-        string=text, count=1, flags=re.MULTILINE)
-
-
-def append_result(icon: str, msg: str) -> str:
-    return '\n' + md.text(icon, md.bold(msg))
+# Warm-up phases at startup; they are run concurrently in background (see `startup`)
+WARM_UP = dict(
+    token=lambda: fngs.token,
+    catalogs=lambda: asyncio.get_event_loop().run_in_executor(None, warm_i18n),
+    attributes=fngs.warm_attrs,
+    users=fngs.warm,
+)
 
 
 async def msg_next(msg: Union[Message, CallbackQuery]) -> None:
@@ -95,22 +57,49 @@ async def msg_next(msg: Union[Message, CallbackQuery]) -> None:
         cb = msg
         msg = cb.message
 
-    news = fngs.fetch_news(user)
+    user = await fngs.fetch_user(user)
+    await attempts.flush(user)
+    if pool.enabled:
+        leased = await pool.lease(user)
+        # News in the pool are shared by users, so the count of the user is set in a copy
+        news = dict(leased[0], count=await fngs.fetch_news_count(user)) if leased else {}
+    else:
+        news = await prefetcher.pop(user)
+    if news is None:
+        news = await prefetcher.fetch(user)
     if news:
-        news['count'] = fngs.fetch_news_count(user)
-        text = format_news(news)
-        await bot.send_message(chat_id=msg.chat.id, text=text, reply_markup=keyboards.include(news['id']))
+        card = Card(news)
+        sent = await outbound.send(msg.chat.id, card.render(), keyboards.include(news['id']))
+        sessions.start(user.tid, card, sent)
+        prefetcher.schedule(user)
         if cb:
-            await msg.delete_reply_markup()
-            await cb.answer()
+            await asyncio.gather(outbound.answer(cb), outbound.edit(msg))
     else:
         text = _('No news yet.\nPlease, try again later.')
         if cb:
-            await cb.answer(text=text)
+            await outbound.answer(cb, text)
         else:
             await msg.answer(text=md.escape_md(text))
 
 
+async def msg_batch(message: Message, user: BotUser, size: int) -> None:
+    await attempts.flush(user)
+    if pool.enabled:
+        news = await pool.lease(user, size)
+    else:
+        news = prefetcher.fresh(user, await fngs.fetch_news_batch(user, size))
+    if news:
+        card = Batch(news)
+        sent = await outbound.send(message.chat.id, card.render(), batch_keyboard(card))
+        sessions.start(user.tid, card, sent)
+    else:
+        await message.answer(text=md.escape_md(_('No news yet.\nPlease, try again later.')))
+
+
+def batch_keyboard(card: Batch) -> keyboards.Keyboard:
+    return keyboards.batch(card.news[card.page]['id'], card.page, len(card.news), len(card.states))
+
+
 async def not_implemented(command: str, message: Message) -> None:
     # All `.` and `!` must be escaped by backslashes
     await message.answer(_(
@@ -124,28 +113,27 @@ async def not_implemented(command: str, message: Message) -> None:
     ), reply_markup=keyboards.next_news())
 
 
-async def error(callback: CallbackQuery) -> None:
+async def error(callback: CallbackQuery, answered: asyncio.Future = None) -> None:
     # All `.` and `!` must be escaped by backslashes
-    text = md.text(config.marker.error, _(
+    text = md.text(settings().marker.error, _(
         'Something went wrong\.\n'
         'Please, press {next} and try again\.'
     ).format(
         next=md.bold(_('Next'))
     ))
-    await callback.message.edit_text(text=text, disable_web_page_preview=True)
-    await callback.message.edit_reply_markup(keyboards.next_news())
-    await callback.answer()
+    await asyncio.gather(answered or outbound.answer(callback),
+                         outbound.edit(callback.message, text, keyboards.next_news(), disable_web_page_preview=True))
 
 
-def init_user(user: User) -> BotUser:
-    user = fngs.fetch_user(user)
+async def init_user(user: User) -> BotUser:
+    user = await fngs.fetch_user(user)
     set_language(user.lang)
     return user
 
 
 @dispatcher.message_handler(commands=['start'])
 async def start(message: Message) -> None:
-    init_user(message.from_user)
+    await init_user(message.from_user)
     await message.answer(md.escape_md(_(
         "Hi! I'm FOSS News Bot!\n"
         "I can send you news articles so you can help to categorize them for a new digest."
@@ -154,13 +142,22 @@ async def start(message: Message) -> None:
 
 @dispatcher.message_handler(commands=['next'])
 async def next_news(message: Message) -> None:
-    init_user(message.from_user)
+    await init_user(message.from_user)
     await msg_next(message)
 
 
+@dispatcher.message_handler(commands=['batch'])
+async def batch(message: Message) -> None:
+    user = await init_user(message.from_user)
+    args = message.get_args()
+    limit = settings().batch.size
+    size = int(args) if args.isdigit() else limit
+    await msg_batch(message, user, max(1, min(size, limit)))
+
+
 @dispatcher.message_handler(commands=['add'])
 async def add(message: Message) -> None:
-    init_user(message.from_user)
+    await init_user(message.from_user)
     await not_implemented('add', message)
 
 
@@ -171,13 +168,19 @@ async def test(message: Message) -> None:
 
 @dispatcher.callback_query_handler()
 async def handler(callback: CallbackQuery) -> None:
-    user = init_user(callback.from_user)
-    text = callback.message.md_text
+    user = await init_user(callback.from_user)
+    snapshot = settings()
+    marker = snapshot.marker
+    card = sessions.get(user.tid, callback.message)
     markup = callback.message.reply_markup
     no_preview = False
+    answered = None
 
     try:
         cmd, news_id, result, value = keyboards.from_callback_data(callback.data)
+        if cmd not in (Command.NEXT, Command.QUESTION):
+            # The answer has no text, so it is sent at once to stop the progress indicator of the client
+            answered = asyncio.ensure_future(outbound.answer(callback))
 
         if cmd == Command.NEXT:
             await msg_next(callback)
@@ -185,85 +188,149 @@ async def handler(callback: CallbackQuery) -> None:
 
         elif cmd == Command.QUESTION:
             log.info("%s pressed question button '%s' for news_id=%i", user, value, news_id)
-            await callback.answer(value)
+            await outbound.answer(callback, value)
             return
 
         elif cmd == Command.INCLUDE:
-            attempt_id = fngs.send_attempt(user, news_id, DIGEST_STATE.get(result, 'UNKNOWN'))
+            ask_is_main = result == Result.YES and (snapshot.features.is_main or user.is_editor())
+            attempt_id = await attempts.send_attempt(user, news_id, DIGEST_STATE.get(result, 'UNKNOWN'),
+                                                     final=not ask_is_main)
+            prefetcher.invalidate(user, news_id)
+            pool.complete(user, news_id)
             if result == Result.YES:
-                text += append_result(config.marker.include, _('In digest'))
-                if config.features.is_main or user.is_editor():
+                card.add_result(marker.include, _('In digest'))
+                if ask_is_main:
                     markup = keyboards.is_main(attempt_id)
                 else:
                     markup = keyboards.next_news()
             else:
                 if result == result.NO:
-                    text += append_result(config.marker.exclude, _('Not in digest'))
+                    card.add_result(marker.exclude, _('Not in digest'))
                 else:
-                    text += append_result(config.marker.unknown, _('Skip'))
+                    card.add_result(marker.unknown, _('Skip'))
                 markup = keyboards.next_news()
                 no_preview = True
 
         elif cmd == Command.IS_MAIN:
-            fngs.update_attempt(user, news_id, 'estimated_is_main', result == Result.YES)
+            ask_type = snapshot.features.types or user.is_editor()
+            await attempts.update_attempt(user, news_id, 'estimated_is_main', result == Result.YES, final=not ask_type)
+            prefetcher.schedule(user, count=False)
             if result == Result.YES:
-                text += append_result(config.marker.is_main, _('Main'))
+                card.add_result(marker.is_main, _('Main'))
             else:
-                text += append_result(config.marker.short, _('Short'))
-            if config.features.types or user.is_editor():
+                card.add_result(marker.short, _('Short'))
+            if ask_type:
                 markup = keyboards.types(news_id, fngs.types, user.lang)
             else:
                 markup = keyboards.next_news()
 
         elif cmd == Command.CONTENT_TYPE:
+            ask_category = snapshot.features.categories or user.is_editor()
             if result == Result.SET:
-                fngs.update_attempt(user, news_id, 'estimated_content_type', value)
-                text = update_text_attr(text, config.marker.content_type, fngs.types[value][user.lang])
+                await attempts.update_attempt(user, news_id, 'estimated_content_type', value, final=not ask_category)
+                card.set_attr(marker.content_type, fngs.types[value][user.lang])
             else:
-                text = update_text_attr(text, config.marker.content_type)
-            if config.features.categories or user.is_editor():
+                if not ask_category:
+                    await attempts.flush(user)
+                card.set_attr(marker.content_type)
+            if ask_category:
                 markup = keyboards.categories(news_id, fngs.categories, user.lang)
             else:
                 markup = keyboards.next_news()
 
         elif cmd == Command.CONTENT_CATEGORY:
             if result == Result.SET:
-                fngs.update_attempt(user, news_id, 'estimated_content_category', value)
-                text = update_text_attr(text, config.marker.content_category, fngs.categories[value][user.lang])
+                await attempts.update_attempt(user, news_id, 'estimated_content_category', value, final=True)
+                card.set_attr(marker.content_category, fngs.categories[value][user.lang])
             else:
-                text = update_text_attr(text, config.marker.content_category)
+                await attempts.flush(user)
+                card.set_attr(marker.content_category)
             markup = keyboards.next_news()
 
+        elif cmd == Command.BATCH:
+            if not isinstance(card, Batch) or card.submitted:
+                await error(callback, answered)
+                return
+            page = news_id
+            if result == Result.DONE:
+                states = [(card.news[p]['id'], state) for p, state in sorted(card.states.items())]
+                # The card is submitted before sending: attempts may be journaled partially when sending fails,
+                # so submitting the card again would send duplicate attempts
+                card.submitted = True
+                for news_id, _state in states:
+                    prefetcher.invalidate(user, news_id)
+                    pool.complete(user, news_id)
+                if states:
+                    await attempts.send_attempts(user, states)
+                markup = keyboards.next_news()
+                no_preview = True
+            elif result is None:
+                card.page = page
+                markup = batch_keyboard(card)
+            else:
+                card.decide(page, DIGEST_STATE.get(result, 'UNKNOWN'))
+                markup = batch_keyboard(card)
+
         else:
-            await error(callback)
+            await error(callback, answered)
             return
 
     except (CantParseEntities, InvalidQueryID) as e:
         log.error(e)  # TODO: implement a better handling of a such kind of exceptions
 
-    except RequestException as e:
+    except HTTPError as e:
         r = e.response
-        log.error('response: %i %s: %s', r.status_code, r.reason, r.text)
-        await error(callback)
+        log.error('response: %i %s: %s', r.status, r.reason, r.text)
+        await error(callback, answered)
+
+    except (ClientError, asyncio.TimeoutError) as e:
+        log.error('request: %r', e)
+        await error(callback, answered)
 
     except Exception as e:
         log.error(e)
-        await error(callback)
+        await error(callback, answered)
 
     else:
-        await callback.message.edit_text(text=text, disable_web_page_preview=no_preview)
-        await callback.message.edit_reply_markup(markup)
-        await callback.answer()
+        await outbound.edit(callback.message, card.render(), markup, disable_web_page_preview=no_preview)
+        sessions.save(user.tid, card)
 
-
-async def on_startup(dp: Dispatcher):
-    log.info('Starting up...')
-    await bot.set_webhook(config.webhook.base + config.webhook.path)
+    finally:
+        # The answer is awaited on every path, so its failure is not left unretrieved
+        if answered is not None:
+            await answered
 
 
-async def on_shutdown(dp: Dispatcher):
+async def on_startup(dp: Dispatcher, webhook: bool = True):
+    """Start the bot; in multi-process mode the webhook is set by the front process, not by workers"""
+    log.info('Starting up...')
+    if webhook:
+        await bot.set_webhook(config.webhook.base + config.webhook.path)
+    # Updates are handled before warm-up is over, so the bot is available even if FNGS is not
+    startup.start(WARM_UP)
+    journal.start()
+    if config.ingest.enabled:
+        ingestion.start()
+    if config.metrics.enabled:
+        metrics.lag_monitor.start()
+    # Settings read from the snapshot are reloaded on SIGHUP and when their files are changed
+    asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, reload)
+    watcher.start()
+
+
+async def on_shutdown(dp: Dispatcher, webhook: bool = True):
     log.info('Shutting down...')
-    await bot.delete_webhook()
+    if webhook:
+        await bot.delete_webhook()
+    startup.stop()
+    asyncio.get_event_loop().remove_signal_handler(signal.SIGHUP)
+    watcher.stop()
+    metrics.lag_monitor.stop()
+    if config.ingest.enabled:
+        await ingestion.stop()
+    await attempts.close()
+    await journal.stop()
+    await fngs.close()
     await dp.storage.close()
     await dp.storage.wait_closed()
     log.info('Bye!')
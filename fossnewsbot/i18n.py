@@ -17,25 +17,84 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import locale
-from gettext import translation  # Do not import gettext as `_` explicitly! See comment below.
+import builtins
+from contextvars import ContextVar
+from datetime import date
+from gettext import GNUTranslations, translation  # Do not import gettext as `_` explicitly! See comment below.
+from typing import Optional
+
+from babel import Locale
+from babel.dates import format_date as _format_date
+from babel.numbers import format_decimal
 
-from . import log
 from .config import config
 
 
 LANGUAGES = ['en', 'ru']
 TEXTDOMAIN = 'fossnewsbot'
 
-translations = {lang: translation(TEXTDOMAIN, localedir=config.localedir, languages=[lang]) for lang in LANGUAGES}
-# Function `_` is added to the global namespace by method `install`.
+
+class LazyTranslation:
+    """Translations of a language loaded on first use, so they are not loaded at import"""
+
+    def __init__(self, lang: str) -> None:
+        self.lang = lang
+        self._catalog: Optional[GNUTranslations] = None
+
+    def load(self) -> GNUTranslations:
+        if self._catalog is None:
+            self._catalog = translation(TEXTDOMAIN, localedir=config.localedir, languages=[self.lang])
+            # Following calls go to the catalog directly
+            self.gettext = self._catalog.gettext
+        return self._catalog
+
+    def gettext(self, message: str) -> str:
+        return self.load().gettext(message)
+
+
+translations = {lang: LazyTranslation(lang) for lang in LANGUAGES}
+locales = {lang: Locale.parse(lang) for lang in LANGUAGES}
+
+# Language of the current update. Every update is handled in its own task with a fresh copy of the context
+# (by aiogram or by ingestion workers), so updates of users with different languages do not interfere.
+_language: ContextVar[str] = ContextVar('language', default='en')
+_translation: ContextVar[LazyTranslation] = ContextVar('translation', default=translations['en'])
+
+
+def gettext(message: str) -> str:
+    return _translation.get().gettext(message)
+
+
+# Function `_` is added to the global namespace here like `GNUTranslations.install` does.
 # Do not define or import `_` as an alias for `gettext`!
-translations['en'].install()
+builtins.__dict__['_'] = gettext
 
 
 def set_language(lang: str) -> None:
-    try:
-        locale.setlocale(locale.LC_ALL, lang)
-    except locale.Error as e:
-        log.warning("Cannot set locale '%s': %s", lang, e)
-    translations.get(lang, translations['en']).install()
+    """Set language of the current context"""
+    if lang not in translations:
+        lang = 'en'
+    _language.set(lang)
+    _translation.set(translations[lang])
+
+
+def get_language() -> str:
+    return _language.get()
+
+
+def format_date(d: date) -> str:
+    """Format date in short form of the current language"""
+    return _format_date(d, format='short', locale=locales[_language.get()])
+
+
+def format_number(n: int) -> str:
+    """Format number with grouping of the current language"""
+    return format_decimal(n, locale=locales[_language.get()])
+
+
+def warm() -> None:
+    """Load translations and locale data of all languages, so the first updates do not wait for them"""
+    for lang in LANGUAGES:
+        translations[lang].load()
+        _format_date(date.today(), format='short', locale=locales[lang])
+        format_decimal(0, locale=locales[lang])
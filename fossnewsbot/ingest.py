@@ -0,0 +1,141 @@
+"""Webhook ingestion queue of fossnewsbot
+
+The webhook handler only validates an update and puts it in the queue, so Telegram gets the response at once
+and does not send the update again while FNGS is slow. Updates are handled by a fixed number of worker coroutines.
+Updates of a user are handled one by one in order of arrival; updates of different users are handled concurrently.
+
+When the queue is full, new updates are shed by the policy:
+- `reject`: the webhook responds with 503, so Telegram sends the update again later;
+- `drop`: the update is dropped, the webhook responds with 200.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from collections import deque
+from logging import getLogger
+from time import monotonic
+from typing import Any, Deque, Dict, List, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiogram.types import Update
+from aiohttp import web
+
+from . import metrics
+from .workers import user_id
+
+
+# Shedding policies
+REJECT = 'reject'
+DROP = 'drop'
+POLICIES = (REJECT, DROP)
+
+STOP_TIMEOUT = 10  # seconds to handle queued updates on shutdown
+
+# Key of the ingestion queue in the web application
+INGESTION_KEY = 'INGESTION'
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+class Ingestion:
+    """Bounded queue of updates with per-user order"""
+
+    def __init__(self, dispatcher: Dispatcher, maxsize: int = 1000, workers: int = 64, policy: str = REJECT) -> None:
+        self._dispatcher = dispatcher
+        self._maxsize = maxsize
+        self._workers = workers
+        self.policy = policy
+        # Queued updates with time of arrival by user; a user is in the ready queue while it has updates
+        # and none of them is being handled
+        self._pending: Dict[Any, Deque[Tuple[float, Update]]] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def put(self, key: Any, update: Update) -> bool:
+        """Queue update of the user; returns `False` if the queue is full"""
+        if self._size >= self._maxsize:
+            metrics.ingest_shed.inc((self.policy,))
+            return False
+        updates = self._pending.get(key)
+        if updates is None:
+            updates = self._pending[key] = deque()
+            self._ready.put_nowait(key)
+        updates.append((monotonic(), update))
+        self._size += 1
+        return True
+
+    async def _work(self) -> None:
+        Dispatcher.set_current(self._dispatcher)
+        Bot.set_current(self._dispatcher.bot)
+        while True:
+            key = await self._ready.get()
+            updates = self._pending[key]
+            queued, update = updates.popleft()
+            self._size -= 1
+            metrics.ingest_wait_seconds.observe(monotonic() - queued)
+            try:
+                # Every update is handled in its own task: the task gets a copy of the context of the worker,
+                # so context variables set by a handler (e.g. the language of the user) do not leak to next updates
+                await asyncio.ensure_future(self._dispatcher.updates_handler.notify(update))
+            except Exception as e:
+                log.error('update %i failed: %r', update.update_id, e)
+            finally:
+                if updates:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+
+    def start(self) -> None:
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self._workers)]
+
+    async def stop(self) -> None:
+        """Handle queued updates (for `STOP_TIMEOUT` seconds at most) and stop workers"""
+        started = monotonic()
+        while self._pending and monotonic() - started < STOP_TIMEOUT:
+            await asyncio.sleep(0.1)
+        if self._size:
+            log.warning('%i queued updates are dropped', self._size)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+class IngestRequestHandler(WebhookRequestHandler):
+    """Webhook handler putting updates in the ingestion queue"""
+
+    async def post(self) -> web.Response:
+        self.validate_ip()
+        self.get_dispatcher()
+        ingestion: Ingestion = self.request.app[INGESTION_KEY]
+        try:
+            data = await self.request.json()
+            update = Update(**data)
+        except (ValueError, TypeError):
+            return web.Response(status=400)
+
+        if not ingestion.put(user_id(data), update) and ingestion.policy == REJECT:
+            return web.Response(status=503)
+        return web.Response(text='ok')
@@ -0,0 +1,402 @@
+"""Write-behind journal of categorization attempts for fossnewsbot
+
+Attempts are written to a local SQLite database first, so a callback can be answered without waiting for FNGS.
+A background flusher delivers them to FNGS in order with retries and replays undelivered attempts after a restart.
+
+Attempts in the journal have local ids. The journal maps them to ids of attempts on FNGS server
+when their creation is delivered, so local ids can be used in keyboards instead of server ids.
+Every worker process has its own journal, and a user may be moved to another worker while keyboards
+still carry local ids of the previous one. So a local id encodes the origin (the journal which allocated it)
+besides the row of the attempt, and updates are accepted only for attempts allocated by this journal
+for the same user.
+
+Every operation has an idempotency key which is sent with all its deliveries, so an operation delivered again
+after a timeout is not applied twice by FNGS.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import sqlite3
+from collections import OrderedDict
+from logging import getLogger
+from typing import List, Optional, Tuple, Union
+from uuid import uuid4
+
+from aiohttp import ClientError
+
+from .fngs import FNGS, RETRY_BACKOFF_MAX, BotUser, HTTPError, attempt_data
+
+
+# Default values
+DEFAULT_BATCH = 32
+DEFAULT_MAXSIZE = 10000
+DEFAULT_TIMEOUT = 10  # seconds
+
+# Number of distinct journal origins: local id is row id * ORIGINS + origin
+ORIGINS = 1024
+
+# Client errors which are retried instead of dropping the operation
+TRANSIENT_STATUSES = frozenset([401, 408, 429])
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS attempts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    server_id INTEGER,
+    user_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS operations (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    attempt INTEGER NOT NULL REFERENCES attempts (id),
+    method TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    data TEXT NOT NULL,
+    tries INTEGER NOT NULL DEFAULT 0,
+    key TEXT
+);
+'''
+# Columns added to journals created by previous versions
+MIGRATIONS = {
+    ('operations', 'key'): 'ALTER TABLE operations ADD COLUMN key TEXT',
+    ('attempts', 'user_id'): 'ALTER TABLE attempts ADD COLUMN user_id INTEGER',
+}
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+class JournalFull(Exception):
+    """Journal has too many undelivered operations"""
+
+
+class Operation:
+    """Journaled FNGS request"""
+
+    __slots__ = ('seq', 'attempt', 'method', 'user_id', 'user', 'data', 'tries', 'key')
+
+    def __init__(self, seq: int, attempt: int, method: str, user_id: int, user: str, data: str, tries: int,
+                 key: Optional[str]) -> None:
+        self.seq = seq
+        self.attempt = attempt
+        self.method = method
+        self.user_id = user_id
+        self.user = user
+        self.data = json.loads(data)
+        self.tries = tries
+        self.key = key
+
+
+class Journal:
+    """Write-behind journal of categorization attempts"""
+
+    def __init__(self, fngs: FNGS, path: str, enabled: bool = True, batch: int = DEFAULT_BATCH,
+                 maxsize: int = DEFAULT_MAXSIZE, timeout: float = DEFAULT_TIMEOUT, origin: int = 0) -> None:
+        if not 0 <= origin < ORIGINS:
+            raise ValueError(f'journal origin must be in range 0..{ORIGINS - 1}: {origin}')
+        self._fngs = fngs
+        self._origin = origin
+        self._path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._batch = batch
+        self._maxsize = maxsize
+        self._timeout = timeout
+        self._pending = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._drained: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self.enabled = enabled
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self._path, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(SCHEMA)
+            columns = {}
+            for (table, column), sql in MIGRATIONS.items():
+                if table not in columns:
+                    columns[table] = {row[1] for row in self._db.execute(f'PRAGMA table_info({table})')}
+                if column not in columns[table]:
+                    self._db.execute(sql)
+            self._pending = self._db.execute('SELECT count(*) FROM operations').fetchone()[0]
+        return self._db
+
+    def __len__(self) -> int:
+        return self._pending
+
+    def start(self) -> None:
+        """Start background flusher; undelivered operations left from previous run are replayed"""
+        if not self.enabled or self._flusher is not None:
+            return
+
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self.db  # open the journal to count undelivered operations
+        if len(self):
+            log.info('journal has %i undelivered operations', len(self))
+        self._wakeup.set()
+        self._flusher = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        """Try to deliver the rest of operations and stop background flusher"""
+        if self._flusher is None:
+            return
+
+        if len(self):
+            try:
+                await asyncio.wait_for(self._wait_drained(0), self._timeout)
+            except asyncio.TimeoutError:
+                log.warning('journal has %i undelivered operations left', len(self))
+
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+        self.db.close()
+        self._db = None
+
+    async def _wait_drained(self, size: int) -> None:
+        while len(self) > size:
+            self._drained.clear()
+            await self._drained.wait()
+
+    def _local_id(self, attempt: int) -> int:
+        """Local id of attempt in row `attempt`"""
+        return attempt * ORIGINS + self._origin
+
+    def _attempt(self, user: BotUser, local_id: int) -> Optional[int]:
+        """Row of attempt with local id `local_id` if it has been allocated by this journal for this user"""
+        attempt, origin = divmod(local_id, ORIGINS)
+        if origin != self._origin:
+            return None
+        row = self.db.execute('SELECT user_id FROM attempts WHERE id = ?', (attempt,)).fetchone()
+        return attempt if row and row[0] == user.id else None
+
+    async def _append(self, attempt: Optional[int], method: str, user: BotUser, data: dict) -> int:
+        """Put operation to the journal and wake up the flusher
+
+        Returns local id of the attempt. If the journal is full, waits for the flusher to deliver operations.
+        """
+        return (await self._append_all(user, [(attempt, method, data)]))[0]
+
+    async def _append_all(self, user: BotUser, ops: List[Tuple[Optional[int], str, dict]]) -> List[int]:
+        """Put operations of the user to the journal in a single transaction and wake up the flusher
+
+        Operations are triples of attempt row (`None` for a new attempt), method and data.
+        Returns local ids of the attempts.
+        """
+        if len(self) + len(ops) > self._maxsize:
+            log.warning('journal is full: %i operations', len(self))
+            try:
+                await asyncio.wait_for(self._wait_drained(self._maxsize - len(ops)), self._timeout)
+            except asyncio.TimeoutError:
+                raise JournalFull(len(self))
+
+        ids = []
+        db = self.db
+        with db:
+            db.execute('BEGIN')
+            for attempt, method, data in ops:
+                if attempt is None:
+                    attempt = db.execute('INSERT INTO attempts (user_id) VALUES (?)', (user.id,)).lastrowid
+                db.execute('INSERT INTO operations (attempt, method, user_id, user, data, key) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', (attempt, method, user.id, str(user), json.dumps(data), uuid4().hex))
+                ids.append(self._local_id(attempt))
+        self._pending += len(ops)
+        self._wakeup.set()
+
+        return ids
+
+    def allocate(self, user: BotUser) -> int:
+        """Allocate local id for a new attempt of this user which will be journaled later"""
+        attempt = self.db.execute('INSERT INTO attempts (user_id) VALUES (?)', (user.id,)).lastrowid
+        self._fngs.count_attempt(user)
+        return self._local_id(attempt)
+
+    async def post_attempt(self, user: BotUser, attempt_id: int, data: dict) -> None:
+        """Journal creation of attempt with allocated local id `attempt_id` and fields `data`"""
+        attempt = self._attempt(user, attempt_id)
+        if attempt is None:
+            raise ValueError(f'attempt {attempt_id} is not allocated by this journal for {user}')
+        await self._append(attempt, 'post', user, data)
+        log.info("%s journaled attempt: local_id=%i data=%s", user, attempt_id, data)
+
+    async def send_attempt(self, user: BotUser, news_id: int, state: str = None) -> int:
+        """Journal categorization attempt of this user and return its local id"""
+        if not self.enabled:
+            return await self._fngs.send_attempt(user, news_id, state)
+
+        attempt_id = await self._append(None, 'post', user, attempt_data(news_id, state))
+        self._fngs.count_attempt(user)
+        log.info("%s journaled attempt: local_id=%i news=%i state=%s", user, attempt_id, news_id, state)
+
+        return attempt_id
+
+    async def send_attempts(self, user: BotUser, states: List[Tuple[int, str]]) -> List[int]:
+        """Journal categorization attempts of this user for pairs of news id and state at once
+
+        The attempts are journaled in a single transaction, but delivered to FNGS as a write per attempt.
+        Returns local ids of the attempts.
+        """
+        if not self.enabled:
+            return await self._fngs.send_attempts(user, states)
+
+        ids = await self._append_all(user, [(None, 'post', attempt_data(news_id, state)) for news_id, state in states])
+        for attempt_id, (news_id, state) in zip(ids, states):
+            self._fngs.count_attempt(user)
+            log.info("%s journaled attempt: local_id=%i news=%i state=%s", user, attempt_id, news_id, state)
+
+        return ids
+
+    async def update_attempt(self, user: BotUser, attempt_id: int, field: str, value: Union[bool, int, str]) -> None:
+        """Journal update of categorization attempt with local id `attempt_id`"""
+        if not self.enabled:
+            return await self._fngs.update_attempt(user, attempt_id, field, value)
+
+        # Keyboards of a user moved from another worker carry local ids of another journal
+        attempt = self._attempt(user, attempt_id)
+        if attempt is None:
+            log.warning("%s dropped update of foreign attempt: local_id=%i %s=%s", user, attempt_id, field, value)
+            return
+
+        await self._append(attempt, 'patch', user, {field: value})
+        log.info("%s journaled attempt update: local_id=%i %s=%s", user, attempt_id, field, value)
+
+    def _server_id(self, attempt: int, user_id: int) -> Optional[int]:
+        """FNGS server id of attempt in row `attempt` of the user if the attempt has been delivered"""
+        # Attempts journaled by previous versions have no user
+        row = self.db.execute('SELECT server_id FROM attempts WHERE id = ? AND coalesce(user_id, ?) = ?',
+                              (attempt, user_id, user_id)).fetchone()
+        return row[0] if row else None
+
+    def _operations(self) -> List[Operation]:
+        rows = self.db.execute('SELECT seq, attempt, method, user_id, user, data, tries, key FROM operations '
+                               'ORDER BY seq LIMIT ?', (self._batch,)).fetchall()
+        return [Operation(*row) for row in rows]
+
+    def _done(self, op: Operation, server_id: int = None) -> None:
+        db = self.db
+        with db:
+            db.execute('BEGIN')
+            if server_id is not None:
+                db.execute('UPDATE attempts SET server_id = ? WHERE id = ?', (server_id, op.attempt))
+            db.execute('DELETE FROM operations WHERE seq = ?', (op.seq,))
+        self._pending -= 1
+        self._drained.set()
+
+    def _drop(self, op: Operation) -> None:
+        """Drop operation and all operations of the same attempt if the attempt cannot be created"""
+        db = self.db
+        with db:
+            db.execute('BEGIN')
+            if op.method == 'post':
+                n = db.execute('DELETE FROM operations WHERE attempt = ?', (op.attempt,)).rowcount
+            else:
+                n = db.execute('DELETE FROM operations WHERE seq = ?', (op.seq,)).rowcount
+        self._pending -= n
+        self._drained.set()
+
+    async def _deliver(self, ops: List[Operation]) -> Tuple[int, bool]:
+        """Deliver operations of a single attempt in order
+
+        Returns number of delivered operations and failure flag.
+        Delivery stops on the first failure to keep the order.
+        """
+        delivered = 0
+        for op in ops:
+            try:
+                if op.method == 'post':
+                    server_id = await self._fngs.post_attempt(op.user_id, op.data, op.key)
+                    self._done(op, server_id)
+                    log.info("%s sent attempt: id=%i local_id=%i data=%s",
+                             op.user, server_id, self._local_id(op.attempt), op.data)
+                else:
+                    server_id = self._server_id(op.attempt, op.user_id)
+                    if server_id is None:
+                        log.error("%s dropped update of undelivered attempt: local_id=%i data=%s",
+                                  op.user, self._local_id(op.attempt), op.data)
+                        self._drop(op)
+                        continue
+                    await self._fngs.patch_attempt(server_id, op.data, op.key)
+                    self._done(op)
+                    log.info("%s updated attempt: id=%i local_id=%i data=%s",
+                             op.user, server_id, self._local_id(op.attempt), op.data)
+                delivered += 1
+
+            except HTTPError as e:
+                r = e.response
+                if 400 <= r.status < 500 and r.status not in TRANSIENT_STATUSES:
+                    log.error("%s dropped rejected attempt %s: local_id=%i: %i %s: %s",
+                              op.user, op.method, self._local_id(op.attempt), r.status, r.reason, r.text)
+                    self._drop(op)
+                    if op.method == 'post':
+                        break
+                    continue
+                self._retry(op, e)
+                return delivered, True
+
+            except (ClientError, asyncio.TimeoutError) as e:
+                self._retry(op, e)
+                return delivered, True
+
+        return delivered, False
+
+    def _retry(self, op: Operation, e: Exception) -> None:
+        op.tries += 1
+        self.db.execute('UPDATE operations SET tries = ? WHERE seq = ?', (op.tries, op.seq))
+        log.warning("%s attempt %s failed (try %i): local_id=%i: %r",
+                    op.user, op.method, op.tries, self._local_id(op.attempt), e)
+
+    async def flush(self) -> Tuple[int, bool]:
+        """Deliver a batch of operations
+
+        Operations of different attempts are delivered concurrently, operations of the same attempt are in order.
+        Returns number of delivered operations and failure flag.
+        """
+        groups = OrderedDict()
+        for op in self._operations():
+            groups.setdefault(op.attempt, []).append(op)
+
+        results = await asyncio.gather(*[self._deliver(ops) for ops in groups.values()])
+
+        return sum(r[0] for r in results), any(r[1] for r in results)
+
+    async def _run(self) -> None:
+        retry = 0
+        while True:
+            self._wakeup.clear()
+            try:
+                delivered, failed = await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception('journal flush failed: %r', e)
+                delivered, failed = 0, True
+
+            if failed:
+                retry += 1
+                await asyncio.sleep(min(RETRY_BACKOFF_MAX, 2 ** retry))
+            elif delivered:
+                retry = 0
+            else:
+                await self._wakeup.wait()
@@ -17,12 +17,14 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import json
 from enum import Enum, unique
-from typing import Optional, Tuple
+from typing import Any, Callable, Optional, Tuple
 
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
-from .config import config
+from .config import settings
+from .i18n import get_language
 
 
 @unique
@@ -33,6 +35,7 @@ class Command(Enum):
     IS_MAIN = 'is_main'
     CONTENT_TYPE = 'content_type'
     CONTENT_CATEGORY = 'content_category'
+    BATCH = 'batch'
 
 
 @unique
@@ -42,10 +45,15 @@ class Result(Enum):
     NO = 'no'
     KEEP = 'keep'
     SET = '='
+    DONE = 'done'
 
 
 _DATA_SEP = ' '
 
+# News id placeholder in keyboard templates and its JSON representation
+_PLACEHOLDER = '\0'
+_PLACEHOLDER_JSON = json.dumps(_PLACEHOLDER)[1:-1]
+
 
 def to_callback_data(cmd: Command, news_id: int = None, result: Result = None, value: str = None) -> str:
     data = cmd.value
@@ -98,7 +106,53 @@ def _from_dict(question: str, cmd: Command, news_id: int, values: dict, lang: st
     return kbd
 
 
-def next_news() -> InlineKeyboardMarkup:
+class Keyboard(str):
+    """Inline keyboard markup serialized to JSON
+
+    It is passed to Bot API methods as is, so it is not serialized again for every request.
+    """
+
+    __slots__ = ()
+
+
+class KeyboardTemplate:
+    """Serialized keyboard with placeholders for news id"""
+
+    __slots__ = ('_parts',)
+
+    def __init__(self, kbd: InlineKeyboardMarkup) -> None:
+        self._parts = json.dumps(kbd.to_python(), ensure_ascii=False).split(_PLACEHOLDER_JSON)
+
+    def __call__(self, news_id: int = None) -> Keyboard:
+        return Keyboard(str(news_id).join(self._parts))
+
+
+# Keyboard templates by kind, interface language, language of values and number of columns.
+# Every template holds a reference to values it is built from to rebuild it when the values are changed.
+_templates = {}
+
+
+def _template(kind: str, build: Callable[[Any], InlineKeyboardMarkup], values: Any = None,
+              lang: str = None, columns: int = None) -> KeyboardTemplate:
+    key = kind, get_language(), lang, columns
+    try:
+        ref, tpl = _templates[key]
+        if ref is values:
+            return tpl
+    except KeyError:
+        pass
+
+    tpl = KeyboardTemplate(build(_PLACEHOLDER))
+    _templates[key] = values, tpl
+
+    return tpl
+
+
+def next_news() -> Keyboard:
+    return _template('next', lambda _id: _next_news())()
+
+
+def _next_news() -> InlineKeyboardMarkup:
     kbd = InlineKeyboardMarkup()
     btn_next = InlineKeyboardButton(text=_('Next'), callback_data='next')
     kbd.add(btn_next)
@@ -106,17 +160,46 @@ def next_news() -> InlineKeyboardMarkup:
     return kbd
 
 
-def include(news_id: int) -> InlineKeyboardMarkup:
-    return _ternary(_('Include in digest?'), Command.INCLUDE, news_id)
+def include(news_id: int) -> Keyboard:
+    return _template('include', lambda _id: _ternary(_('Include in digest?'), Command.INCLUDE, _id))(news_id)
+
 
+def is_main(news_id: int) -> Keyboard:
+    return _template('is_main', lambda _id: _ternary(_('Include in main news?'), Command.IS_MAIN, _id))(news_id)
 
-def is_main(news_id: int) -> InlineKeyboardMarkup:
-    return _ternary(_('Include in main news?'), Command.IS_MAIN, news_id)
 
+def types(news_id: int, types_: dict, lang: str = 'en') -> Keyboard:
+    def build(_id: str) -> InlineKeyboardMarkup:
+        return _from_dict(_('Choose type'), Command.CONTENT_TYPE, _id, types_, lang, columns)
 
-def types(news_id: int, types_: dict, lang: str = 'en') -> InlineKeyboardMarkup:
-    return _from_dict(_('Choose type'), Command.CONTENT_TYPE, news_id, types_, lang, config.keyboard.columns)
+    columns = settings().keyboard.columns
+    return _template('types', build, types_, lang, columns)(news_id)
 
 
-def categories(news_id: int, categories_: dict, lang: str = 'en') -> InlineKeyboardMarkup:
-    return _from_dict(_('Choose category'), Command.CONTENT_CATEGORY, news_id, categories_, lang, config.keyboard.columns)
+def categories(news_id: int, categories_: dict, lang: str = 'en') -> Keyboard:
+    def build(_id: str) -> InlineKeyboardMarkup:
+        return _from_dict(_('Choose category'), Command.CONTENT_CATEGORY, _id, categories_, lang, columns)
+
+    columns = settings().keyboard.columns
+    return _template('categories', build, categories_, lang, columns)(news_id)
+
+
+def batch(news_id: int, page: int, pages: int, decided: int) -> Keyboard:
+    """Keyboard of a batch card: digest state of the news on the page, pages and submission
+
+    The news id field of callback data holds the page.
+    """
+    kbd = InlineKeyboardMarkup()
+    kbd.row(btn_question(_('Include in digest?'), news_id))
+    kbd.row(
+        InlineKeyboardButton(text=_('Yes'), callback_data=to_callback_data(Command.BATCH, page, Result.YES)),
+        InlineKeyboardButton(text=_('No'), callback_data=to_callback_data(Command.BATCH, page, Result.NO)),
+        InlineKeyboardButton(text=_('Skip'), callback_data=to_callback_data(Command.BATCH, page, Result.UNKNOWN)))
+    if pages > 1:
+        kbd.row(
+            InlineKeyboardButton(text='◀', callback_data=to_callback_data(Command.BATCH, (page - 1) % pages)),
+            InlineKeyboardButton(text='▶', callback_data=to_callback_data(Command.BATCH, (page + 1) % pages)))
+    kbd.row(InlineKeyboardButton(text=_('Submit ({decided}/{pages})').format(decided=decided, pages=pages),
+                                 callback_data=to_callback_data(Command.BATCH, page, Result.DONE)))
+
+    return Keyboard(json.dumps(kbd.to_python(), ensure_ascii=False))
@@ -0,0 +1,372 @@
+"""Metrics of fossnewsbot in Prometheus text format
+
+Metrics are recorded in memory with a few dict lookups and additions, so recording is cheap enough
+to be always on. They are rendered on scrape (`GET /metrics`); values of caches and in-flight updates
+are collected at that time.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import re
+from bisect import bisect_left
+from logging import getLogger
+from time import monotonic
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, Update
+from aiohttp import web
+
+from cache import CacheInfoTTL
+from .keyboards import Command
+
+
+# Default values
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1, 2.5, 5, 7.5, 10)  # seconds
+LAG_INTERVAL = 1  # seconds between event loop lag measurements
+LAG_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)  # seconds
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRICS_PATH = '/metrics'
+
+Labels = Tuple[str, ...]
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == int(value) and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Metric family with labels; values of labeled series are keyed by tuples of label values"""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values: Dict[Labels, float] = {}
+
+    def samples(self) -> Iterable[Tuple[str, Labels, str, float]]:
+        """Samples of the metric: name suffix, label values, extra label and value"""
+        for labels, value in self._values.items():
+            yield '', labels, '', value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.type}']
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labels, labels, extra)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing counter"""
+
+    type = 'counter'
+
+    def inc(self, labels: Labels = (), amount: float = 1) -> None:
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Value which can go up and down; with `collect` function, values are collected on scrape"""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (),
+                 collect: Callable[[], Iterable[Tuple[Labels, float]]] = None) -> None:
+        super().__init__(name, doc, labels)
+        self._collect = collect
+
+    def set(self, value: float, labels: Labels = ()) -> None:
+        self._values[labels] = value
+
+    def inc(self, labels: Labels = (), amount: float = 1) -> None:
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+    def dec(self, labels: Labels = (), amount: float = 1) -> None:
+        self.inc(labels, -amount)
+
+    def samples(self) -> Iterable[Tuple[str, Labels, str, float]]:
+        if self._collect is None:
+            yield from super().samples()
+            return
+        for labels, value in self._collect():
+            yield '', labels, '', value
+
+
+class CounterFunc(Gauge):
+    """Counter with values collected on scrape"""
+
+    type = 'counter'
+
+
+class Histogram(Metric):
+    """Histogram of observed values
+
+    Every series is a list of bucket counts (not cumulative) with sum of values appended.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self) -> Iterable[Tuple[str, Labels, str, float]]:
+        for labels, series in list(self._series.items()):
+            total = 0
+            for bound, n in zip(self.buckets, series):
+                total += n
+                yield '_bucket', labels, f'le="{_format_value(bound)}"', total
+            total += series[-2]
+            yield '_bucket', labels, 'le="+Inf"', total
+            yield '_sum', labels, '', series[-1]
+            yield '_count', labels, '', total
+
+
+class Registry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+
+    def add(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, doc: str, labels: Sequence[str] = ()) -> Counter:
+        return self.add(Counter(name, doc, labels))
+
+    def gauge(self, name: str, doc: str, labels: Sequence[str] = (),
+              collect: Callable[[], Iterable[Tuple[Labels, float]]] = None) -> Gauge:
+        return self.add(Gauge(name, doc, labels, collect))
+
+    def histogram(self, name: str, doc: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, doc, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                lines += metric.render()
+            except Exception as e:
+                log.exception('cannot render metric %s: %r', metric.name, e)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# Updates and handlers
+updates_in_flight = registry.gauge('fossnewsbot_updates_in_flight', 'Updates being handled')
+update_seconds = registry.histogram('fossnewsbot_update_seconds', 'Update handling latency', ['type'])
+handler_seconds = registry.histogram('fossnewsbot_handler_seconds', 'Handler latency by handler and callback command',
+                                     ['handler', 'command'])
+update_errors = registry.counter('fossnewsbot_update_errors_total', 'Unhandled errors by update type and error',
+                                 ['type', 'error'])
+
+# External APIs
+fngs_seconds = registry.histogram('fossnewsbot_fngs_request_seconds', 'FNGS API request latency',
+                                  ['method', 'endpoint'])
+fngs_responses = registry.counter('fossnewsbot_fngs_responses_total',
+                                  'FNGS API responses by status (or error for failed requests)',
+                                  ['method', 'endpoint', 'status'])
+telegram_seconds = registry.histogram('fossnewsbot_telegram_request_seconds', 'Telegram Bot API request latency',
+                                      ['method', 'result'])
+telegram_skipped = registry.counter('fossnewsbot_telegram_skipped_total',
+                                   'Telegram Bot API calls not sent as they would not change anything', ['call'])
+telegram_wait_seconds = registry.histogram('fossnewsbot_telegram_wait_seconds',
+                                           'Wait of Telegram Bot API requests for rate limits', ['method'])
+telegram_retries = registry.counter('fossnewsbot_telegram_retries_total',
+                                    'Telegram Bot API requests retried after flood control errors', ['method'])
+
+# Work pool
+pool_leases = registry.counter('fossnewsbot_pool_leases_total',
+                               'Leases of news by source: the pool, a refill for the user or no news', ['result'])
+pool_expired = registry.counter('fossnewsbot_pool_expired_total', 'Leases of news expired before categorization')
+
+# Deduplication
+duplicates = registry.counter('fossnewsbot_duplicates_total', 'Duplicate updates dropped by kind', ['kind'])
+
+# Ingestion queue
+ingest_wait_seconds = registry.histogram('fossnewsbot_ingest_wait_seconds', 'Wait of updates in ingestion queue')
+ingest_shed = registry.counter('fossnewsbot_ingest_shed_total', 'Updates shed as ingestion queue is full',
+                               ['policy'])
+
+# Event loop
+loop_lag = registry.histogram('fossnewsbot_event_loop_lag_seconds', 'Delay of scheduled callbacks of event loop',
+                              buckets=LAG_BUCKETS)
+
+# Caches: functions returning info of caches by name
+caches: List[Callable[[], Dict[str, CacheInfoTTL]]] = []
+
+
+def _cache_infos() -> Iterable[Tuple[str, CacheInfoTTL]]:
+    for provider in caches:
+        yield from provider().items()
+
+
+def _cache_metric(field: str) -> Callable[[], Iterable[Tuple[Labels, float]]]:
+    return lambda: [((name, ), getattr(info, field)) for name, info in _cache_infos()]
+
+
+for _field, _metric, _doc in [('hits', 'hits_total', 'Cache hits'), ('misses', 'misses_total', 'Cache misses'),
+                              ('coalesced', 'coalesced_total', 'Cache misses coalesced with concurrent fetches')]:
+    registry.add(CounterFunc(f'fossnewsbot_cache_{_metric}', _doc, ['cache'], _cache_metric(_field)))
+registry.gauge('fossnewsbot_cache_size', 'Number of cache entries', ['cache'], _cache_metric('currsize'))
+registry.gauge('fossnewsbot_cache_maxsize', 'Max number of cache entries', ['cache'], _cache_metric('maxsize'))
+
+# Ids in FNGS API paths are replaced with a placeholder to keep the number of series bounded
+_ID = re.compile(r'/\d+(?=/|$)')
+
+
+def endpoint(url: str) -> str:
+    """Label of FNGS API endpoint: URL path without query and ids"""
+    return _ID.sub('/{id}', url.split('?', 1)[0])
+
+
+# Only known commands are used as label values
+_COMMANDS = frozenset(cmd.value for cmd in Command)
+
+
+def _command(callback: CallbackQuery) -> str:
+    cmd = (callback.data or '').split(' ', 1)[0]
+    return cmd if cmd in _COMMANDS else 'unknown'
+
+
+def _update_type(update: Update) -> str:
+    return next((k for k in update.values if k != 'update_id'), 'unknown')
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Record latency of updates and handlers"""
+
+    async def on_pre_process_update(self, update: Update, data: dict) -> None:
+        updates_in_flight.inc()
+        data['metrics_started'] = monotonic()
+
+    async def on_post_process_update(self, update: Update, results: list, data: dict) -> None:
+        updates_in_flight.dec()
+        started = data.get('metrics_started')
+        if started is not None:
+            update_seconds.observe(monotonic() - started, (_update_type(update),))
+
+    @staticmethod
+    def _start(data: dict, command: str) -> None:
+        handler = current_handler.get(None)
+        data['metrics_handler'] = (getattr(handler, '__name__', 'unknown'), command, monotonic())
+
+    @staticmethod
+    def _stop(data: dict) -> None:
+        started = data.pop('metrics_handler', None)
+        if started is not None:
+            handler_seconds.observe(monotonic() - started[2], started[:2])
+
+    async def on_process_message(self, message: Message, data: dict) -> None:
+        self._start(data, '')
+
+    async def on_post_process_message(self, message: Message, results: list, data: dict) -> None:
+        self._stop(data)
+
+    async def on_process_callback_query(self, callback: CallbackQuery, data: dict) -> None:
+        self._start(data, _command(callback))
+
+    async def on_post_process_callback_query(self, callback: CallbackQuery, results: list, data: dict) -> None:
+        self._stop(data)
+
+
+async def on_error(update: Update, exception: Exception) -> None:
+    """Errors handler counting errors; the error is not suppressed"""
+    update_errors.inc((_update_type(update), type(exception).__name__))
+
+
+class MeteredBot(Bot):
+    """Bot recording latency of Telegram Bot API requests"""
+
+    async def request(self, method: str, data: Optional[Dict] = None, files: Optional[Dict] = None, **kwargs):
+        started = monotonic()
+        result = 'ok'
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            result = type(e).__name__
+            raise
+        finally:
+            telegram_seconds.observe(monotonic() - started, (method, result))
+
+
+class LagMonitor:
+    """Measure event loop lag: delay of a callback scheduled every `interval` seconds"""
+
+    def __init__(self, interval: float = LAG_INTERVAL) -> None:
+        self._interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self._interval
+            await asyncio.sleep(self._interval)
+            loop_lag.observe(max(0.0, loop.time() - expected))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+lag_monitor = LagMonitor()
+
+
+async def handler(request: web.Request) -> web.Response:
+    """`GET /metrics` handler"""
+    return web.Response(body=registry.render().encode(), headers={'Content-Type': CONTENT_TYPE})
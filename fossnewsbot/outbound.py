@@ -0,0 +1,89 @@
+"""Outbound Telegram calls of fossnewsbot
+
+Text and keyboard of a message are changed with a single `editMessageText` call, edits which do not change
+the message are not sent at all, and callback queries are answered without waiting for other calls.
+To detect such edits, the content of the last message sent by the bot is kept for every chat and updated
+by its edits.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from logging import getLogger
+from typing import Dict, Optional, Union
+
+from aiogram import Bot
+from aiogram.types import CallbackQuery, InlineKeyboardMarkup, Message
+from aiogram.utils.exceptions import MessageNotModified, TelegramAPIError
+
+from cache import CacheInfoTTL, LRUCacheTTL
+from . import metrics
+
+
+Markup = Union[InlineKeyboardMarkup, str, None]
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+class Outbound:
+    """Sends and edits messages of the bot"""
+
+    def __init__(self, bot: Bot, maxsize: int = 1024, seconds: float = 3600) -> None:
+        self._bot = bot
+        # Message id, text and keyboard of the last message by chat id
+        self._last = LRUCacheTTL(maxsize=maxsize, seconds=seconds)
+
+    def cache_info(self) -> Dict[str, CacheInfoTTL]:
+        return dict(messages=self._last.info())
+
+    async def send(self, chat_id: int, text: str, markup: Markup = None, **kwargs) -> Message:
+        message = await self._bot.send_message(chat_id=chat_id, text=text, reply_markup=markup, **kwargs)
+        self._last[chat_id] = message.message_id, text, markup
+        return message
+
+    async def edit(self, message: Message, text: Optional[str] = None, markup: Markup = None, **kwargs) -> None:
+        """Change text and keyboard of the message; without `text` only the keyboard is changed
+
+        Like in Telegram, the message has no keyboard after the edit if `markup` is `None`.
+        """
+        chat_id, message_id = message.chat.id, message.message_id
+        last = self._last.get(chat_id)
+        known = last is not None and last[0] == message_id
+        if known and text == last[1]:
+            text = None  # the text is not changed
+        if text is None and known and markup == last[2]:
+            metrics.telegram_skipped.inc(('edit',))
+            return
+
+        try:
+            if text is None:
+                await self._bot.edit_message_reply_markup(chat_id, message_id, reply_markup=markup)
+            else:
+                await self._bot.edit_message_text(text, chat_id, message_id, reply_markup=markup, **kwargs)
+        except MessageNotModified:
+            pass
+        # An edit of an older message (e.g. the previous card after a new one is sent) keeps the last message
+        if known or last is None:
+            self._last[chat_id] = message_id, text if text is not None else last[1] if known else None, markup
+
+    async def answer(self, callback: CallbackQuery, text: Optional[str] = None) -> None:
+        """Answer callback query; a failed answer does not affect handling of the query, so it is only logged"""
+        try:
+            await callback.answer(text)
+        except TelegramAPIError as e:
+            log.warning('failed to answer callback query: %r', e)
@@ -0,0 +1,240 @@
+"""Shared work pool of news for fossnewsbot
+
+Random news are fetched for every user separately, so active users often get the same news and categorize it
+twice. The pool fetches uncategorized news in bulk and hands every news out under a time-limited lease
+to a single user (or to `copies` users for cross-validation) among the users it has been fetched for. A lease ends when the user categorizes the news;
+leases which are not finished in time and leases of users who have moved on are returned to the pool.
+News categorized by enough users are retired: they are not handed out again even if FNGS returns them.
+
+The pool is refilled in background when few news are available for a user. News are fetched for a particular
+user, so they are known to be uncategorized only for that user: every news records the users FNGS has returned it for
+and is leased to them only. News categorized by a user are remembered, so they are not handed out to the user again
+before FNGS knows about the attempt (attempts are delivered in background by the journal).
+
+Every worker process has its own pool; users are assigned to workers, so the pools do not overlap much.
+
+The pool is disabled by default: it is refilled with news fetched in bulk, which FNGS is not known to support.
+If FNGS ignores the limit of a bulk fetch, a refill gets only a few news (see `FNGS.fetch_news_batch`),
+so the pool is refilled more often but keeps working.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from logging import getLogger
+from time import monotonic
+from typing import Dict, List, Optional, Set
+
+from cache import CacheInfoTTL, LRUCacheTTL
+from . import metrics
+from .fngs import FNGS, BotUser
+
+
+# Default values
+DEFAULT_SIZE = 100
+DEFAULT_LOW = 20
+DEFAULT_LEASE = 600  # seconds
+DEFAULT_COPIES = 1
+DEFAULT_TTL = 3600  # seconds
+
+USERS = 4096  # max number of users with remembered categorized news
+RETIRED = 16384  # max number of remembered news categorized by `copies` users
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+def _consume(task: asyncio.Task) -> None:
+    """Retrieve exception of a finished task so it is not reported as never retrieved"""
+    if not task.cancelled() and task.exception():
+        log.warning('pool refill failed: %r', task.exception())
+
+
+class Item:
+    """News in the pool with its leases"""
+
+    __slots__ = ('news', 'added', 'users', 'leases', 'done')
+
+    def __init__(self, news: dict, now: float) -> None:
+        self.news = news
+        self.added = now
+        self.users: Set[int] = set()  # ids of users for whom FNGS has returned the news as uncategorized
+        self.leases: Dict[int, float] = {}  # expiration times by user id
+        self.done: Set[int] = set()  # ids of users who have categorized the news
+
+    def expire(self, now: float) -> int:
+        """Drop expired leases; returns their number"""
+        expired = [tid for tid, expires in self.leases.items() if expires <= now]
+        for tid in expired:
+            del self.leases[tid]
+        return len(expired)
+
+
+class WorkPool:
+    """Pool of uncategorized news leased to users"""
+
+    def __init__(self, fngs: FNGS, size: int = DEFAULT_SIZE, low: int = DEFAULT_LOW, lease: float = DEFAULT_LEASE,
+                 copies: int = DEFAULT_COPIES, ttl: float = DEFAULT_TTL, enabled: bool = True) -> None:
+        self._fngs = fngs
+        self._size = size
+        self._low = low
+        self._lease = lease
+        self._copies = copies
+        self._ttl = ttl
+        self._items: Dict[int, Item] = {}  # by news id in order of arrival
+        self._leased: Dict[int, Set[int]] = {}  # ids of leased news by user id
+        self._done = LRUCacheTTL(maxsize=USERS, seconds=ttl)  # ids of categorized news by user id
+        self._retired = LRUCacheTTL(maxsize=RETIRED, seconds=ttl)  # news which are not handed out anymore
+        self._refill: Optional[asyncio.Task] = None
+        self.enabled = enabled
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def cache_info(self) -> Dict[str, CacheInfoTTL]:
+        return dict(pool_users=self._done.info(), pool_retired=self._retired.info())
+
+    def _available(self, user: BotUser = None) -> int:
+        """Number of news available for new leases (to the user if it is given)"""
+        return sum(1 for item in self._items.values() if len(item.leases) + len(item.done) < self._copies
+                   and (user is None or user.tid in item.users and user.tid not in item.leases
+                        and user.tid not in item.done))
+
+    def stats(self) -> Dict[str, int]:
+        """Number of news by state: available for new leases or leased to all users they can be leased to"""
+        available = self._available()
+        return dict(available=available, leased=len(self._items) - available)
+
+    def _categorized(self, user: BotUser) -> Set[int]:
+        done = self._done.get(user.tid)
+        if done is None:
+            done = self._done[user.tid] = set()
+        return done
+
+    def _release(self, user: BotUser) -> None:
+        """Return news leased to the user to the pool"""
+        for news_id in self._leased.pop(user.tid, ()):
+            item = self._items.get(news_id)
+            if item is not None:
+                item.leases.pop(user.tid, None)
+
+    def _take(self, user: BotUser, count: int) -> List[dict]:
+        """Lease up to `count` available news to the user; expired leases and news are dropped on the way"""
+        now = monotonic()
+        done = self._categorized(user)
+        leased = self._leased.setdefault(user.tid, set())
+        news, stale, expired = [], [], 0
+        for news_id, item in self._items.items():
+            if now - item.added > self._ttl:
+                stale.append(news_id)
+                continue
+            expired += item.expire(now)
+            if len(news) < count and user.tid in item.users and news_id not in done and user.tid not in item.leases \
+                    and user.tid not in item.done and len(item.leases) + len(item.done) < self._copies:
+                item.leases[user.tid] = now + self._lease
+                leased.add(news_id)
+                news.append(item.news)
+        for news_id in stale:
+            del self._items[news_id]
+        if expired:
+            metrics.pool_expired.inc(amount=expired)
+        return news
+
+    async def _fill(self, user: BotUser, limit: int) -> List[int]:
+        """Fetch up to `limit` uncategorized news of the user to the pool; returns ids of fetched news
+
+        Leased news do not count towards the size of the pool, so it can be refilled while all its news are leased.
+        """
+        if limit <= 0:
+            return []
+        now = monotonic()
+        done = self._categorized(user)
+        fetched, added = [], 0
+        for news in await self._fngs.fetch_news_batch(user, limit):
+            # The user may have categorized the news recently, but the attempt has not been delivered yet;
+            # news retired from the pool are uncategorized for this user, but categorized by enough users
+            if news['id'] in done or self._retired.get(news['id']):
+                continue
+            fetched.append(news['id'])
+            item = self._items.get(news['id'])
+            if item is None:
+                item = self._items[news['id']] = Item(news, now)
+                added += 1
+            item.users.add(user.tid)
+        log.debug('%s refilled pool: %i news added, %i in pool', user, added, len(self._items))
+        return fetched
+
+    def _share(self, user: BotUser, ids: List[int], count: int) -> List[dict]:
+        """Lease news fetched for the user even if they are leased to other users"""
+        expires = monotonic() + self._lease
+        leased = self._leased.setdefault(user.tid, set())
+        news = []
+        for news_id in ids[:count]:
+            item = self._items[news_id]
+            item.leases[user.tid] = expires
+            leased.add(news_id)
+            news.append(item.news)
+        return news
+
+    def _schedule(self, user: BotUser) -> None:
+        """Start refill in background unless it is running already"""
+        if self._refill is None or self._refill.done():
+            self._refill = asyncio.ensure_future(self._fill(user, self._size - self._available(user)))
+            self._refill.add_done_callback(_consume)
+
+    async def lease(self, user: BotUser, count: int = 1) -> List[dict]:
+        """Lease up to `count` news to the user; news leased to the user before are returned to the pool
+
+        Returns an empty list if there are no news for the user.
+        """
+        self._release(user)
+        news = self._take(user, count)
+        if len(news) < count:
+            # Concurrent refill is awaited, so news it has fetched are used if they are fetched for this user too;
+            # otherwise the pool is refilled for this user
+            if self._refill is not None and not self._refill.done():
+                await asyncio.wait([self._refill])
+                news += self._take(user, count - len(news))
+            if len(news) < count:
+                ids = await self._fill(user, max(count - len(news), self._size - self._available(user)))
+                news += self._take(user, count - len(news))
+                if not news:
+                    # All news of the user are leased to other users: sharing them is better than no news at all
+                    news = self._share(user, ids, count)
+            metrics.pool_leases.inc(('refill' if news else 'empty',))
+        else:
+            metrics.pool_leases.inc(('pool',))
+
+        if self._available(user) < self._low:
+            self._schedule(user)
+        return news
+
+    def complete(self, user: BotUser, news_id: int) -> None:
+        """Finish lease of the news categorized by the user"""
+        self._categorized(user).add(news_id)
+        leased = self._leased.get(user.tid)
+        if leased is not None:
+            leased.discard(news_id)
+        item = self._items.get(news_id)
+        if item is None:
+            return
+        item.leases.pop(user.tid, None)
+        item.done.add(user.tid)
+        if len(item.done) >= self._copies:
+            del self._items[news_id]
+            self._retired[news_id] = True
@@ -0,0 +1,178 @@
+"""Speculative prefetch of news for fossnewsbot
+
+Next random news and count of uncategorized news are fetched in background while the user reads the current news,
+so the next news can be shown without waiting for FNGS.
+
+Attempts are delivered to FNGS in background by the journal, so FNGS may return news the user has just categorized.
+News categorized by a user are remembered for a while and skipped both in prefetched and in fetched news.
+Prefetched news older than `RECHECK` seconds is fetched again, since it may have been categorized meanwhile.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from logging import getLogger
+from time import monotonic
+from typing import Awaitable, Dict, List, Optional, Set
+
+from cache import CacheInfoTTL, LRUCacheTTL
+from .fngs import FNGS, BotUser
+
+
+RECHECK = 60  # seconds after which prefetched news is fetched again
+FETCH_TRIES = 3  # fetches of news skipping news categorized by the user recently
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+def _consume(task: asyncio.Task) -> None:
+    """Retrieve exception of a finished task so it is not reported as never retrieved"""
+    if not task.cancelled() and task.exception():
+        log.warning('prefetch failed: %r', task.exception())
+
+
+class Prefetched:
+    """Prefetch buffer of a single user"""
+
+    __slots__ = ('news', 'count', 'fetched')
+
+    def __init__(self) -> None:
+        self.news: Optional[asyncio.Task] = None
+        self.count: Optional[asyncio.Task] = None
+        self.fetched = 0.0  # time of the news fetch
+
+
+class Prefetcher:
+    """Per-user buffers of prefetched news
+
+    Buffers are kept in LRU cache with TTL, so the memory is bounded and buffers of idle users expire.
+    """
+
+    def __init__(self, fngs: FNGS, maxsize: int = 256, seconds: float = 300, enabled: bool = True) -> None:
+        self._fngs = fngs
+        self._buffers = LRUCacheTTL(maxsize=maxsize, seconds=seconds)
+        self._done = LRUCacheTTL(maxsize=maxsize, seconds=seconds)  # ids of recently categorized news by user id
+        self.enabled = enabled
+
+    def cache_info(self) -> Dict[str, CacheInfoTTL]:
+        return dict(prefetch=self._buffers.info(), prefetch_done=self._done.info())
+
+    def _categorized(self, user: BotUser) -> Set[int]:
+        done = self._done.get(user.tid)
+        if done is None:
+            done = self._done[user.tid] = set()
+        return done
+
+    @staticmethod
+    def _task(coro: Awaitable) -> asyncio.Task:
+        task = asyncio.ensure_future(coro)
+        task.add_done_callback(_consume)
+        return task
+
+    @staticmethod
+    def _failed(task: Optional[asyncio.Task]) -> bool:
+        return task is None or task.done() and (task.cancelled() or task.exception() is not None)
+
+    def schedule(self, user: BotUser, count: bool = True) -> None:
+        """Start fetching the next news (unless it is already fetched) and optionally the count of news"""
+        if not self.enabled:
+            return
+
+        buf = self._buffers.get(user.tid)
+        if buf is None:
+            buf = self._buffers[user.tid] = Prefetched()
+
+        if self._failed(buf.news):
+            buf.news = self._task(self._fngs.fetch_news(user))
+            buf.fetched = monotonic()
+        if count or self._failed(buf.count):
+            buf.count = self._task(self._fngs.fetch_news_count(user))
+
+    def invalidate(self, user: BotUser, news_id: int) -> None:
+        """Mark news as categorized by this user and refresh the buffer
+
+        Prefetched news is dropped if it is the categorized one.
+        Prefetched count is refetched because it is outdated now.
+        """
+        # News are skipped by `fetch` even if prefetch is disabled
+        self._categorized(user).add(news_id)
+        if not self.enabled:
+            return
+
+        buf = self._buffers.get(user.tid)
+        if buf is None:
+            return
+
+        if buf.news is not None and buf.news.done() and not self._failed(buf.news) \
+                and buf.news.result().get('id') == news_id:
+            buf.news = None
+        self.schedule(user)
+
+    async def pop(self, user: BotUser) -> Optional[dict]:
+        """Take prefetched news with count from the buffer
+
+        Returns `None` if there is no usable prefetched news, so it should be fetched as usual.
+        Prefetched absence of news is not usable either: new news may have arrived since.
+        """
+        buf = self._buffers.pop(user.tid, None)
+        if buf is None or buf.news is None or buf.count is None:
+            return None
+        if monotonic() - buf.fetched > RECHECK:
+            log.debug('%s dropped old prefetched news', user)
+            return None
+
+        try:
+            news, count = await asyncio.gather(buf.news, buf.count)
+        except Exception as e:
+            log.warning('%s cannot use prefetched news: %r', user, e)
+            return None
+
+        if not news:
+            return None
+        if news['id'] in self._categorized(user):
+            log.debug('%s dropped stale prefetched news: id=%i', user, news['id'])
+            return None
+
+        news = dict(news, count=count)
+        log.debug('%s used prefetched news', user)
+
+        return news
+
+    async def fetch(self, user: BotUser) -> dict:
+        """Fetch news with count as usual, skipping news categorized by the user recently
+
+        Returns an empty dict if there are no news for the user.
+        """
+        done = self._done.get(user.tid) or ()
+        for _ in range(FETCH_TRIES):
+            news = await self._fngs.fetch_news(user)
+            if not news or news['id'] not in done:
+                break
+            log.debug('%s skipped recently categorized news: id=%i', user, news['id'])
+        else:
+            return {}
+
+        if news:
+            news['count'] = await self._fngs.fetch_news_count(user)
+        return news
+
+    def fresh(self, user: BotUser, news: List[dict]) -> List[dict]:
+        """News except the ones categorized by the user recently"""
+        done = self._done.get(user.tid) or ()
+        return [n for n in news if n['id'] not in done]
@@ -0,0 +1,177 @@
+"""Rate-limited scheduler of Telegram Bot API requests
+
+Telegram limits the rate of requests of a bot: about 30 per second in total and about one per second in a chat.
+Every request waits for a token of its chat bucket and then for a token of the global bucket.
+Requests waiting for the global bucket are ordered by priority: answers of callback queries go first,
+so progress indicators of users stop, then edits of messages, then new messages.
+Requests failed with `RetryAfter` are sent again after the requested time with a random jitter,
+so requests which have failed together are not sent together again.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import random
+from heapq import heappop, heappush
+from itertools import count
+from logging import getLogger
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+from cache import LRUCacheTTL
+from . import metrics
+
+
+# Priorities of methods: requests with lower values are sent first
+PRIORITIES = dict(
+    answerCallbackQuery=0,
+    editMessageText=1,
+    editMessageReplyMarkup=1,
+    deleteMessage=1,
+    sendMessage=2,
+)
+DEFAULT_PRIORITY = 1
+
+RETRY_JITTER = 0.2  # part of retry_after added at random
+CHATS = 4096  # max number of chats with buckets
+CHAT_TTL = 60  # seconds; a bucket of a chat without requests is full again by then
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+class TokenBucket:
+    """Token bucket; tokens may be taken in advance, then the next request waits until they are refilled"""
+
+    __slots__ = ('rate', 'capacity', '_tokens', '_updated')
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, now: float) -> float:
+        """Time to wait for a token"""
+        self._refill(now)
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self, now: float) -> float:
+        """Take a token; returns time to wait until it is available"""
+        delay = self.delay(now)
+        self._tokens -= 1
+        return delay
+
+    def pause(self, seconds: float, now: float) -> None:
+        """Make the next token available not earlier than in `seconds`"""
+        self._refill(now)
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+
+class Scheduler:
+    """Global and per-chat rate limits of Telegram Bot API requests"""
+
+    def __init__(self, rate: float = 30, chat_rate: float = 1, chat_burst: int = 3, retries: int = 3) -> None:
+        self._global = TokenBucket(rate, rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats = LRUCacheTTL(maxsize=CHATS, seconds=CHAT_TTL)
+        self._retries = retries
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.waiting = 0
+
+    async def _dispatch(self) -> None:
+        """Grant global tokens to waiting requests in order of priority"""
+        while self._queue:
+            delay = self._global.delay(monotonic())
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            *_, future = heappop(self._queue)
+            if not future.done():  # the request may be cancelled
+                self._global.take(monotonic())
+                future.set_result(None)
+        self._dispatcher = None
+
+    async def acquire(self, chat_id: Any, priority: int) -> None:
+        """Wait for tokens of the chat (if any) and the global bucket"""
+        self.waiting += 1
+        try:
+            if chat_id is not None:
+                bucket = self._chats.get(chat_id)
+                if bucket is None:
+                    bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+                delay = bucket.take(monotonic())
+                if delay:
+                    await asyncio.sleep(delay)
+
+            if not self._queue and not self._global.delay(monotonic()):
+                self._global.take(monotonic())
+                return
+            future = asyncio.get_event_loop().create_future()
+            heappush(self._queue, (priority, next(self._seq), future))
+            if self._dispatcher is None:
+                self._dispatcher = asyncio.ensure_future(self._dispatch())
+            await future
+        finally:
+            self.waiting -= 1
+
+    def _pause(self, chat_id: Any, seconds: float) -> None:
+        now = monotonic()
+        bucket = self._chats.get(chat_id) if chat_id is not None else None
+        (bucket or self._global).pause(seconds, now)
+
+    async def call(self, method: str, data: Optional[Dict], send: Callable[[], Awaitable]) -> Any:
+        """Send request when rate limits allow, retrying it on `RetryAfter`"""
+        chat_id = data.get('chat_id') if data else None
+        priority = PRIORITIES.get(method, DEFAULT_PRIORITY)
+        for attempt in range(self._retries + 1):
+            started = monotonic()
+            await self.acquire(chat_id, priority)
+            metrics.telegram_wait_seconds.observe(monotonic() - started, (method,))
+            try:
+                return await send()
+            except RetryAfter as e:
+                if attempt == self._retries:
+                    raise
+                # The request is queued again, the chat (or all chats for requests without a chat) is paused
+                delay = e.timeout * random.uniform(1, 1 + RETRY_JITTER)
+                log.warning('%s: flood control exceeded for chat %s, retrying in %.1f s', method, chat_id, delay)
+                metrics.telegram_retries.inc((method,))
+                self._pause(chat_id, delay)
+
+
+class ScheduledBot(Bot):
+    """Bot sending requests through `scheduler` if it is set"""
+
+    scheduler: Optional[Scheduler] = None
+
+    async def request(self, method: str, data: Optional[Dict] = None, files: Optional[Dict] = None, **kwargs):
+        if self.scheduler is None:
+            return await super().request(method, data, files, **kwargs)
+        return await self.scheduler.call(method, data, lambda: super(ScheduledBot, self).request(method, data, files,
+                                                                                                **kwargs))
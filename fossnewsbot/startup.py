@@ -0,0 +1,116 @@
+"""Startup pipeline of fossnewsbot
+
+The bot starts serving updates as soon as handlers are imported; caches are warmed up in background meanwhile.
+Warm-up phases (FNGS token, translations, news types and categories and so on) run concurrently.
+A failed phase is retried with exponential backoff until it succeeds, so the bot starts even if FNGS
+is unreachable for a while; updates handled before the end of warm-up fetch what they need themselves.
+
+Durations of phases are recorded: they are logged when warm-up is over and printed by `--profile-startup`.
+Only the standard library is imported here, so imports of the bot can be measured too.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from contextlib import contextmanager
+from inspect import isawaitable
+from logging import getLogger
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, Optional, Set
+
+
+RETRY_DELAY = 1  # seconds before the first retry of a failed phase
+RETRY_DELAY_MAX = 60  # seconds
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+class Profile:
+    """Durations of startup phases in order of their end"""
+
+    def __init__(self) -> None:
+        self.started = perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.failed: Set[str] = set()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = perf_counter() - started
+
+    def elapsed(self) -> float:
+        return perf_counter() - self.started
+
+    def report(self) -> str:
+        """Table of durations; warm-up phases run concurrently, so they overlap"""
+        lines = [f'{"phase":<12} {"ms":>9}']
+        for name, seconds in self.phases.items():
+            lines.append(f'{name:<12} {seconds * 1000:9.1f}' + ('  failed' if name in self.failed else ''))
+        lines.append(f'{"total":<12} {self.elapsed() * 1000:9.1f}')
+        return '\n'.join(lines)
+
+
+profile = Profile()
+
+_task: Optional[asyncio.Task] = None
+
+
+async def _run(name: str, warm: Callable[[], Any], retry: bool) -> None:
+    """Run a warm-up phase; `warm` may return an awaitable, which is awaited"""
+    delay = RETRY_DELAY
+    with profile.phase(name):
+        while True:
+            try:
+                result = warm()
+                if isawaitable(result):
+                    await result
+                return
+            except Exception as e:
+                if not retry:
+                    profile.failed.add(name)
+                    log.error('warm-up of %s failed: %r', name, e)
+                    return
+                log.warning('warm-up of %s failed, retrying in %i s: %r', name, delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_DELAY_MAX)
+
+
+async def warm_up(phases: Dict[str, Callable[[], Any]], retry: bool = True) -> None:
+    """Run warm-up phases concurrently; failed phases are retried until they succeed if `retry` is true"""
+    with profile.phase('warm-up'):
+        await asyncio.gather(*[_run(name, warm, retry) for name, warm in phases.items()])
+    log.info('warmed up in %.0f ms, started in %.0f ms',
+             profile.phases['warm-up'] * 1000, profile.elapsed() * 1000)
+
+
+def start(phases: Dict[str, Callable[[], Any]]) -> None:
+    """Warm up in background"""
+    global _task
+    if _task is None:
+        _task = asyncio.ensure_future(warm_up(phases))
+
+
+def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
@@ -0,0 +1,313 @@
+"""Multi-process mode of fossnewsbot
+
+The front process accepts Telegram webhook requests and forwards every update to one of worker processes.
+Updates are routed by id of the user with consistent hashing, so updates of a user are handled by the same worker
+and per-user caches and sessions stay local to it. If the worker of a user is down, its users are routed
+to the next workers on the ring until it is back.
+
+Workers are started by the front process and listen on local ports `workers.port` + index.
+The front process checks their health and restarts crashed or hung workers.
+Every worker has its own attempts journal.
+"""
+
+#  Copyright (C) 2021 PermLUG
+#
+#  This file is part of fossnewsbot, FOSS News Telegram Bot.
+#
+#  fossnewsbot is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  fossnewsbot is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import os
+import signal
+import sys
+from bisect import bisect
+from hashlib import blake2b
+from logging import getLogger
+from time import monotonic
+from typing import Any, Iterable, Iterator, List, Optional
+
+from aiogram import Bot
+from aiohttp import ClientConnectorError, ClientError, ClientSession, ClientTimeout, web
+
+from . import metrics
+from .config import PREFIX, config
+
+
+# Default values
+DEFAULT_REPLICAS = 64  # virtual nodes of a worker on the ring
+
+# Health checks
+HEALTH_PATH = '/health'
+HEALTH_INTERVAL = 5  # seconds
+HEALTH_TIMEOUT = 2  # seconds
+HEALTH_FAILURES = 3  # failed checks in a row before the worker is restarted
+
+# Restarts of crashed workers
+RESTART_DELAY = 1  # seconds
+RESTART_DELAY_MAX = 60  # seconds
+STARTUP_TIMEOUT = 60  # seconds to wait for workers before the webhook is set
+STOP_TIMEOUT = 15  # seconds to wait for a worker to shut down before it is killed
+
+FORWARD_TIMEOUT = 60  # seconds
+FORWARD_HEADERS = ('Content-Type', 'X-Telegram-Bot-Api-Secret-Token')
+
+# Environment variables with index of a worker process and base port of workers
+# (`workers.index` and `workers.port` options)
+WORKER_ENV = f'{PREFIX}_WORKERS__INDEX'
+PORT_ENV = f'{PREFIX}_WORKERS__PORT'
+
+# Metrics of the front process
+forward_seconds = metrics.registry.histogram('fossnewsbot_forward_seconds', 'Latency of updates forwarded to workers',
+                                             ['worker', 'status'])
+
+# Logger
+log = getLogger(__name__.split('.')[-1])
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring
+
+    Every node has `replicas` virtual nodes on the ring, so keys are distributed evenly
+    and only keys of a node move to other nodes when the node is removed.
+    """
+
+    def __init__(self, nodes: Iterable[Any], replicas: int = DEFAULT_REPLICAS) -> None:
+        ring = sorted((_hash(f'{node}:{i}'), node) for node in nodes for i in range(replicas))
+        self._hashes = [h for h, _ in ring]
+        self._nodes = [node for _, node in ring]
+        self._size = len(set(self._nodes))
+
+    def nodes(self, key: Any) -> Iterator[Any]:
+        """Distinct nodes for the key in order of preference"""
+        seen = set()
+        n = len(self._nodes)
+        start = bisect(self._hashes, _hash(str(key)))
+        for i in range(n):
+            node = self._nodes[(start + i) % n]
+            if node not in seen:
+                yield node
+                seen.add(node)
+                if len(seen) == self._size:
+                    return
+
+    def node(self, key: Any) -> Any:
+        """Node for the key"""
+        return next(self.nodes(key))
+
+
+def user_id(update: dict) -> Optional[int]:
+    """Id of the user who has sent the update (chat id for updates without a user)"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        for field in ('from', 'user', 'chat'):
+            obj = value.get(field)
+            if isinstance(obj, dict) and 'id' in obj:
+                return obj['id']
+    return None
+
+
+def worker_path(path: str, index: int) -> str:
+    """Path to a file of a worker process: `journal.db` of worker 1 is `journal-1.db`"""
+    root, ext = os.path.splitext(path)
+    return f'{root}-{index}{ext}'
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.Response(text='OK')
+
+
+class Worker:
+    """Worker process supervised by the front process"""
+
+    def __init__(self, index: int, port: int) -> None:
+        self.index = index
+        self.port = port
+        self.url = f'http://127.0.0.1:{port + index}'
+        self.healthy = False
+        self._ready = False  # the worker has been healthy since its start
+        self._failures = 0
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._supervisor: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def __str__(self) -> str:
+        return f'worker {self.index}'
+
+    def start(self) -> None:
+        self._supervisor = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        delay = RESTART_DELAY / 2
+        while True:
+            env = dict(os.environ)
+            env[WORKER_ENV] = str(self.index)
+            env[PORT_ENV] = str(self.port)
+            self._process = await asyncio.create_subprocess_exec(sys.executable, '-m', __package__, env=env)
+            self._ready = False
+            self._failures = 0
+            log.info('%s started: pid=%i', self, self._process.pid)
+
+            code = await self._process.wait()
+            self.healthy = False
+            if self._stopping:
+                return
+
+            # A worker which crashes on startup is restarted with increasing delay
+            delay = RESTART_DELAY if self._ready else min(RESTART_DELAY_MAX, delay * 2)
+            log.error('%s exited with code %i, restarting in %i s', self, code, delay)
+            await asyncio.sleep(delay)
+
+    async def check(self, http: ClientSession) -> None:
+        """Check health of the worker; a worker which fails too many checks in a row is killed and restarted"""
+        if self._process is None or self._process.returncode is not None:
+            return
+
+        try:
+            async with http.get(self.url + HEALTH_PATH, timeout=ClientTimeout(total=HEALTH_TIMEOUT)) as r:
+                ok = r.status == 200
+        except (ClientError, asyncio.TimeoutError):
+            ok = False
+
+        if ok:
+            if not self.healthy:
+                log.info('%s is healthy', self)
+            self.healthy = self._ready = True
+            self._failures = 0
+            return
+
+        self._failures += 1
+        if self.healthy:
+            log.warning('%s failed health check', self)
+        self.healthy = False
+        # A starting worker is given more time
+        if self._failures >= (HEALTH_FAILURES if self._ready else STARTUP_TIMEOUT // HEALTH_INTERVAL):
+            log.error('%s failed %i health checks, restarting', self, self._failures)
+            self._process.kill()
+
+    def send_signal(self, signum: int) -> None:
+        if self._process is not None and self._process.returncode is None:
+            self._process.send_signal(signum)
+
+    async def stop(self) -> None:
+        self._stopping = True
+        self.healthy = False
+        if self._process is not None and self._process.returncode is None:
+            self._process.terminate()
+            try:
+                await asyncio.wait_for(self._process.wait(), STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.warning('%s has not stopped in time, killing', self)
+                self._process.kill()
+        if self._supervisor is not None:
+            await self._supervisor
+
+
+class Front:
+    """Front process: routes webhook updates to workers by user"""
+
+    def __init__(self, bot: Bot, count: int, port: int) -> None:
+        self._bot = bot
+        self._workers: List[Worker] = [Worker(i, port) for i in range(count)]
+        self._ring = HashRing(range(count))
+        self._http: Optional[ClientSession] = None
+        self._checker: Optional[asyncio.Task] = None
+        metrics.registry.gauge('fossnewsbot_worker_healthy', 'Health of worker processes', ['worker'],
+                               collect=lambda: [((str(w.index),), int(w.healthy)) for w in self._workers])
+
+    async def forward(self, request: web.Request) -> web.Response:
+        """Forward webhook request to the worker of the user; the response of the worker is returned to Telegram"""
+        body = await request.read()
+        try:
+            key = user_id(json.loads(body))
+        except (ValueError, AttributeError):
+            return web.Response(status=400)
+
+        headers = {name: request.headers[name] for name in FORWARD_HEADERS if name in request.headers}
+        for index in self._ring.nodes(key):
+            worker = self._workers[index]
+            if not worker.healthy:
+                continue
+            started = monotonic()
+            try:
+                async with self._http.post(worker.url + request.path, data=body, headers=headers) as r:
+                    response = web.Response(body=await r.read(), status=r.status, content_type=r.content_type)
+                    forward_seconds.observe(monotonic() - started, (str(index), str(r.status)))
+                    return response
+            except ClientConnectorError as e:
+                # The update has not been delivered, so it can be sent to the next worker
+                log.warning('%s is unavailable: %s', worker, e)
+                worker.healthy = False
+            except (ClientError, asyncio.TimeoutError) as e:
+                log.error('%s failed to handle update: %r', worker, e)
+                break
+
+        # Telegram will send the update again
+        return web.Response(status=503)
+
+    async def _check(self) -> None:
+        while True:
+            await asyncio.gather(*[worker.check(self._http) for worker in self._workers])
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def _wait_healthy(self) -> None:
+        while not all(worker.healthy for worker in self._workers):
+            await asyncio.sleep(HEALTH_TIMEOUT / 4)
+
+    def _reload(self) -> None:
+        log.info('Reloading settings of workers...')
+        for worker in self._workers:
+            worker.send_signal(signal.SIGHUP)
+
+    async def on_startup(self, app: web.Application) -> None:
+        log.info('Starting %i workers...', len(self._workers))
+        self._http = ClientSession(timeout=ClientTimeout(total=FORWARD_TIMEOUT))
+        for worker in self._workers:
+            worker.start()
+        self._checker = asyncio.ensure_future(self._check())
+        # Workers reload their settings on SIGHUP
+        asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, self._reload)
+
+        try:
+            await asyncio.wait_for(self._wait_healthy(), STARTUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning('%i of %i workers are healthy', sum(w.healthy for w in self._workers), len(self._workers))
+        await self._bot.set_webhook(app['webhook_url'], drop_pending_updates=True)
+
+    async def on_shutdown(self, app: web.Application) -> None:
+        log.info('Shutting down...')
+        await self._bot.delete_webhook()
+        asyncio.get_event_loop().remove_signal_handler(signal.SIGHUP)
+        self._checker.cancel()
+        await asyncio.gather(*[worker.stop() for worker in self._workers])
+        await self._http.close()
+        session = await self._bot.get_session()
+        await session.close()
+        log.info('Bye!')
+
+    def run(self, webhook_url: str, webhook_path: str, host: str, port: int) -> None:
+        app = web.Application()
+        app['webhook_url'] = webhook_url
+        app.router.add_post(webhook_path, self.forward)
+        app.router.add_get(HEALTH_PATH, health)
+        if config.metrics.enabled:
+            app.router.add_get(metrics.METRICS_PATH, metrics.handler)
+        app.on_startup.append(self.on_startup)
+        app.on_shutdown.append(self.on_shutdown)
+        web.run_app(app, host=host, port=port)